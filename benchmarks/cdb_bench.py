@@ -0,0 +1,78 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compare lookups in a constant database against the SQLite read paths.
+
+Usage: python benchmarks/cdb_bench.py [num_rows [num_lookups]]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import sqlite3dbm.cdb
+import sqlite3dbm.dbm
+
+def time_lookups(name, db, keys):
+    start = time.time()
+    for k in keys:
+        db[k]
+    single = time.time() - start
+
+    start = time.time()
+    db.get_many(keys)
+    batch = time.time() - start
+
+    print '%-20s %10.0f lookups/s %10.0f get_many keys/s' % (
+        name, len(keys) / single, len(keys) / batch,
+    )
+
+def main(num_rows=100000, num_lookups=100000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        sqlite_path = os.path.join(tmpdir, 'bench.sqlite')
+        cdb_path = os.path.join(tmpdir, 'bench.cdb')
+
+        sqlite3dbm.dbm.build(
+            sqlite_path,
+            (('key%010d' % i, 'val%d' % i) for i in xrange(num_rows)),
+        )
+        start = time.time()
+        sqlite3dbm.cdb.export(sqlite_path, cdb_path)
+        print 'Exported %d rows in %.2fs' % (num_rows, time.time() - start)
+
+        keys = [
+            'key%010d' % random.randrange(num_rows)
+            for _ in xrange(num_lookups)
+        ]
+        time_lookups('sqlite', sqlite3dbm.dbm.open(sqlite_path), keys)
+        time_lookups(
+            'sqlite in_memory',
+            sqlite3dbm.dbm.open(sqlite_path, in_memory=True),
+            keys,
+        )
+        time_lookups('cdb', sqlite3dbm.cdb.open(cdb_path), keys)
+        time_lookups(
+            'cdb zero_copy',
+            sqlite3dbm.cdb.open(cdb_path, zero_copy=True),
+            keys,
+        )
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,295 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Generate concurrent load on one sqlite3dbm file.
+
+Starts reader and writer processes (or threads) that hammer a shared database
+for a fixed time, picking keys uniformly or from a Zipf distribution, and
+reports the throughput and latency percentiles of each side along with how
+often SQLite said "database is locked".  Locked operations are rolled back
+and retried up to --retries times before they count as failed.
+
+Use it to compare journal modes and settings before deploying, e.g.:
+    python benchmarks/load.py --readers 8 --writers 2 --journal-mode wal
+    python benchmarks/load.py --readers 8 --writers 2 --journal-mode delete
+
+Usage: python benchmarks/load.py [options]
+"""
+
+from __future__ import with_statement
+
+import bisect
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import Queue
+
+import sqlite3dbm.dbm
+
+def _key(i):
+    return 'key%010d' % i
+
+class ZipfSampler(object):
+    """Pick numbers in [0, n) with probability proportional to 1 / (i+1)^s,
+    so that a few keys are hot and most are cold.
+    """
+
+    def __init__(self, n, s=1.0):
+        total = 0.0
+        self.cumulative = []
+        for i in xrange(n):
+            total += 1.0 / (i + 1) ** s
+            self.cumulative.append(total)
+        self.total = total
+
+    def __call__(self, rand):
+        return bisect.bisect(self.cumulative, rand.random() * self.total)
+
+def make_sampler(options):
+    if options['distribution'] == 'zipf':
+        return ZipfSampler(options['num_keys'], options['zipf_s'])
+    num_keys = options['num_keys']
+    return lambda rand: rand.randrange(num_keys)
+
+def open_db(path, role, options):
+    """Open the map for one worker and apply the connection settings."""
+    db = sqlite3dbm.dbm.open(path, flag='r' if role == 'reader' else 'w')
+    db.conn.execute('PRAGMA busy_timeout = %d' % (options['busy_timeout'],))
+    if options['synchronous']:
+        db.conn.execute('PRAGMA synchronous = %s' % (options['synchronous'],))
+    return db
+
+def is_locked_error(e):
+    return 'locked' in str(e) or 'busy' in str(e)
+
+def worker(path, role, seed, options, deadline, results):
+    """Run reads or writes against `path` until `deadline`, then put a
+    result dict on the `results` queue.
+    """
+    db = open_db(path, role, options)
+    rand = random.Random(seed)
+    sample = make_sampler(options)
+    batch_size = options['batch_size']
+    value = 'x' * options['value_size']
+
+    latencies = []
+    locked = 0
+    failed = 0
+    keys_done = 0
+    while time.time() < deadline:
+        keys = [_key(sample(rand)) for _ in xrange(batch_size)]
+        start = time.time()
+        for attempt in xrange(options['retries'] + 1):
+            try:
+                if role == 'reader':
+                    if batch_size == 1:
+                        db.get(keys[0])
+                    else:
+                        db.get_many(keys)
+                else:
+                    if batch_size == 1:
+                        db[keys[0]] = value
+                    else:
+                        db.update((k, value) for k in keys)
+                keys_done += batch_size
+                break
+            except sqlite3.OperationalError, e:
+                if not is_locked_error(e):
+                    raise
+                locked += 1
+                db.conn.rollback()
+        else:
+            failed += 1
+        latencies.append(time.time() - start)
+
+    results.put({
+        'role': role,
+        'latencies': latencies,
+        'locked': locked,
+        'failed': failed,
+        'keys': keys_done,
+    })
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    index = min(int(len(sorted_vals) * p / 100.0), len(sorted_vals) - 1)
+    return sorted_vals[index]
+
+def summarize(role, worker_results, duration):
+    latencies = sorted(
+        l for r in worker_results for l in r['latencies']
+    )
+    keys = sum(r['keys'] for r in worker_results)
+    return {
+        'role': role,
+        'workers': len(worker_results),
+        'ops': len(latencies),
+        'ops_per_sec': len(latencies) / duration,
+        'keys_per_sec': keys / duration,
+        'latency': dict(
+            ('p%g' % p, percentile(latencies, p))
+            for p in (50, 90, 99, 99.9)
+        ),
+        'max_latency': latencies[-1] if latencies else None,
+        'locked': sum(r['locked'] for r in worker_results),
+        'failed': sum(r['failed'] for r in worker_results),
+    }
+
+def run(path, options):
+    """Populate the db at `path`, run the workers and return the summary.
+
+    `path` should not exist yet.  Existing data is left alone, but the keys
+    the benchmark uses are overwritten.
+    """
+    db = sqlite3dbm.dbm.open(path, flag='c')
+    db.conn.execute('PRAGMA journal_mode = %s' % (options['journal_mode'],))
+    value = 'x' * options['value_size']
+    db.update((_key(i), value) for i in xrange(options['num_keys']))
+    db.conn.close()
+
+    if options['workers'] == 'thread':
+        results = Queue.Queue()
+        make_worker = threading.Thread
+    else:
+        results = multiprocessing.Queue()
+        make_worker = multiprocessing.Process
+
+    roles = (
+        ['reader'] * options['readers'] + ['writer'] * options['writers']
+    )
+    # Leave time for the workers to start, so they all run for `duration`
+    deadline = time.time() + 1 + options['duration']
+    workers = [
+        make_worker(
+            target=worker,
+            args=(path, role, i, options, deadline, results),
+        )
+        for i, role in enumerate(roles)
+    ]
+    for w in workers:
+        w.start()
+    worker_results = [results.get() for _ in workers]
+    for w in workers:
+        w.join()
+
+    return {
+        'options': options,
+        'sqlite': sqlite3.sqlite_version,
+        'results': [
+            summarize(
+                role,
+                [r for r in worker_results if r['role'] == role],
+                options['duration'],
+            )
+            for role in ('reader', 'writer')
+            if role in roles
+        ],
+    }
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--readers', type='int', default=4)
+    parser.add_option('--writers', type='int', default=1)
+    parser.add_option(
+        '--workers', type='choice', choices=['process', 'thread'],
+        default='process', help='run workers as processes or threads',
+    )
+    parser.add_option(
+        '--duration', type='float', default=10.0,
+        help='seconds to run for [default: %default]',
+    )
+    parser.add_option('--num-keys', type='int', default=100000)
+    parser.add_option('--value-size', type='int', default=100)
+    parser.add_option(
+        '--batch-size', type='int', default=1,
+        help='keys per get_many/update; 1 means get/setitem',
+    )
+    parser.add_option(
+        '--distribution', type='choice', choices=['uniform', 'zipf'],
+        default='uniform',
+    )
+    parser.add_option(
+        '--zipf-s', type='float', default=1.0,
+        help='skew of the Zipf distribution [default: %default]',
+    )
+    parser.add_option(
+        '--journal-mode', default='delete',
+        help='delete, truncate, persist, memory, wal or off',
+    )
+    parser.add_option(
+        '--synchronous', default=None, help='off, normal or full',
+    )
+    parser.add_option(
+        '--busy-timeout', type='int', default=5000,
+        help='milliseconds SQLite waits on a lock [default: %default]',
+    )
+    parser.add_option(
+        '--retries', type='int', default=3,
+        help='times a locked operation is retried [default: %default]',
+    )
+    parser.add_option(
+        '--path',
+        help='new database file to create and keep; a temporary one by '
+        'default',
+    )
+    parser.add_option('-o', '--output', help='also write the JSON here')
+    options, _ = parser.parse_args(argv)
+    options = dict(
+        (k, v) for k, v in vars(options).iteritems()
+        if k not in ('path', 'output')
+    )
+
+    tmpdir = None
+    path = parser.values.path
+    if path is None:
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'load.sqlite')
+    elif os.path.exists(path):
+        parser.error('%s already exists; pass a new --path' % (path,))
+    try:
+        summary = run(path, options)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    for result in summary['results']:
+        print (
+            '%(role)-6s x%(workers)-3d %(ops_per_sec)10.0f ops/s '
+            '%(keys_per_sec)10.0f keys/s  locked %(locked)d failed %(failed)d'
+            % result
+        )
+        print '        latency ms: %s max %.2f' % (
+            ' '.join(
+                '%s %.2f' % (p, l * 1000)
+                for p, l in sorted(result['latency'].items())
+                if l is not None
+            ),
+            (result['max_latency'] or 0) * 1000,
+        )
+
+    if parser.values.output:
+        with open(parser.values.output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
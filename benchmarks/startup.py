@@ -0,0 +1,83 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measure how long `import sqlite3dbm` and `open()` take.
+
+Each import is timed in a fresh interpreter, so nothing is already loaded.
+open() is timed on an existing database, both on its own and followed by a
+first lookup, which is when the connection is actually made.
+
+Usage: python benchmarks/startup.py [num_runs]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import sqlite3dbm
+
+_IMPORT_CODE = (
+    'import time; start = time.time(); import %s; '
+    'print time.time() - start'
+)
+
+def time_import(module, num_runs):
+    """Best time to import `module` in a fresh interpreter."""
+    times = []
+    for _ in xrange(num_runs):
+        output = subprocess.Popen(
+            [sys.executable, '-c', _IMPORT_CODE % (module,)],
+            stdout=subprocess.PIPE,
+        ).communicate()[0]
+        times.append(float(output))
+    return min(times)
+
+def time_open(path, num_runs, lookup=False):
+    """Mean time to open the map at `path` (and do one lookup)."""
+    start = time.time()
+    for _ in xrange(num_runs):
+        smap = sqlite3dbm.open(path)
+        if lookup:
+            smap.get('foo')
+    return (time.time() - start) / num_runs
+
+def main(num_runs=20):
+    print '%-28s %8.2f ms' % (
+        'import sqlite3dbm', time_import('sqlite3dbm', num_runs) * 1000
+    )
+    print '%-28s %8.2f ms' % (
+        'import sqlite3dbm.sshelve',
+        time_import('sqlite3dbm.sshelve', num_runs) * 1000,
+    )
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'startup.sqlite')
+        sqlite3dbm.open(path, flag='c')['foo'] = 'bar'
+        num_opens = num_runs * 50
+        print '%-28s %8.3f ms' % (
+            'open()', time_open(path, num_opens) * 1000
+        )
+        print '%-28s %8.3f ms' % (
+            'open() + first lookup',
+            time_open(path, num_opens, lookup=True) * 1000,
+        )
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,309 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark the dict operations of sqlite3dbm against the stdlib dbms.
+
+Every operation is timed for each backend, number of rows and value size,
+and the results are written out as JSON.  Passing the JSON from an earlier
+run with --compare checks for regressions: the script exits with status 1 if
+any operation got more than --tolerance slower.
+
+The dbm, gdbm and dumbdbm baselines are skipped when the module is missing.
+They have no batch operations, so update, get_many and clear are done one key
+at a time on them.
+
+Usage: python benchmarks/suite.py [options]
+    e.g. python benchmarks/suite.py --rows 1000,100000 -o new.json \\
+             --compare old.json
+"""
+
+from __future__ import with_statement
+
+import itertools
+import json
+import optparse
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import sqlite3dbm
+import sqlite3dbm.dbm
+import sqlite3dbm.sshelve
+
+# Batch sizes for get_many, on both sides of the bound parameter limit
+GET_MANY_SIZES = [
+    100,
+    sqlite3dbm.dbm.SQLITE_MAX_QUERY_VARS,
+    sqlite3dbm.dbm.SQLITE_MAX_QUERY_VARS + 1,
+    5000,
+]
+
+def _open_stdlib(module_name):
+    """Return an opener for the stdlib dbm `module_name`, or None if it is
+    not available.
+    """
+    try:
+        module = __import__(module_name)
+    except ImportError:
+        return None
+    return lambda path: module.open(path, 'n')
+
+BACKENDS = [
+    ('sqlite3dbm', lambda path: sqlite3dbm.open(path, flag='n')),
+    ('sshelve', lambda path: sqlite3dbm.sshelve.open(path, flag='n')),
+    ('dbm', _open_stdlib('dbm')),
+    ('gdbm', _open_stdlib('gdbm')),
+    ('dumbdbm', _open_stdlib('dumbdbm')),
+]
+
+def _has_batch_ops(db):
+    return hasattr(db, 'get_many')
+
+## Operations.  Each takes the open db and the (key, value) rows, and
+## returns the number of keys it touched.
+
+def bench_setitem(db, rows):
+    for k, v in rows:
+        db[k] = v
+    return len(rows)
+
+def bench_update(db, rows):
+    if _has_batch_ops(db):
+        db.update(rows)
+    else:
+        bench_setitem(db, rows)
+    return len(rows)
+
+def bench_getitem(db, rows):
+    for k, _ in rows:
+        db[k]
+    return len(rows)
+
+def make_bench_get_many(batch_size):
+    def bench_get_many(db, rows):
+        keys = (k for k, _ in rows)
+        while True:
+            batch = list(itertools.islice(keys, batch_size))
+            if not batch:
+                break
+            if _has_batch_ops(db):
+                db.get_many(batch)
+            else:
+                [db[k] for k in batch]
+        return len(rows)
+    return bench_get_many
+
+def bench_iteration(db, rows):
+    if _has_batch_ops(db):
+        count = sum(1 for _ in db.iteritems())
+    else:
+        # The stdlib dbms can only list their keys
+        count = sum(1 for k in db.keys() if db[k] is not None)
+    return count
+
+def bench_clear(db, rows):
+    if _has_batch_ops(db):
+        db.clear()
+    else:
+        for k, _ in rows:
+            del db[k]
+    return len(rows)
+
+# (name, function, whether the db should be filled first)
+OPERATIONS = [
+    ('setitem', bench_setitem, False),
+    ('update', bench_update, False),
+    ('getitem', bench_getitem, True),
+] + [
+    ('get_many_%d' % size, make_bench_get_many(size), True)
+    for size in GET_MANY_SIZES
+] + [
+    ('iteration', bench_iteration, True),
+    ('clear', bench_clear, True),
+]
+
+class Rows(object):
+    """The (key, value) rows of a benchmark.
+
+    The rows are generated afresh each time they are iterated over, so that
+    even huge benchmarks only ever hold one row in memory.
+    """
+
+    def __init__(self, num_rows, value_size):
+        self.num_rows = num_rows
+        self.value = 'x' * value_size
+
+    def __len__(self):
+        return self.num_rows
+
+    def __iter__(self):
+        value = self.value
+        for i in xrange(self.num_rows):
+            yield 'key%010d' % i, value
+
+def run_one(opener, op, fill, rows, repeat):
+    """Time `op` on a fresh db `repeat` times and return the best time."""
+    best = None
+    for _ in xrange(repeat):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = opener(os.path.join(tmpdir, 'bench'))
+            if fill:
+                bench_update(db, rows)
+            start = time.time()
+            op(db, rows)
+            elapsed = time.time() - start
+            if hasattr(db, 'close'):
+                db.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def run(row_counts, value_sizes, backends, operations, repeat=1):
+    """Run the benchmarks and return the results as a JSON-able dict."""
+    results = []
+    for backend_name, opener in BACKENDS:
+        if backend_name not in backends or opener is None:
+            continue
+        for num_rows in row_counts:
+            for value_size in value_sizes:
+                rows = Rows(num_rows, value_size)
+                for op_name, op, fill in OPERATIONS:
+                    if op_name not in operations:
+                        continue
+                    seconds = run_one(opener, op, fill, rows, repeat)
+                    result = {
+                        'backend': backend_name,
+                        'op': op_name,
+                        'rows': num_rows,
+                        'value_size': value_size,
+                        'seconds': seconds,
+                        'ops_per_sec': num_rows / max(seconds, 1e-9),
+                    }
+                    print >> sys.stderr, (
+                        '%(backend)-10s %(op)-14s %(rows)9d rows '
+                        '%(value_size)6dB values %(ops_per_sec)12.0f ops/s'
+                        % result
+                    )
+                    results.append(result)
+
+    return {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sqlite': sqlite3.sqlite_version,
+            'sqlite3dbm': sqlite3dbm.__version__,
+        },
+        'results': results,
+    }
+
+def _result_key(result):
+    return (
+        result['backend'], result['op'], result['rows'], result['value_size']
+    )
+
+def find_regressions(old, new, tolerance):
+    """Return (old result, new result) pairs for the benchmarks in `new`
+    that got more than `tolerance` (a fraction) slower than in `old`.
+    """
+    old_results = dict((_result_key(r), r) for r in old['results'])
+    regressions = []
+    for result in new['results']:
+        old_result = old_results.get(_result_key(result))
+        if old_result is None:
+            continue
+        if result['ops_per_sec'] < old_result['ops_per_sec'] * (1 - tolerance):
+            regressions.append((old_result, result))
+    return regressions
+
+def _int_list(s):
+    return [int(x) for x in s.split(',')]
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '--rows', type='string', default='1000,10000',
+        help='comma-separated numbers of rows [default: %default]',
+    )
+    parser.add_option(
+        '--value-sizes', type='string', default='10,1000',
+        help='comma-separated value sizes in bytes [default: %default]',
+    )
+    parser.add_option(
+        '--backends', type='string',
+        default=','.join(name for name, _ in BACKENDS),
+        help='comma-separated backends to run [default: %default]',
+    )
+    parser.add_option(
+        '--ops', type='string',
+        default=','.join(name for name, _, _ in OPERATIONS),
+        help='comma-separated operations to run [default: %default]',
+    )
+    parser.add_option(
+        '--repeat', type='int', default=1,
+        help='take the best of this many runs [default: %default]',
+    )
+    parser.add_option(
+        '-o', '--output', help='write the JSON results here, not to stdout',
+    )
+    parser.add_option(
+        '--compare', help='JSON results from an earlier run to check against',
+    )
+    parser.add_option(
+        '--tolerance', type='float', default=0.2,
+        help='fraction by which ops/s may drop before it counts as a '
+             'regression [default: %default]',
+    )
+    options, _ = parser.parse_args(argv)
+
+    results = run(
+        _int_list(options.rows),
+        _int_list(options.value_sizes),
+        options.backends.split(','),
+        options.ops.split(','),
+        repeat=options.repeat,
+    )
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+    if options.compare:
+        with open(options.compare) as f:
+            old = json.load(f)
+        regressions = find_regressions(old, results, options.tolerance)
+        for old_result, result in regressions:
+            print >> sys.stderr, (
+                'REGRESSION: %s %s (%d rows, %dB values): '
+                '%.0f -> %.0f ops/s' % (
+                    _result_key(result) +
+                    (old_result['ops_per_sec'], result['ops_per_sec'])
+                )
+            )
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
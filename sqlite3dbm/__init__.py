@@ -20,8 +20,25 @@ serialization for it.
 __author__ = 'Jason Fennell <jfennell@yelp.com>'
 __version__ = '0.1.4-memory'
 
+import sys
+
 import sqlite3dbm.dbm as dbm
-import sqlite3dbm.sshelve as sshelve
+
+class _LazyModule(object):
+    """Stand-in for a submodule that is only imported once one of its
+    attributes is used.  Importing the submodule replaces the stand-in.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        __import__(self._name)
+        return getattr(sys.modules[self._name], attr)
+
+# sshelve pulls in shelve and pickle, which most users of the dbm interface
+# never need
+sshelve = _LazyModule('sqlite3dbm.sshelve')
 
 # Expose `open` and `error` here
 from sqlite3dbm.dbm import *
@@ -0,0 +1,325 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compile a sqlite3dbm database into an immutable, memory-mapped hash table.
+
+For static data that is read far more than it is written, even an in-memory
+SQLite database does more work per lookup than it needs to.  This module
+exports a sqlite3dbm file into a constant database in the style of djb's
+cdb (with crc32 as the hash function): a flat file of records followed by
+256 open-addressing hash tables.  A lookup is a hash, a couple of probes into
+the mmap'd file and a slice.
+Offsets are 64 bits wide, so files are not limited to 4GB like classic cdb.
+
+File layout (all integers little-endian):
+ * header: magic (8 bytes), number of records (uint64), end of the
+   records (uint64), then 256 x (table offset, number of slots) as uint64
+ * records: key length (uint32), value length (uint32), key, value
+ * hash tables: slots of (hash, record offset) as uint64.  An offset of 0
+   marks an empty slot.
+
+Usage Example:
+>>> import sqlite3dbm.cdb
+>>> sqlite3dbm.cdb.export('mydb.sqlite3', 'mydb.cdb')
+3
+>>> db = sqlite3dbm.cdb.open('mydb.cdb')
+>>> db['foo']
+'one'
+>>> db.get_many('foo', 'bar', 'qux')
+['one', 'two', None]
+>>> zero_copy_db = sqlite3dbm.cdb.open('mydb.cdb', zero_copy=True)
+>>> zero_copy_db['foo']
+<read-only buffer for 0x7f0d6ecac4d0, size 3, offset 2100 at 0x7f0d6ecac4f0>
+"""
+
+from __future__ import with_statement
+
+import __builtin__
+import mmap
+import os
+import struct
+import zlib
+from array import array
+
+import sqlite3dbm.dbm
+from sqlite3dbm.dbm import error, _array_typecode, _utf8
+
+__all__ = [
+    'CdbMap',
+    'export',
+    'open',
+]
+
+_MAGIC = 'SQ3CDB01'
+_NUM_TABLES = 256
+
+_HEADER = struct.Struct('<8sQQ')
+_TABLE_POINTER = struct.Struct('<QQ')
+_RECORD_HEADER = struct.Struct('<II')
+_SLOT = struct.Struct('<QQ')
+
+_DATA_START = _HEADER.size + _NUM_TABLES * _TABLE_POINTER.size
+
+# Offsets need 64 bits, which 'L' only has where a C long does
+_UINT64_TYPECODE = _array_typecode('QL')
+
+def _uint64_array(items):
+    """Compact array of unsigned 64-bit ints, or a plain list where the
+    platform has no such array type.
+    """
+    if _UINT64_TYPECODE is None:
+        return list(items)
+    return array(_UINT64_TYPECODE, items)
+
+# Unique sentinel that we can use to distinguish missing values from None
+# values in `select`
+__MISSING_SENTINEL__ = ('__missing__',)
+
+def cdb_hash(s):
+    """Hash used to place keys in the tables.
+
+    This is crc32 rather than cdb's own hash, since computing that one byte
+    by byte in Python costs more than the rest of the lookup put together.
+    """
+    return zlib.crc32(s) & 0xffffffff
+
+def export(sqlite_path, cdb_path):
+    """Compile the sqlite3dbm database at `sqlite_path` into a constant
+    database at `cdb_path` and return the number of records written.
+
+    The file is written next to `cdb_path` and moved into place once it is
+    complete, replacing any existing file.  Only string and BLOB values can
+    be exported, so exporting a map typed with the 'int' or 'float' codec
+    (see :func:`sqlite3dbm.dbm.open`) raises an error.  Values stored with
+    an :class:`sqlite3dbm.dbm.ArrayCodec` are exported as their packed
+    bytes.
+    """
+    smap = sqlite3dbm.dbm.open(sqlite_path)
+    cdb_path = os.path.abspath(cdb_path)
+    tmp_path = cdb_path + '.export'
+
+    # (hash, offset) pairs for each table, flattened into arrays to keep the
+    # memory overhead down for very large databases
+    tables = [_uint64_array([]) for _ in xrange(_NUM_TABLES)]
+
+    num_records = 0
+    try:
+        with __builtin__.open(tmp_path, 'wb') as f:
+            f.write('\0' * _DATA_START)
+
+            pos = _DATA_START
+            for k, v in smap.iteritems():
+                if not isinstance(v, (str, buffer)):
+                    raise error(
+                        'Cannot export the %s value of %r: only string '
+                        'values can be exported' % (type(v).__name__, k)
+                    )
+                k = _utf8(k)
+                h = cdb_hash(k)
+                tables[h % _NUM_TABLES].extend((h, pos))
+
+                f.write(_RECORD_HEADER.pack(len(k), len(v)))
+                f.write(k)
+                f.write(v)
+                pos += _RECORD_HEADER.size + len(k) + len(v)
+                num_records += 1
+            records_end = pos
+
+            pointers = []
+            for table in tables:
+                num_slots = len(table)  # Twice the number of entries
+                slots = _uint64_array([0]) * (2 * num_slots)
+                for i in xrange(0, len(table), 2):
+                    h, record_pos = table[i], table[i + 1]
+                    slot = (h / _NUM_TABLES) % num_slots
+                    while slots[2 * slot + 1]:
+                        slot = (slot + 1) % num_slots
+                    slots[2 * slot] = h
+                    slots[2 * slot + 1] = record_pos
+
+                pointers.append((pos, num_slots))
+                for i in xrange(0, len(slots), 2):
+                    f.write(_SLOT.pack(slots[i], slots[i + 1]))
+                pos += num_slots * _SLOT.size
+
+            f.seek(0)
+            f.write(_HEADER.pack(_MAGIC, num_records, records_end))
+            for table_pos, num_slots in pointers:
+                f.write(_TABLE_POINTER.pack(table_pos, num_slots))
+    except:
+        os.remove(tmp_path)
+        raise
+
+    os.rename(tmp_path, cdb_path)
+    return num_records
+
+
+class CdbMap(object):
+    """Read-only dictionary interface over a constant database written by
+    :func:`export`.
+
+    Supports the same read methods as :class:`sqlite3dbm.dbm.SqliteMap`.  If
+    `zero_copy` is True, values are returned as read-only `buffer` slices of
+    the memory map instead of strings, so nothing is copied until the caller
+    needs it.  The buffers are only valid until the map is closed.
+    """
+
+    def __init__(self, path, zero_copy=False):
+        self.path = os.path.abspath(path)
+        self.zero_copy = zero_copy
+
+        with __builtin__.open(self.path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.num_records, self.records_end = _HEADER.unpack_from(
+            self.mmap, 0
+        )
+        if magic != _MAGIC:
+            raise error('%s is not a sqlite3dbm constant database' % (path,))
+
+        self.tables = [
+            _TABLE_POINTER.unpack_from(
+                self.mmap, _HEADER.size + i * _TABLE_POINTER.size
+            )
+            for i in xrange(_NUM_TABLES)
+        ]
+
+    def close(self):
+        """Unmap the file."""
+        self.mmap.close()
+
+    def _value(self, pos, size):
+        if self.zero_copy:
+            return buffer(self.mmap, pos, size)
+        return self.mmap[pos:pos + size]
+
+    def _find(self, k):
+        """Return the (offset, length) of the value for `k`, or None."""
+        k = _utf8(k)
+        h = cdb_hash(k)
+        table_pos, num_slots = self.tables[h % _NUM_TABLES]
+        if not num_slots:
+            return None
+
+        slot = (h / _NUM_TABLES) % num_slots
+        for _ in xrange(num_slots):
+            slot_h, record_pos = _SLOT.unpack_from(
+                self.mmap, table_pos + slot * _SLOT.size
+            )
+            if not record_pos:
+                return None
+            if slot_h == h:
+                klen, vlen = _RECORD_HEADER.unpack_from(self.mmap, record_pos)
+                key_pos = record_pos + _RECORD_HEADER.size
+                if klen == len(k) and self.mmap[key_pos:key_pos + klen] == k:
+                    return key_pos + klen, vlen
+            slot = (slot + 1) % num_slots
+        return None
+
+    def __getitem__(self, k):
+        """x.__getitem__(k) <==> x[k]
+
+        Like SqliteMap, this also works on lists of keys.
+        """
+        if hasattr(k, '__iter__'):
+            return self.select(k)
+
+        found = self._find(k)
+        if found is None:
+            raise KeyError(k)
+        return self._value(*found)
+
+    def __contains__(self, k):
+        """D.__contains__(k) -> True if D has a key k, else False"""
+        return self._find(k) is not None
+
+    def has_key(self, k):
+        """D.has_key(k) -> True if D has a key k, else False."""
+        return k in self
+
+    def get(self, k, d=None):
+        """D.get(k[,d]) -> D[k] if k in D, else d. d defaults to None."""
+        found = self._find(k)
+        if found is None:
+            return d
+        return self._value(*found)
+
+    def get_many(self, *args, **kwargs):
+        """Same as :meth:`sqlite3dbm.dbm.SqliteMap.get_many`."""
+        default = kwargs.pop('default', None)
+        if kwargs:
+            raise TypeError(
+                'Got an unexpected keyword argument: %r' % (kwargs,)
+            )
+
+        result = []
+        for arg in args:
+            if hasattr(arg, '__iter__'):
+                result.extend(self.get(k, default) for k in arg)
+            else:
+                result.append(self.get(arg, default))
+        return result
+
+    def select(self, *args):
+        """Same as :meth:`sqlite3dbm.dbm.SqliteMap.select`.
+
+        Raises KeyError if any of the keys are missing.
+        """
+        vals = self.get_many(default=__MISSING_SENTINEL__, *args)
+        if __MISSING_SENTINEL__ in vals:
+            raise KeyError('One of the requested keys is missing!')
+        return vals
+
+    def __len__(self):
+        """x.__len__() <==> len(x)"""
+        return self.num_records
+
+    ## Iteration
+    def iteritems(self):
+        """D.iteritems() -> an iterator over the (key, value) items of D"""
+        pos = _DATA_START
+        while pos < self.records_end:
+            klen, vlen = _RECORD_HEADER.unpack_from(self.mmap, pos)
+            key_pos = pos + _RECORD_HEADER.size
+            yield (
+                self.mmap[key_pos:key_pos + klen],
+                self._value(key_pos + klen, vlen),
+            )
+            pos = key_pos + klen + vlen
+
+    def items(self):
+        """D.items() -> list of D's (key, value) pairs, as 2-tuples"""
+        return list(self.iteritems())
+    def iterkeys(self):
+        """D.iterkeys() -> an iterator over the keys of D"""
+        return (k for k, _ in self.iteritems())
+    def keys(self):
+        """D.keys() -> list of D's keys"""
+        return list(self.iterkeys())
+    def itervalues(self):
+        """D.itervalues() -> an iterator over the values of D"""
+        return (v for _, v in self.iteritems())
+    def values(self):
+        """D.values() -> list of D's values"""
+        return list(self.itervalues())
+    def __iter__(self):
+        """Iterate over the keys of D.  Consistent with dict."""
+        return self.iterkeys()
+
+
+def open(filename, zero_copy=False):
+    """Open a constant database written by :func:`export` and return a
+    CdbMap object.
+    """
+    return CdbMap(filename, zero_copy=zero_copy)
@@ -0,0 +1,409 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Command-line tool for loading, dumping and inspecting sqlite3dbm files.
+
+Everything streams in batches, so memory use does not grow with the size of
+the data.  Run as ``python -m sqlite3dbm``:
+
+    python -m sqlite3dbm import mydb.sqlite3 data.tsv
+    zcat data.jsonl.gz | python -m sqlite3dbm import -f jsonl mydb.sqlite3
+    python -m sqlite3dbm export --sorted --prefix user: mydb.sqlite3
+    python -m sqlite3dbm stats mydb.sqlite3
+    python -m sqlite3dbm compact mydb.sqlite3
+    python -m sqlite3dbm convert old.gdbm mydb.sqlite3
+
+Formats:
+    tsv: One key<TAB>value per line, with both escaped like Python string
+        literals (so tabs, newlines and binary data survive) [default]
+    jsonl: One {"key": ..., "value": ...} object per line.  Keys and values
+        must be valid utf-8; exporting any others is an error.
+    pickle: A stream of pickled (key, value) tuples
+
+Only string values can be exported, so exporting a map typed with the 'int'
+or 'float' codec is an error.
+"""
+
+from __future__ import with_statement
+
+import anydbm
+import argparse
+import json
+import os
+import sys
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import sqlite3dbm.dbm
+
+__all__ = [
+    'main',
+]
+
+# Sorted exports walk the primary key index, with a key range for prefixes
+_GET_SORTED_QUERY = (
+    'SELECT kv_table.key, kv_table.val FROM kv_table%s ORDER BY kv_table.key'
+)
+_KEY_FROM = 'kv_table.key >= ?'
+_KEY_BEFORE = 'kv_table.key < ?'
+_SIZES_QUERY = (
+    'SELECT length(CAST(kv_table.key AS BLOB)), '
+    'length(CAST(kv_table.val AS BLOB)) FROM kv_table'
+)
+
+DEFAULT_BATCH_SIZE = 10000
+
+# Rows between progress updates
+_PROGRESS_INTERVAL = 10000
+
+class Progress(object):
+    """Row counter printed on one line of `out`, unless `quiet`."""
+
+    def __init__(self, out, verb, quiet=False):
+        self.out = out
+        self.verb = verb
+        self.quiet = quiet
+        self.count = 0
+
+    def add(self, n=1):
+        before = self.count
+        self.count += n
+        if (not self.quiet and
+            before / _PROGRESS_INTERVAL != self.count / _PROGRESS_INTERVAL):
+            self.out.write('\r%s %d rows' % (self.verb, self.count))
+            self.out.flush()
+
+    def done(self):
+        if not self.quiet:
+            self.out.write('\r%s %d rows\n' % (self.verb, self.count))
+            self.out.flush()
+
+## Formats.  Readers yield (key, value) pairs from a file object and writers
+## write one pair to a file object.
+
+def read_tsv(f):
+    for line in f:
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        k, _, v = line.partition('\t')
+        yield k.decode('string_escape'), v.decode('string_escape')
+
+def write_tsv(f, k, v):
+    f.write('%s\t%s\n' % (
+        k.encode('string_escape'), v.encode('string_escape')
+    ))
+
+def read_jsonl(f):
+    for line in f:
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        yield row['key'].encode('utf-8'), row['value'].encode('utf-8')
+
+def write_jsonl(f, k, v):
+    try:
+        row = {'key': k.decode('utf-8'), 'value': v.decode('utf-8')}
+    except UnicodeDecodeError:
+        raise sqlite3dbm.dbm.error(
+            'Cannot export the row with key %r as jsonl: it is not valid '
+            'utf-8 (use the tsv or pickle format)' % (k,)
+        )
+    f.write(json.dumps(row, sort_keys=True) + '\n')
+
+def read_pickle(f):
+    unpickler = pickle.Unpickler(f)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
+
+def write_pickle(f, k, v):
+    pickle.dump((k, v), f, pickle.HIGHEST_PROTOCOL)
+
+FORMATS = {
+    'tsv': (read_tsv, write_tsv),
+    'jsonl': (read_jsonl, write_jsonl),
+    'pickle': (read_pickle, write_pickle),
+}
+
+def _batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _load(smap, rows, batch_size, progress):
+    """Write `rows` to `smap` one transaction per batch."""
+    for batch in _batches(rows, batch_size):
+        smap.update(batch)
+        progress.add(len(batch))
+    progress.done()
+
+## Commands
+
+def cmd_import(args, stdin, stdout, stderr):
+    smap = sqlite3dbm.dbm.open(args.db, flag='c')
+    read = FORMATS[args.format][0]
+    progress = Progress(stderr, 'Imported', args.quiet)
+
+    for path in args.files or ['-']:
+        if path == '-':
+            _load(smap, read(stdin), args.batch_size, progress)
+        else:
+            with open(path, 'rb') as f:
+                _load(smap, read(f), args.batch_size, progress)
+
+def _sorted_rows(smap, prefix):
+    """Iterate over the rows of `smap` in key order, limited to keys
+    starting with `prefix` if it is not None.
+    """
+    conditions = []
+    params = []
+    if prefix:
+        conditions.append(_KEY_FROM)
+        params.append(prefix)
+        end = sqlite3dbm.dbm._prefix_end(prefix)
+        if end is not None:
+            conditions.append(_KEY_BEFORE)
+            params.append(end)
+    if smap.has_expiry:
+        conditions.append(sqlite3dbm.dbm._NOT_EXPIRED)
+
+    where = ''
+    if conditions:
+        where = ' WHERE ' + ' AND '.join(conditions)
+    return smap.conn.execute(_GET_SORTED_QUERY % (where,), params)
+
+def _string_rows(rows):
+    """Pass through (key, value) pairs, raising error for values that are
+    not strings, such as those of maps typed with the 'int' or 'float'
+    codec, since none of the formats can read them back.
+    """
+    for k, v in rows:
+        if isinstance(v, buffer):
+            v = str(v)
+        elif not isinstance(v, str):
+            raise sqlite3dbm.dbm.error(
+                'Cannot export the %s value of %r: only string values can '
+                'be exported' % (type(v).__name__, k)
+            )
+        yield k, v
+
+def cmd_export(args, stdin, stdout, stderr):
+    smap = sqlite3dbm.dbm.open(args.db)
+    write = FORMATS[args.format][1]
+    progress = Progress(stderr, 'Exported', args.quiet)
+
+    if args.sorted or args.prefix is not None:
+        rows = _sorted_rows(smap, args.prefix)
+    else:
+        rows = smap.iteritems()
+
+    if args.output is None or args.output == '-':
+        out = stdout
+    else:
+        out = open(args.output, 'wb')
+    try:
+        for k, v in _string_rows(rows):
+            write(out, k, v)
+            progress.add()
+    finally:
+        if out is not stdout:
+            out.close()
+    progress.done()
+
+class SizeStats(object):
+    """Running min/max/total of sizes, with a histogram of power of two
+    buckets (mapping each bucket's upper bound to a count).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.histogram = {}
+
+    def add(self, size):
+        size = size or 0
+        self.count += 1
+        self.total += size
+        self.min = size if self.min is None else min(self.min, size)
+        self.max = size if self.max is None else max(self.max, size)
+        bucket = 1 << size.bit_length()
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': float(self.total) / self.count if self.count else None,
+            'histogram': self.histogram,
+        }
+
+def db_stats(path):
+    """Return a dict of statistics about the database at `path`."""
+    smap = sqlite3dbm.dbm.open(path)
+    conn = smap.conn
+
+    key_sizes = SizeStats()
+    val_sizes = SizeStats()
+    for key_size, val_size in conn.execute(_SIZES_QUERY):
+        key_sizes.add(key_size)
+        val_sizes.add(val_size)
+
+    page_size, = conn.execute(sqlite3dbm.dbm._PAGE_SIZE_QUERY).fetchone()
+    page_count, = conn.execute(sqlite3dbm.dbm._PAGE_COUNT_QUERY).fetchone()
+    freelist_count, = conn.execute(
+        sqlite3dbm.dbm._FREELIST_COUNT_QUERY
+    ).fetchone()
+    return {
+        'rows': key_sizes.count,
+        'file_size': os.path.getsize(smap.path),
+        'page_size': page_size,
+        'page_count': page_count,
+        'freelist_count': freelist_count,
+        'key_size': key_sizes.to_dict(),
+        'value_size': val_sizes.to_dict(),
+    }
+
+def cmd_stats(args, stdin, stdout, stderr):
+    stats = db_stats(args.db)
+    if args.json:
+        json.dump(stats, stdout, indent=2, sort_keys=True)
+        stdout.write('\n')
+        return
+
+    for name in ('rows', 'file_size', 'page_size', 'page_count',
+                 'freelist_count'):
+        stdout.write('%-16s %d\n' % (name, stats[name]))
+    for name in ('key_size', 'value_size'):
+        size_stats = stats[name]
+        stdout.write(
+            '%-16s min %s mean %s max %s total %d\n' % (
+                name, size_stats['min'], size_stats['mean'],
+                size_stats['max'], size_stats['total'],
+            )
+        )
+        for bucket, count in sorted(size_stats['histogram'].iteritems()):
+            stdout.write('  < %-12d %d\n' % (bucket, count))
+
+def cmd_compact(args, stdin, stdout, stderr):
+    smap = sqlite3dbm.dbm.open(args.db, flag='w')
+    before = os.path.getsize(smap.path)
+    smap.conn.execute(sqlite3dbm.dbm._VACUUM_QUERY)
+    after = os.path.getsize(smap.path)
+    stdout.write('%d -> %d bytes\n' % (before, after))
+
+def _dbm_keys(db):
+    """Iterate over the keys of an anydbm database, without listing them
+    all at once where the backend allows it.
+    """
+    if hasattr(db, 'firstkey'):
+        k = db.firstkey()
+        while k is not None:
+            yield k
+            k = db.nextkey(k)
+    else:
+        for k in db.keys():
+            yield k
+
+def cmd_convert(args, stdin, stdout, stderr):
+    src = anydbm.open(args.src, 'r')
+    smap = sqlite3dbm.dbm.open(args.db, flag='c')
+    progress = Progress(stderr, 'Converted', args.quiet)
+    _load(
+        smap, ((k, src[k]) for k in _dbm_keys(src)), args.batch_size, progress
+    )
+    src.close()
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m sqlite3dbm',
+        description='Load, dump and inspect sqlite3dbm files.',
+    )
+    subparsers = parser.add_subparsers()
+
+    def add_common(subparser, batch=False):
+        subparser.add_argument(
+            '-q', '--quiet', action='store_true', help="don't show progress"
+        )
+        if batch:
+            subparser.add_argument(
+                '-b', '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                help='rows written per transaction (default: %(default)s)',
+            )
+
+    p = subparsers.add_parser('import', help='load rows into a database')
+    p.add_argument('db')
+    p.add_argument(
+        'files', nargs='*', help='files to read (default: stdin, or -)'
+    )
+    p.add_argument('-f', '--format', choices=sorted(FORMATS), default='tsv')
+    add_common(p, batch=True)
+    p.set_defaults(func=cmd_import)
+
+    p = subparsers.add_parser('export', help='dump the rows of a database')
+    p.add_argument('db')
+    p.add_argument('-o', '--output', help='file to write (default: stdout)')
+    p.add_argument('-f', '--format', choices=sorted(FORMATS), default='tsv')
+    p.add_argument(
+        '--sorted', action='store_true', help='write the rows in key order'
+    )
+    p.add_argument(
+        '--prefix', help='only write keys with this prefix, in key order'
+    )
+    add_common(p)
+    p.set_defaults(func=cmd_export)
+
+    p = subparsers.add_parser('stats', help='show the size of a database')
+    p.add_argument('db')
+    p.add_argument('--json', action='store_true', help='output JSON')
+    p.set_defaults(func=cmd_stats)
+
+    p = subparsers.add_parser('compact', help='vacuum a database')
+    p.add_argument('db')
+    p.set_defaults(func=cmd_compact)
+
+    p = subparsers.add_parser(
+        'convert', help='copy an anydbm database (dbm, gdbm, ...) into one'
+    )
+    p.add_argument('src')
+    p.add_argument('db')
+    add_common(p, batch=True)
+    p.set_defaults(func=cmd_convert)
+
+    return parser
+
+def main(argv=None, stdin=None, stdout=None, stderr=None):
+    """Run the command line tool and return the exit status."""
+    args = make_parser().parse_args(argv)
+    stdin = stdin or sys.stdin
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    try:
+        args.func(args, stdin, stdout, stderr)
+    except sqlite3dbm.dbm.error, e:
+        stderr.write('error: %s\n' % (e,))
+        return 1
+    return 0
@@ -96,12 +96,24 @@ Caught a module-specific error
 
 from __future__ import with_statement
 
+import contextlib
+import itertools
 import os
+import re
 import sqlite3
+import threading
+import time
+from array import array
 
 __all__ = [
     'open',
     'error',
+    'build',
+    'merge',
+    'restore',
+    'diff',
+    'Database',
+    'SqliteMapTimeout',
 ]
 
 # Maximum number of bindable parameters in a SQLite query
@@ -115,6 +127,14 @@ __POP_SENTINEL__ = ('__pop__',)
 # values in `select`
 __MISSING_SENTINEL__ = ('__missing__',)
 
+# Unique sentinel to tell when `set` should fall back to the default TTL,
+# since None already means "never expires"
+__TTL_SENTINEL__ = ('__ttl__',)
+
+# Unique sentinel to tell when an operation should fall back to the map's
+# timeout, since None already means "no timeout"
+__TIMEOUT_SENTINEL__ = ('__timeout__',)
+
 def _utf8(s):
     """Guarantee that the return value is a utf-8 encoded string."""
     if isinstance(s, unicode):
@@ -137,20 +157,21 @@ _GET_MANY_QUERY_TEMPLATE = (
     'SELECT kv_table.key, kv_table.val FROM kv_table '
     'WHERE kv_table.key IN (%s)'
 )
-def get_many_query(num_keys):
+def get_many_query(num_keys, template=_GET_MANY_QUERY_TEMPLATE):
     # Cache the super-big query, as it may happen many times
     # through big select/get_many calls
     if (num_keys == SQLITE_MAX_QUERY_VARS and
-        hasattr(get_many_query, '_big_query_cache')):
-        return get_many_query._big_query_cache
+        template in get_many_query._big_query_cache):
+        return get_many_query._big_query_cache[template]
 
     interpolation_params = ','.join('?' * num_keys)
-    tmpl = _GET_MANY_QUERY_TEMPLATE % interpolation_params
+    tmpl = template % interpolation_params
 
     if num_keys == SQLITE_MAX_QUERY_VARS:
-        get_many_query._big_query_cache = tmpl
+        get_many_query._big_query_cache[template] = tmpl
 
     return tmpl
+get_many_query._big_query_cache = {}
 
 # Do INSERT OR REPLACE instead of a vanilla INSERT
 # to mimic normal dict overwrite-on-insert behavior
@@ -159,8 +180,177 @@ _SET_QUERY = 'INSERT OR REPLACE INTO kv_table (key, val) VALUES (?, ?)'
 _DEL_QUERY = 'DELETE FROM kv_table WHERE kv_table.key = ?'
 _CLEAR_QUERY = 'DELETE FROM kv_table; VACUUM;'
 
+# Set-based deletes.  Prefixes and ranges become key ranges so that they can
+# use the primary key index.
+_DEL_MANY_QUERY_TEMPLATE = 'DELETE FROM kv_table WHERE kv_table.key IN (%s)'
+_DEL_FROM_QUERY = 'DELETE FROM kv_table WHERE kv_table.key >= ?'
+_DEL_BEFORE_QUERY = 'DELETE FROM kv_table WHERE kv_table.key < ?'
+_DEL_RANGE_QUERY = (
+    'DELETE FROM kv_table WHERE kv_table.key >= ? AND kv_table.key < ?'
+)
+_DEL_ALL_QUERY = 'DELETE FROM kv_table'
+
 _COUNT_QUERY = 'SELECT COUNT(*) FROM kv_table'
 
+## Expiring keys.  Tables have an `expires` column (seconds since the
+## epoch, NULL for never), which writable maps add to older files when they
+## connect, and the read queries below skip rows whose time has passed.  Only
+## keys with a TTL are indexed.  The current time is computed by SQLite so
+## that these queries take the same parameters as the plain ones.
+_TABLE_INFO_QUERY = 'PRAGMA %(schema)s.table_info(kv_table)'
+_ADD_EXPIRY_COLUMN_QUERY = (
+    'ALTER TABLE %(schema)s.kv_table ADD COLUMN expires REAL'
+)
+_CREATE_EXPIRY_INDEX_QUERY = (
+    'CREATE INDEX IF NOT EXISTS %(schema)s.kv_table_expires '
+    'ON kv_table (expires) WHERE expires IS NOT NULL'
+)
+
+_NOT_EXPIRED = (
+    "(kv_table.expires IS NULL OR "
+    "kv_table.expires > (julianday('now') - 2440587.5) * 86400.0)"
+)
+_GET_TTL_QUERY = _GET_QUERY + ' AND ' + _NOT_EXPIRED
+_GET_ALL_TTL_QUERY = _GET_ALL_QUERY + ' WHERE ' + _NOT_EXPIRED
+_GET_ONE_TTL_QUERY = (
+    'SELECT kv_table.key, kv_table.val FROM kv_table '
+    'WHERE ' + _NOT_EXPIRED + ' LIMIT 1 OFFSET 0'
+)
+_GET_MANY_TTL_QUERY_TEMPLATE = (
+    _GET_MANY_QUERY_TEMPLATE + ' AND ' + _NOT_EXPIRED
+)
+_COUNT_TTL_QUERY = _COUNT_QUERY + ' WHERE ' + _NOT_EXPIRED
+# Expired keys passed to delete_many are dropped first, so that only live
+# keys count as deleted
+_DEL_MANY_EXPIRED_QUERY_TEMPLATE = (
+    _DEL_MANY_QUERY_TEMPLATE + ' AND NOT ' + _NOT_EXPIRED
+)
+
+_SET_TTL_QUERY = (
+    'INSERT OR REPLACE INTO kv_table (key, val, expires) VALUES (?, ?, ?)'
+)
+
+# Evict in small batches, oldest first, so that no single delete holds the
+# write lock for long
+_EVICT_QUERY = (
+    'DELETE FROM kv_table WHERE kv_table.key IN ('
+    'SELECT kv_table.key FROM kv_table WHERE kv_table.expires <= ? '
+    'ORDER BY kv_table.expires LIMIT ?)'
+)
+_EVICT_BATCH_SIZE = 1000
+
+## Atomic read-modify-write operations, done as single UPSERT statements.
+## The values are TEXT, so SQLite converts them to numbers for `+` and the
+## result back to TEXT when storing it.  The TTL variants treat an expired
+## row as missing, and keep the expiry time of a live one.
+_INCR_QUERY = (
+    'INSERT INTO kv_table (key, val) VALUES (?, ?) '
+    'ON CONFLICT (key) DO UPDATE SET val = kv_table.val + ?'
+)
+_INCR_TTL_QUERY = (
+    'INSERT INTO kv_table (key, val, expires) VALUES (?, ?, ?) '
+    'ON CONFLICT (key) DO UPDATE SET '
+    'val = CASE WHEN ' + _NOT_EXPIRED + ' '
+    'THEN kv_table.val + ? ELSE excluded.val END, '
+    'expires = CASE WHEN ' + _NOT_EXPIRED + ' '
+    'THEN kv_table.expires ELSE excluded.expires END'
+)
+_APPEND_QUERY = (
+    'INSERT INTO kv_table (key, val) VALUES (?, ?) '
+    'ON CONFLICT (key) DO UPDATE SET val = kv_table.val || ?'
+)
+_APPEND_TTL_QUERY = (
+    'INSERT INTO kv_table (key, val, expires) VALUES (?, ?, ?) '
+    'ON CONFLICT (key) DO UPDATE SET '
+    'val = CASE WHEN ' + _NOT_EXPIRED + ' '
+    'THEN kv_table.val || ? ELSE excluded.val END, '
+    'expires = CASE WHEN ' + _NOT_EXPIRED + ' '
+    'THEN kv_table.expires ELSE excluded.expires END'
+)
+
+## Change log.  Once enabled, triggers on kv_table record every write (from
+## any connection) as a (seq, key, op) row.  In compact mode each write first
+## drops the earlier entries for its key, so only the latest op is kept.
+## Values are not logged; readers of the log join against kv_table instead.
+_CREATE_CHANGES_TABLE = (
+    'CREATE TABLE IF NOT EXISTS kv_changes ('
+    'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+    'key TEXT NOT NULL, '
+    'op TEXT NOT NULL)'
+)
+_CREATE_CHANGES_KEY_INDEX = (
+    'CREATE INDEX IF NOT EXISTS kv_changes_key ON kv_changes (key)'
+)
+_CHANGE_TRIGGER_TEMPLATE = (
+    'CREATE TRIGGER IF NOT EXISTS kv_changes_%(name)s '
+    'AFTER %(event)s ON kv_table BEGIN '
+    '%(compact)s'
+    "INSERT INTO kv_changes (key, op) VALUES (%(row)s.key, '%(op)s'); "
+    'END'
+)
+_COMPACT_CHANGE_STATEMENT = (
+    'DELETE FROM kv_changes WHERE kv_changes.key = %(row)s.key; '
+)
+# The update trigger only watches `val`, so that bookkeeping updates (like
+# access tracking) are not logged
+_CHANGE_TRIGGERS = [
+    {'name': 'insert', 'event': 'INSERT', 'row': 'NEW', 'op': 'set'},
+    {'name': 'update', 'event': 'UPDATE OF val', 'row': 'NEW', 'op': 'set'},
+    {'name': 'delete', 'event': 'DELETE', 'row': 'OLD', 'op': 'del'},
+]
+_DROP_CHANGE_TRIGGER_QUERY = 'DROP TRIGGER IF EXISTS kv_changes_%(name)s'
+_DROP_CHANGES_TABLE = 'DROP TABLE IF EXISTS kv_changes'
+
+# Filled in with the expiry column, or NULL for tables that predate TTLs
+_CHANGES_SINCE_QUERY_TEMPLATE = (
+    'SELECT kv_changes.seq, kv_changes.key, kv_changes.op, kv_table.val, %s '
+    'FROM kv_changes LEFT JOIN kv_table ON kv_table.key = kv_changes.key '
+    'WHERE kv_changes.seq > ? ORDER BY kv_changes.seq LIMIT ?'
+)
+_CHANGE_SEQ_QUERY = 'SELECT MAX(kv_changes.seq) FROM kv_changes'
+_TRUNCATE_CHANGES_QUERY = 'DELETE FROM kv_changes WHERE kv_changes.seq <= ?'
+_COMPACT_CHANGES_QUERY = (
+    'DELETE FROM kv_changes WHERE kv_changes.seq NOT IN ('
+    'SELECT MAX(kv_changes.seq) FROM kv_changes GROUP BY kv_changes.key)'
+)
+
+# Number of log entries fetched per query by changes_since
+_CHANGES_BATCH_SIZE = 1000
+
+## Diagnostics.
+_EXPLAIN_QUERY = 'EXPLAIN QUERY PLAN %s'
+
+# Statements are grouped by their SQL, with lists of placeholders collapsed
+# so that all the get_many_query sizes count as one statement
+_PLACEHOLDER_LIST_RE = re.compile(r'\?(,\?)+')
+
+## Capacity-limited maps.  These track how recently (LRU) or how often (LFU)
+## each key is used in an indexed `access` column and evict the coldest keys
+## once the map grows past its limits.  Accesses are buffered in memory and
+## written out in batches, so reads do not each cost a write.
+_ADD_ACCESS_COLUMN_QUERY = 'ALTER TABLE kv_table ADD COLUMN access REAL'
+_CREATE_ACCESS_INDEX_QUERY = (
+    'CREATE INDEX IF NOT EXISTS kv_table_access ON kv_table (access)'
+)
+_TOUCH_LRU_QUERY = 'UPDATE kv_table SET access = ? WHERE kv_table.key = ?'
+_TOUCH_LFU_QUERY = (
+    'UPDATE kv_table SET access = COALESCE(access, 0) + ? '
+    'WHERE kv_table.key = ?'
+)
+# Keys that were never seen used (NULL) sort first, and so go first
+_EVICT_COLDEST_QUERY = (
+    'DELETE FROM kv_table WHERE kv_table.key IN ('
+    'SELECT kv_table.key FROM kv_table ORDER BY kv_table.access LIMIT ?)'
+)
+_PAGE_COUNT_QUERY = 'PRAGMA page_count'
+_FREELIST_COUNT_QUERY = 'PRAGMA freelist_count'
+_PAGE_SIZE_QUERY = 'PRAGMA page_size'
+
+# Number of distinct accessed keys buffered before they are written out
+_ACCESS_BATCH_SIZE = 1000
+# Number of single-key writes between capacity checks
+_CAPACITY_CHECK_INTERVAL = 100
+
 # Table has a String key, which puts an upper bound on the
 # size of keys that can be inserted.  The Text format of
 # the values should be fine in general, but could be optimized
@@ -172,8 +362,352 @@ _COUNT_QUERY = 'SELECT COUNT(*) FROM kv_table'
 # indexing?  Should do some performance profiling...
 _CREATE_TABLE = (
     'CREATE TABLE IF NOT EXISTS '
-    'kv_table (key TEXT PRIMARY KEY, val TEXT)'
+    'kv_table (key TEXT PRIMARY KEY, val TEXT, expires REAL)'
+)
+# Maps with a value codec leave `val` untyped, so that SQLite keeps numbers
+# as INTEGER or REAL and binary data as BLOBs instead of converting to TEXT
+_CREATE_TYPED_TABLE = (
+    'CREATE TABLE IF NOT EXISTS '
+    'kv_table (key TEXT PRIMARY KEY, val, expires REAL)'
+)
+
+# Bulk builds store the rows directly in the primary key B-tree, so inserting
+# in key order only ever appends to the last page.  The table is otherwise the
+# same as the one above, so normal opens find it and use it as is.
+_CREATE_BUILD_TABLE = (
+    'CREATE TABLE kv_table (key TEXT PRIMARY KEY, val TEXT, expires REAL) '
+    'WITHOUT ROWID'
+)
+_BUILD_INSERT_QUERY = 'INSERT INTO kv_table (key, val) VALUES (?, ?)'
+
+# Nothing needs to survive a crash halfway through a build, since the
+# half-built file is thrown away anyway
+_BUILD_PRAGMAS = (
+    'PRAGMA journal_mode = OFF;'
+    'PRAGMA synchronous = OFF;'
+    'PRAGMA locking_mode = EXCLUSIVE;'
+    'PRAGMA cache_size = -65536;'
+)
+_BUILD_FINISH_QUERY = 'ANALYZE; VACUUM;'
+
+## Merging works on attached source databases so that rows are copied
+## without ever coming back into Python
+_ATTACH_QUERY = 'ATTACH DATABASE ? AS merge_src'
+_DETACH_QUERY = 'DETACH DATABASE merge_src'
+_MERGE_LAST_QUERY = (
+    'INSERT OR REPLACE INTO main.kv_table (key, val) '
+    'SELECT key, val FROM merge_src.kv_table'
+)
+_MERGE_FIRST_QUERY = (
+    'INSERT OR IGNORE INTO main.kv_table (key, val) '
+    'SELECT key, val FROM merge_src.kv_table'
+)
+_MERGE_CONFLICTS_QUERY = (
+    'SELECT src.key, dest.val, src.val FROM merge_src.kv_table src '
+    'JOIN main.kv_table dest ON dest.key = src.key'
+)
+_MERGE_RESOLVE_QUERY = 'UPDATE main.kv_table SET val = ? WHERE key = ?'
+# Sources with the expires column bring their expiry times along, and keys
+# that have already expired are left behind
+_MERGE_SRC_NOT_EXPIRED = _NOT_EXPIRED.replace('kv_table.', 'src.')
+_MERGE_LAST_TTL_QUERY = (
+    'INSERT OR REPLACE INTO main.kv_table (key, val, expires) '
+    'SELECT key, val, expires FROM merge_src.kv_table src '
+    'WHERE ' + _MERGE_SRC_NOT_EXPIRED
+)
+_MERGE_FIRST_TTL_QUERY = (
+    'INSERT OR IGNORE INTO main.kv_table (key, val, expires) '
+    'SELECT key, val, expires FROM merge_src.kv_table src '
+    'WHERE ' + _MERGE_SRC_NOT_EXPIRED
+)
+_MERGE_CONFLICTS_TTL_QUERY = (
+    _MERGE_CONFLICTS_QUERY + ' WHERE ' + _MERGE_SRC_NOT_EXPIRED
+)
+# Expired keys in the destination do not count as conflicts
+_MERGE_DEL_EXPIRED_QUERY = (
+    "DELETE FROM main.kv_table WHERE expires <= "
+    "(julianday('now') - 2440587.5) * 86400.0"
+)
+_VACUUM_QUERY = 'VACUUM'
+
+## Diffs between two DB files.  The new DB is attached to a connection to the
+## old one and compared inside SQLite; each query walks the primary key index
+## of one side and probes the other, so both stream in key order.  The value
+## columns are replaced with NULL when only keys are wanted, and expired rows
+## on either side count as missing, as they do for reads.
+_ATTACH_DIFF_QUERY = 'ATTACH DATABASE ? AS diff_new'
+_DIFF_NEW_NOT_EXPIRED = _NOT_EXPIRED.replace('kv_table.', 'new_kv.')
+_DIFF_OLD_QUERY_TEMPLATE = (
+    'SELECT kv_table.key, %(old_val)s, new_kv.key IS NULL, %(new_val)s '
+    'FROM kv_table LEFT JOIN diff_new.kv_table AS new_kv '
+    'ON new_kv.key = kv_table.key AND %(new_live)s '
+    'WHERE %(old_live)s '
+    'AND (new_kv.key IS NULL OR new_kv.val IS NOT kv_table.val) '
+    'ORDER BY kv_table.key'
+)
+_DIFF_ADDED_QUERY_TEMPLATE = (
+    'SELECT new_kv.key, %(new_val)s FROM diff_new.kv_table AS new_kv '
+    'WHERE %(new_live)s AND NOT EXISTS ('
+    'SELECT 1 FROM kv_table WHERE kv_table.key = new_kv.key '
+    'AND %(old_live)s) '
+    'ORDER BY new_kv.key'
+)
+
+## Streaming values.  This sqlite3 module has no incremental blob I/O, so
+## reads fetch one byte range at a time with substr() and writes collect their
+## chunks in a temp table that one INSERT concatenates.  Either way a large
+## value is only ever held whole inside SQLite, not in Python.  SQLite loads
+## the whole value for every substr(), so reads fetch at least
+## _BLOB_READAHEAD bytes at a time to keep the number of queries down.
+_BLOB_LENGTH_QUERY = (
+    'SELECT length(CAST(kv_table.val AS BLOB)) FROM kv_table '
+    'WHERE kv_table.key = ?'
+)
+_BLOB_READ_QUERY = (
+    'SELECT substr(CAST(kv_table.val AS BLOB), ?, ?) FROM kv_table '
+    'WHERE kv_table.key = ?'
+)
+_CREATE_STREAM_TABLE = (
+    'CREATE TEMP TABLE IF NOT EXISTS kv_stream ('
+    'stream INTEGER NOT NULL, '
+    'seq INTEGER NOT NULL, '
+    'data, '
+    'PRIMARY KEY (stream, seq))'
+)
+_STREAM_CHUNK_QUERY = (
+    'INSERT INTO temp.kv_stream (stream, seq, data) VALUES (?, ?, ?)'
+)
+_STREAM_VALUE = (
+    "coalesce((SELECT group_concat(data, '') FROM ("
+    "SELECT kv_stream.data FROM temp.kv_stream "
+    "WHERE kv_stream.stream = ? ORDER BY kv_stream.seq)), '')"
+)
+_STREAM_SET_QUERY = (
+    'INSERT OR REPLACE INTO kv_table (key, val) '
+    'VALUES (?, ' + _STREAM_VALUE + ')'
+)
+_STREAM_SET_TTL_QUERY = (
+    'INSERT OR REPLACE INTO kv_table (key, val, expires) '
+    'VALUES (?, ' + _STREAM_VALUE + ', ?)'
+)
+_STREAM_DISCARD_QUERY = (
+    'DELETE FROM temp.kv_stream WHERE kv_stream.stream = ?'
+)
+
+# Bytes read from the source file per chunk by `put_stream`
+_STREAM_CHUNK_SIZE = 1 << 20
+
+# Smallest byte range fetched by a blob read
+_BLOB_READAHEAD = 1 << 20
+
+# Ids for the open blob writers, unique across connections
+_stream_ids = itertools.count(1)
+
+## Named tables.  A map stored in a table other than kv_table runs the same
+## queries, rewritten by _TableConnection to use its table, and its own change
+## log and shelf index tables (users -> users_changes, users_index).
+DEFAULT_TABLE = 'kv_table'
+_TABLE_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_TABLE_REF_RE = re.compile(r'\bkv_(table|changes|index)')
+
+# Queries rewritten per table are cached, up to this many per map
+_MAX_TABLE_QUERIES = 2000
+
+## Database transactions are run with explicit statements, with savepoints
+## for nested transactions.
+_BEGIN_QUERY = 'BEGIN'
+_COMMIT_QUERY = 'COMMIT'
+_ROLLBACK_QUERY = 'ROLLBACK'
+_SAVEPOINT_QUERY = 'SAVEPOINT sqlite3dbm_%d'
+_ROLLBACK_TO_QUERY = 'ROLLBACK TO sqlite3dbm_%d'
+_RELEASE_QUERY = 'RELEASE sqlite3dbm_%d'
+_LIST_TABLES_QUERY = (
+    "SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name"
+)
+
+## Timeouts.  While an operation with a deadline runs, a progress handler
+## interrupts SQLite once the deadline has passed, and the busy timeout is cut
+## down so that waiting on a lock cannot outlast it either.
+_BUSY_TIMEOUT_QUERY = 'PRAGMA busy_timeout'
+_SET_BUSY_TIMEOUT_QUERY = 'PRAGMA busy_timeout = %d'
+
+# VM instructions between deadline checks
+_DEADLINE_STEPS = 1000
+
+# Rows fetched at a time by iterations with a deadline
+_DEADLINE_FETCH_SIZE = 1000
+
+## Backups and in-memory loads copy rows between attached databases in key
+## order, a step at a time, so that no single transaction holds the lock for
+## long.  The copy queries are templated on the source and destination
+## schema names.
+# Snapshot backups copy the whole file in one read transaction
+_BACKUP_SNAPSHOT_QUERY = 'VACUUM INTO ?'
+_ATTACH_BACKUP_QUERY = 'ATTACH DATABASE ? AS backup_dest'
+_DETACH_BACKUP_QUERY = 'DETACH DATABASE backup_dest'
+_ATTACH_LOAD_QUERY = 'ATTACH DATABASE ? AS load_src'
+_DETACH_LOAD_QUERY = 'DETACH DATABASE load_src'
+_COPY_FIRST_STEP_QUERY = (
+    'INSERT INTO %(dest)s.kv_table (%(columns)s) '
+    'SELECT %(columns)s FROM %(src)s.kv_table ORDER BY key LIMIT ?'
+)
+_COPY_STEP_QUERY = (
+    'INSERT INTO %(dest)s.kv_table (%(columns)s) '
+    'SELECT %(columns)s FROM %(src)s.kv_table '
+    'WHERE key > ? ORDER BY key LIMIT ?'
 )
+_COPY_LAST_KEY_QUERY = 'SELECT MAX(key) FROM %(dest)s.kv_table'
+_COPY_COUNT_QUERY = 'SELECT COUNT(*) FROM %(src)s.kv_table'
+
+# Rows copied per step when loading a database into memory
+_LOAD_ROWS_PER_STEP = 100000
+
+_RESTORE_CLEAR_QUERY = 'DELETE FROM main.kv_table'
+# Backups of maps with expiring keys keep their expiry times
+_RESTORE_TTL_QUERY = (
+    'INSERT OR REPLACE INTO main.kv_table (key, val, expires) '
+    'SELECT key, val, expires FROM merge_src.kv_table'
+)
+
+def _kv_gen(args, kwargs):
+    """Generator that combines all the args to update() for easy iteration."""
+    for arg in args:
+        if isinstance(arg, dict):
+            for k, v in arg.iteritems():
+                yield k, v
+        else:
+            for k, v in arg:
+                yield k, v
+
+    for k, v in kwargs.iteritems():
+        yield k, v
+
+def _key_gen(args):
+    """Generator over the keys in `args`, which are keys or iterables of
+    keys, as taken by `select` and `get_many`.
+    """
+    for arg in args:
+        if hasattr(arg, '__iter__'):
+            for k in arg:
+                yield k
+        else:
+            yield arg
+
+def _prefix_end(prefix):
+    """Smallest bytestring greater than every string starting with `prefix`,
+    or None if there is no such string.
+    """
+    prefix = _utf8(prefix).rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def _deadline_checker(deadlines, diagnostics):
+    """Progress handler interrupting the running statement once the earliest
+    of `deadlines` has passed.
+
+    pysqlite only keeps a reference to progress handlers as keys of a dict,
+    so a map makes a single one and reuses it.  It must not refer to the map
+    itself, or the connection would keep the map alive.
+    """
+    progress = diagnostics and diagnostics._progress_handler
+    def check():
+        if progress is not None:
+            # Keep its step counts going
+            progress()
+        return time.time() >= min(deadlines)
+    return check
+
+def _to_number(s):
+    """Parse a number stored as TEXT by SQLite.  Numbers stored natively,
+    as INTEGER or REAL, are returned unchanged.
+    """
+    if isinstance(s, (int, long, float)):
+        return s
+    try:
+        return int(s)
+    except ValueError:
+        return float(s)
+
+def _prepare_path(path, flag, mode):
+    """Check `flag` and make `path` absolute, creating the file (with
+    `mode`) if `flag` allows it and it does not exist.
+
+    Returns the path and whether the file was created.
+    """
+    if flag not in ('c', 'n', 'w', 'r'):
+        raise error('Invalid flag "%s"' % (flag,))
+
+    # Default behavior is to create if the file does not already exist.
+    # We tweak from this default behavior to accommodate the other flag options
+
+    # Allow for :memory: sqlite3 path for testing purposes
+    if path == ':memory:':
+        return path, False
+
+    # Need an absolute path to db on the filesystem
+    path = os.path.abspath(path)
+
+    # r and w require the db to exist ahead of time
+    if os.path.exists(path):
+        return path, False
+    if flag in ('r', 'w'):
+        raise error('DB does not exist at %s' % (path,))
+
+    # Ghetto way of respecting mode, since unexposed by sqlite3.connect
+    # Manually create the file before sqlite3 connects to it
+    os.open(path, os.O_CREAT, mode)
+    return path, True
+
+def _has_column(conn, column, schema='main'):
+    """Whether `schema`.kv_table on `conn` has the column `column`."""
+    return any(
+        row[1] == column
+        for row in conn.execute(_TABLE_INFO_QUERY % {'schema': schema})
+    )
+
+def _add_expiry_column(conn, schema='main'):
+    """Add the indexed `expires` column to `schema`.kv_table on `conn`."""
+    conn.execute(_ADD_EXPIRY_COLUMN_QUERY % {'schema': schema})
+    conn.execute(_CREATE_EXPIRY_INDEX_QUERY % {'schema': schema})
+    conn.commit()
+
+def _copy_rows(conn, src, dest, rows_per_step=-1, sleep=0, progress=None,
+               expiry=False):
+    """Copy every row of `src`.kv_table into the empty `dest`.kv_table,
+    where `src` and `dest` are schema names on `conn`.  If `expiry` is True,
+    the `expires` column is copied too.
+
+    Rows are copied `rows_per_step` at a time (all at once if negative),
+    committing and pausing for `sleep` seconds after each step.  `progress`
+    is called as progress(copied, total) after each step.
+
+    Returns the number of rows copied.
+    """
+    names = {
+        'src': src,
+        'dest': dest,
+        'columns': 'key, val, expires' if expiry else 'key, val',
+    }
+    total, = conn.execute(_COPY_COUNT_QUERY % names).fetchone()
+
+    copied = 0
+    step = conn.execute(_COPY_FIRST_STEP_QUERY % names, (rows_per_step,))
+    while True:
+        conn.commit()
+        copied += step.rowcount
+        if progress is not None:
+            progress(copied, total)
+
+        if rows_per_step < 0 or step.rowcount < rows_per_step:
+            return copied
+
+        if sleep:
+            time.sleep(sleep)
+        last_key, = conn.execute(_COPY_LAST_KEY_QUERY % names).fetchone()
+        step = conn.execute(
+            _COPY_STEP_QUERY % names, (last_key, rows_per_step)
+        )
 
 class SqliteMapException(Exception):
     """Raised on module-specific errors, such as protection errors.
@@ -185,6 +719,12 @@ class SqliteMapException(Exception):
 # DBM interface
 error = SqliteMapException
 
+class SqliteMapTimeout(SqliteMapException):
+    """Raised when an operation runs past its timeout.  The operation is
+    abandoned (and its writes rolled back), and the map can still be used.
+    """
+    pass
+
 
 class SqliteMap(object):
     """Dictionary interface backed by a SQLite DB.
@@ -194,50 +734,609 @@ class SqliteMap(object):
     This is not remotely threadsafe.
     """
 
-    def __init__(self, path, flag='r', mode=0666):
+    # Schema for new tables
+    _create_table_query = _CREATE_TABLE
+
+    def __init__(self, path, flag='r', mode=0666, in_memory=False,
+                 progress=None, reload_interval=None, default_ttl=None,
+                 max_entries=None, max_bytes=None, eviction='lru',
+                 diagnostics=None, table=DEFAULT_TABLE, database=None,
+                 timeout=None):
         """Create an dict backed by a SQLite DB at `sqlite_db_path`.
 
-        See `open` for explanation of the parameters.
+        See `open` for explanation of the parameters.  `database` is the
+        :class:`Database` whose connection the map should share, if any.
         """
+        if not _TABLE_NAME_RE.match(table):
+            raise error('Invalid table name "%s"' % (table,))
+        if database is not None and (in_memory or diagnostics):
+            raise error(
+                'in_memory and diagnostics are not supported for maps in a '
+                'Database'
+            )
 
-        if flag not in ('c', 'n', 'w', 'r'):
-            raise error('Invalid flag "%s"' % (flag,))
-
-        # Default behavior is to create if the file does not already exist.
-        # We tweak from this default behavior to accommodate the other flag options
-
+        path, created = _prepare_path(path, flag, mode)
         self.readonly = flag == 'r'
 
-        # Allow for :memory: sqlite3 path for testing purposes
-        if path != ':memory:':
-            # Need an absolute path to db on the filesystem
-            path = os.path.abspath(path)
-
-            # r and w require the db to exist ahead of time
-            if not os.path.exists(path):
-                if flag in ('r', 'w'):
-                    raise error('DB does not exist at %s' % (path,))
-                else:
-                    # Ghetto way of respecting mode, since unexposed by sqlite3.connect
-                    # Manually create the file before sqlite3 connects to it
-                    os.open(path, os.O_CREAT, mode)
-
-        self.conn = sqlite3.connect(path)
-        self.conn.text_factory = str
-        self.conn.execute(_CREATE_TABLE)
+        if in_memory and (flag != 'r' or path == ':memory:'):
+            raise error('in_memory requires an existing DB and flag "r"')
+
+        self.path = path
+        self.table = table
+        self.database = database
+        self.timeout = timeout
+        self._deadlines = []
+        self.in_memory = in_memory
+        self.progress = progress
+        self.reload_interval = reload_interval
+        self.default_ttl = default_ttl
+        if diagnostics is True:
+            diagnostics = Diagnostics()
+        self.diagnostics = diagnostics or None
+        self._check_deadline = _deadline_checker(
+            self._deadlines, self.diagnostics
+        )
+
+        # Otherwise the connection is opened on first use, by __getattr__.
+        # New files get their table right away though, so that they are
+        # valid DBs even if the map is never used.
+        if in_memory:
+            self.reload()
+        elif created:
+            self.conn
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.tracks_access = max_entries is not None or max_bytes is not None
+        self._pending_access = {}
+        self._writes_since_check = 0
+        self._evicted = 0
+        self._eviction_runs = 0
+        if self.tracks_access:
+            if eviction not in ('lru', 'lfu'):
+                raise error('Invalid eviction policy "%s"' % (eviction,))
+            if self.readonly:
+                raise error('Capacity limits require a writeable DB')
+            if not _has_column(self.conn, 'access'):
+                self.conn.execute(_ADD_ACCESS_COLUMN_QUERY)
+                self.conn.execute(_CREATE_ACCESS_INDEX_QUERY)
+                self.conn.commit()
 
         # n option requires us to clear out existing data
         if flag == 'n':
             self.clear()
 
+    def __getattr__(self, name):
+        """Connect to the DB the first time `conn` or `has_expiry` is
+        needed.
+
+        Maps that are opened but never used cost no connection or CREATE
+        TABLE.  Once connected these are plain attributes, so this is not
+        called again.
+        """
+        if name not in ('conn', 'has_expiry') or 'path' not in self.__dict__:
+            raise AttributeError(name)
+
+        if self.database is None:
+            conn = self._table_conn(self._connect(self.path))
+        else:
+            conn = self._table_conn(self.database.conn)
+        self.conn = conn
+        self._prepare_table()
+        return getattr(self, name)
+
+    def _prepare_table(self):
+        """Create the map's table if needed, and work out `has_expiry`.
+
+        Writable maps add the `expires` column to older tables up front, so
+        that maps connected before anything had a TTL do not skip the expiry
+        checks later on.  A read-only map of a file from before TTLs
+        existed only looks for the column here, so it has to be reopened to
+        see keys expire once a writer has added it.
+        """
+        conn = self.conn
+        conn.execute(self._create_table_query)
+        self.has_expiry = _has_column(conn, 'expires')
+        if not self.readonly:
+            if not self.has_expiry:
+                conn.execute(_ADD_EXPIRY_COLUMN_QUERY % {'schema': 'main'})
+                self.has_expiry = True
+            conn.execute(_CREATE_EXPIRY_INDEX_QUERY % {'schema': 'main'})
+
+    def _connect(self, path):
+        """Open a connection to the SQLite DB at `path`."""
+        if self.diagnostics is None:
+            conn = sqlite3.connect(path)
+        else:
+            conn = sqlite3.connect(path, factory=_TracingConnection)
+            self.diagnostics.install(conn)
+        conn.text_factory = str
+        return conn
+
+    def _deadline_after(self, timeout):
+        """Time by which an operation allowed `timeout` seconds must finish,
+        or None for no deadline.  The map's timeout is used if `timeout` is
+        left out.
+        """
+        if timeout is __TIMEOUT_SENTINEL__:
+            timeout = self.timeout
+        if timeout is None:
+            return None
+        return time.time() + timeout
+
+    @contextlib.contextmanager
+    def _deadline(self, deadline):
+        """Context manager interrupting the SQLite statements run in its
+        block once `deadline` has passed, and raising SqliteMapTimeout.  A
+        `deadline` of None means no deadline.
+
+        Generators enter it around each fetch but never around a yield, so
+        that the statements the caller runs in between are not affected.
+
+        Deadlines are not applied inside a :meth:`Database.transaction`,
+        since SQLite rolls back the whole transaction when a statement in it
+        is interrupted.
+        """
+        if deadline is None or getattr(self.conn, 'depth', 0):
+            yield
+            return
+        remaining = max(deadline - time.time(), 0)
+
+        conn = self.conn
+        deadlines = self._deadlines
+        deadlines.append(deadline)
+        outermost = len(deadlines) == 1
+        busy_timeout = None
+        if outermost:
+            diagnostics = self.diagnostics
+            if diagnostics is not None and diagnostics.progress_steps:
+                steps = diagnostics.progress_steps
+            else:
+                steps = _DEADLINE_STEPS
+            conn.set_progress_handler(self._check_deadline, steps)
+
+            busy_timeout, = conn.execute(_BUSY_TIMEOUT_QUERY).fetchone()
+            if busy_timeout > remaining * 1000:
+                conn.execute(_SET_BUSY_TIMEOUT_QUERY % (remaining * 1000,))
+            else:
+                busy_timeout = None
+
+        try:
+            yield
+        except sqlite3.OperationalError, e:
+            if not ('interrupted' in str(e) or
+                    (busy_timeout is not None and 'locked' in str(e))):
+                raise
+            conn.rollback()
+            raise SqliteMapTimeout('Operation timed out')
+        finally:
+            deadlines.remove(deadline)
+            if outermost:
+                conn.set_progress_handler(None, 0)
+                if self.diagnostics is not None:
+                    self.diagnostics.install(conn)
+                if busy_timeout is not None:
+                    conn.execute(_SET_BUSY_TIMEOUT_QUERY % (busy_timeout,))
+
+    def _table_conn(self, conn):
+        """Wrap `conn` to use the map's table, if it is not kv_table."""
+        if self.table == DEFAULT_TABLE:
+            return conn
+        return _TableConnection(conn, self.table)
+
+    def explain(self, op=None):
+        """Return the EXPLAIN QUERY PLAN output for the query behind the
+        built-in operation `op`, as a list of strings.
+
+        `op` is one of 'get', 'get_many', 'set', 'del', 'len', 'iter',
+        'popitem' or 'delete_range' ('evict_expired' too, for maps with
+        expiring keys).  If `op` is None, a dict mapping every operation to
+        its plan is returned.
+        """
+        if self.has_expiry:
+            queries = {
+                'get': _GET_TTL_QUERY,
+                'get_many': get_many_query(2, _GET_MANY_TTL_QUERY_TEMPLATE),
+                'set': _SET_TTL_QUERY,
+                'len': _COUNT_TTL_QUERY,
+                'iter': _GET_ALL_TTL_QUERY,
+                'popitem': _GET_ONE_TTL_QUERY,
+                'evict_expired': _EVICT_QUERY,
+            }
+        else:
+            queries = {
+                'get': _GET_QUERY,
+                'get_many': get_many_query(2),
+                'set': _SET_QUERY,
+                'len': _COUNT_QUERY,
+                'iter': _GET_ALL_QUERY,
+                'popitem': _GET_ONE_QUERY,
+            }
+        queries['del'] = _DEL_QUERY
+        queries['delete_range'] = _DEL_RANGE_QUERY
+
+        if op is None:
+            return dict((op, self.explain(op)) for op in queries)
+        if op not in queries:
+            raise error('Unknown operation "%s"' % (op,))
+
+        query = queries[op]
+        return [
+            row[-1] for row in self.conn.execute(
+                _EXPLAIN_QUERY % (query,), (None,) * query.count('?')
+            )
+        ]
+
+    def reload(self):
+        """Load a fresh copy of the DB on disk into memory.
+
+        Only for maps opened with `in_memory`.  The new copy is swapped in
+        once it is fully loaded, so lookups never see a partial copy.
+        """
+        if not self.in_memory:
+            raise error('Only in-memory maps can be reloaded')
+
+        # Stat before loading, so that changes made during the load get
+        # picked up by the next check
+        st = os.stat(self.path)
+
+        conn = self._table_conn(self._connect(':memory:'))
+        conn.execute(self._create_table_query)
+        conn.execute(_ATTACH_LOAD_QUERY, (self.path,))
+        try:
+            has_expiry = _has_column(conn, 'expires', 'load_src')
+            if has_expiry:
+                conn.execute(_CREATE_EXPIRY_INDEX_QUERY % {'schema': 'main'})
+            # A map that was created but never used has no table yet
+            if _has_column(conn, 'key', 'load_src'):
+                _copy_rows(
+                    conn, 'load_src', 'main',
+                    rows_per_step=_LOAD_ROWS_PER_STEP,
+                    progress=self.progress, expiry=has_expiry,
+                )
+        finally:
+            conn.execute(_DETACH_LOAD_QUERY)
+
+        self.conn = conn
+        self.has_expiry = has_expiry
+        self._loaded_stat = (st.st_ino, st.st_size, st.st_mtime)
+        self._last_reload_check = time.time()
+
+    def _maybe_reload(self):
+        """Reload an in-memory map if `reload_interval` seconds have passed
+        since the last check and the file on disk has changed.
+        """
+        if self.reload_interval is None:
+            return
+
+        now = time.time()
+        if now - self._last_reload_check < self.reload_interval:
+            return
+        self._last_reload_check = now
+
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # The file is probably being swapped out.  Keep serving the copy
+            # we have and try again next time.
+            return
+        if (st.st_ino, st.st_size, st.st_mtime) != self._loaded_stat:
+            self.reload()
+
+    def _enable_expiry(self):
+        """Make sure the table has the `expires` column."""
+        if not self.has_expiry:
+            # Another connection may have added it since we opened
+            if not _has_column(self.conn, 'expires'):
+                _add_expiry_column(self.conn)
+            self.has_expiry = True
+
+    def _expires(self, ttl):
+        """Expiry time for a key set now with `ttl`."""
+        if ttl is None:
+            return None
+        return time.time() + ttl
+
+    def set(self, k, v, ttl=__TTL_SENTINEL__):
+        """D.set(k, v[, ttl]) -> None.  Set D[k] = v, expiring in `ttl` seconds.
+
+        `ttl` defaults to the map's `default_ttl`.  A `ttl` of None means the
+        key never expires.  Expired keys are treated as missing by every
+        read, and are deleted by :meth:`evict_expired`.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        if ttl is __TTL_SENTINEL__:
+            ttl = self.default_ttl
+
+        if self.timeout is None:
+            self._set(k, v, ttl)
+        else:
+            with self._deadline(self._deadline_after(self.timeout)):
+                self._set(k, v, ttl)
+
+        if self.tracks_access:
+            self._record_access([k])
+            self._writes_since_check += 1
+            if self._writes_since_check >= _CAPACITY_CHECK_INTERVAL:
+                self.enforce_capacity()
+
+    def _set(self, k, v, ttl):
+        if ttl is None:
+            self.conn.execute(_SET_QUERY, (k, v))
+        else:
+            self._enable_expiry()
+            self.conn.execute(_SET_TTL_QUERY, (k, v, self._expires(ttl)))
+        self.conn.commit()
+
+    def _record_access(self, keys):
+        """Note that `keys` were used, flushing the buffer if it is full."""
+        pending = self._pending_access
+        for k in keys:
+            pending[k] = pending.get(k, 0) + 1
+        if len(pending) >= _ACCESS_BATCH_SIZE:
+            self._flush_access()
+
+    def _flush_access(self):
+        """Write buffered key accesses to the `access` column."""
+        if not self._pending_access:
+            return
+
+        if self.eviction == 'lru':
+            now = time.time()
+            self.conn.executemany(
+                _TOUCH_LRU_QUERY,
+                [(now, k) for k in self._pending_access]
+            )
+        else:
+            self.conn.executemany(
+                _TOUCH_LFU_QUERY,
+                [(count, k) for k, count in self._pending_access.iteritems()]
+            )
+        self.conn.commit()
+        self._pending_access = {}
+
+    def _used_bytes(self):
+        """Approximate size of the data, from the pages in use."""
+        page_count, = self.conn.execute(_PAGE_COUNT_QUERY).fetchone()
+        freelist_count, = self.conn.execute(_FREELIST_COUNT_QUERY).fetchone()
+        page_size, = self.conn.execute(_PAGE_SIZE_QUERY).fetchone()
+        return (page_count - freelist_count) * page_size
+
+    def _evict_coldest(self, num_keys):
+        """Delete up to `num_keys` of the least used keys in one batch."""
+        count = self.conn.execute(_EVICT_COLDEST_QUERY, (num_keys,)).rowcount
+        self.conn.commit()
+        self._evicted += count
+        return count
+
+    def enforce_capacity(self):
+        """Evict keys until the map is within its `max_entries` and
+        `max_bytes` limits, and return the number of keys evicted.
+
+        Expired keys go first, then the least recently (LRU) or least
+        frequently (LFU) used keys, in batches.  This is called
+        automatically every so often by writes.
+
+        `max_bytes` is compared against the pages the database uses, so it
+        is approximate.
+        """
+        if not self.tracks_access:
+            return 0
+
+        self._flush_access()
+        self._writes_since_check = 0
+        self._eviction_runs += 1
+
+        evicted = 0
+        if self.has_expiry:
+            evicted = self.evict_expired()
+            self._evicted += evicted
+
+        if self.max_entries is not None:
+            excess = len(self) - self.max_entries
+            while excess > 0:
+                count = self._evict_coldest(min(excess, _EVICT_BATCH_SIZE))
+                if not count:
+                    break
+                excess -= count
+                evicted += count
+
+        if self.max_bytes is not None:
+            used = self._used_bytes()
+            while used > self.max_bytes:
+                # Deleting rows frees whole pages only once they empty out,
+                # so work from the average row size and stop if no space was
+                # reclaimed, rather than emptying the map
+                num_rows = max(len(self), 1)
+                avg_row = max(used / num_rows, 1)
+                count = self._evict_coldest(min(
+                    (used - self.max_bytes) / avg_row + 1, _EVICT_BATCH_SIZE
+                ))
+                evicted += count
+
+                new_used = self._used_bytes()
+                if not count or new_used >= used:
+                    break
+                used = new_used
+
+        return evicted
+
+    def cache_stats(self):
+        """Return a dict of statistics for a capacity-limited map.
+
+        `evicted` is the number of keys this map has evicted, and
+        `eviction_runs` the number of times it checked its limits.
+        """
+        return {
+            'entries': len(self),
+            'used_bytes': self._used_bytes(),
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'evicted': self._evicted,
+            'eviction_runs': self._eviction_runs,
+        }
+
     def __setitem__(self, k, v):
         """x.__setitem__(k, v) <==> x[k] = v"""
+        self.set(k, v)
+
+    def _upsert_many(self, query, ttl_query, rows):
+        """Run an UPSERT for each of the (key, value, update_param) `rows`,
+        without committing.
+
+        Picks the TTL variant of the query if the map has expiring keys, in
+        which case new keys get the default TTL.
+        """
+        if self.default_ttl is not None:
+            self._enable_expiry()
+
+        if self.has_expiry:
+            expires = self._expires(self.default_ttl)
+            self.conn.executemany(ttl_query, [
+                (k, v, expires, param) for k, v, param in rows
+            ])
+        else:
+            self.conn.executemany(query, rows)
+
+        if self.tracks_access:
+            self._record_access(k for k, _, _ in rows)
+
+    def incr(self, k, delta=1, default=0):
+        """D.incr(k[, delta[, default]]) -> D[k] + delta, atomically
+        storing the result in D[k].
+
+        A missing key is treated as having the value `default`.  The update
+        is a single statement inside SQLite, so concurrent increments from
+        other connections are never lost.  Stored values that are not
+        numbers count as 0, as in SQL.
+
+        Returns the new value as an int or float.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        self._upsert_many(
+            _INCR_QUERY, _INCR_TTL_QUERY, [(k, default + delta, delta)]
+        )
+        # Still in the same transaction, so nobody else can have changed it
+        val, = self.conn.execute(_GET_QUERY, (k,)).fetchone()
+        self.conn.commit()
+        return _to_number(val)
+
+    def incr_many(self, *args, **kwargs):
+        """Apply many increments in one transaction.
+
+        Takes the same arguments as :meth:`update`, mapping keys to deltas,
+        plus an optional `default` keyword argument as for :meth:`incr`.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        default = kwargs.pop('default', 0)
+        rows = [
+            (k, default + delta, delta)
+            for k, delta in _kv_gen(args, kwargs)
+        ]
+        self._upsert_many(_INCR_QUERY, _INCR_TTL_QUERY, rows)
+        self.conn.commit()
+
+    def append(self, k, suffix):
+        """D.append(k, suffix) -> None.  Atomically append `suffix` to D[k].
+
+        A missing key is treated as the empty string.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        self._upsert_many(
+            _APPEND_QUERY, _APPEND_TTL_QUERY, [(k, suffix, suffix)]
+        )
+        self.conn.commit()
+
+    def append_many(self, *args, **kwargs):
+        """Apply many appends in one transaction.
+
+        Takes the same arguments as :meth:`update`, mapping keys to suffixes.
+        """
         if self.readonly:
             raise error('DB is readonly')
 
-        self.conn.execute(_SET_QUERY, (k, v))
+        rows = [
+            (k, suffix, suffix)
+            for k, suffix in _kv_gen(args, kwargs)
+        ]
+        self._upsert_many(_APPEND_QUERY, _APPEND_TTL_QUERY, rows)
+        self.conn.commit()
+
+    def open_blob(self, k, mode='r'):
+        """D.open_blob(k[, mode]) -> a file-like object over D[k].
+
+        With mode 'r' the value is read a byte range at a time, so a large
+        value can be streamed in chunks or only partly read (a header, say)
+        without all of it being held in Python's memory.  SQLite still loads
+        the whole value for each range though, so every range costs time
+        proportional to the size of the value, and streaming all of a value
+        of n bytes costs O(n * n / 1MB).  Ranges of at least 1MB are fetched
+        to keep that down, whatever the size of the reads.  KeyError is
+        raised if `k` is missing.
+
+        With mode 'w' the chunks written are stored in SQLite as they come,
+        and D[k] is set to their concatenation when the object is closed.
+        Writes go to a temporary table, so nothing changes in D until then.
+
+        Both can be used as context managers.  A writer closed by an
+        exception is discarded without setting D[k].
+        """
+        return SqliteBlob(self, k, mode)
+
+    def put_stream(self, k, fileobj, size=None, chunk_size=_STREAM_CHUNK_SIZE):
+        """D.put_stream(k, fileobj[, size]) -> number of bytes stored.
+
+        Set D[k] to the contents of the file-like `fileobj`, read
+        `chunk_size` bytes at a time.  If `size` is given exactly that many
+        bytes are read, and an error is raised if the file ends first.
+        Otherwise it is read to the end.
+        """
+        with self.open_blob(k, 'w') as blob:
+            remaining = size
+            while remaining is None or remaining > 0:
+                if remaining is None:
+                    chunk = fileobj.read(chunk_size)
+                else:
+                    chunk = fileobj.read(min(chunk_size, remaining))
+                    remaining -= len(chunk)
+                if not chunk:
+                    break
+                blob.write(chunk)
+            if remaining:
+                raise error(
+                    'Expected %d bytes, the file ended after %d' % (
+                        size, size - remaining
+                    )
+                )
+            return blob.size
+
+    def _set_from_stream(self, k, stream):
+        """Set D[k] to the chunks of `stream` in the kv_stream table, and
+        drop them.
+        """
+        if self.default_ttl is None:
+            self.conn.execute(_STREAM_SET_QUERY, (k, stream))
+        else:
+            self._enable_expiry()
+            self.conn.execute(
+                _STREAM_SET_TTL_QUERY,
+                (k, stream, self._expires(self.default_ttl))
+            )
+        self.conn.execute(_STREAM_DISCARD_QUERY, (stream,))
         self.conn.commit()
 
+        if self.tracks_access:
+            self._record_access([k])
+
     def __getitem__(self, k):
         """x.__getitem__(k) <==> x[k]
 
@@ -251,9 +1350,17 @@ class SqliteMap(object):
         if hasattr(k, '__iter__'):
             return self.select(k)
 
-        row = self.conn.execute(_GET_QUERY, (k,)).fetchone()
+        self._maybe_reload()
+        query = _GET_TTL_QUERY if self.has_expiry else _GET_QUERY
+        if self.timeout is None:
+            row = self.conn.execute(query, (k,)).fetchone()
+        else:
+            with self._deadline(self._deadline_after(self.timeout)):
+                row = self.conn.execute(query, (k,)).fetchone()
         if row is None:
             raise KeyError(k)
+        if self.tracks_access:
+            self._record_access([k])
         return row[0]
 
     def __delitem__(self, k):
@@ -268,8 +1375,76 @@ class SqliteMap(object):
         # thrown when it should. I think this is dumb :-P
         self[k]
 
-        self.conn.execute(_DEL_QUERY, (k,))
-        self.conn.commit()
+        with self._deadline(self._deadline_after(self.timeout)):
+            self.conn.execute(_DEL_QUERY, (k,))
+            self.conn.commit()
+
+    def delete_many(self, keys, missing_ok=True,
+                    timeout=__TIMEOUT_SENTINEL__):
+        """Delete all of `keys` in one transaction and return the number of
+        keys deleted.
+
+        If `missing_ok` is False, KeyError is raised (and nothing is deleted)
+        if any of the keys are missing.  Expired keys count as missing, and
+        are not counted as deleted.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        keys = list(keys)
+        deleted = 0
+        with self._deadline(self._deadline_after(timeout)):
+            try:
+                for i in xrange(0, len(keys), SQLITE_MAX_QUERY_VARS):
+                    chunk = keys[i:i + SQLITE_MAX_QUERY_VARS]
+                    if self.has_expiry:
+                        self.conn.execute(
+                            get_many_query(
+                                len(chunk), _DEL_MANY_EXPIRED_QUERY_TEMPLATE
+                            ),
+                            chunk
+                        )
+                    deleted += self.conn.execute(
+                        get_many_query(len(chunk), _DEL_MANY_QUERY_TEMPLATE),
+                        chunk
+                    ).rowcount
+                if not missing_ok and deleted < len(set(map(_utf8, keys))):
+                    raise KeyError('One of the keys to delete is missing!')
+            except:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+        return deleted
+
+    def delete_range(self, start=None, stop=None,
+                     timeout=__TIMEOUT_SENTINEL__):
+        """Delete every key k with start <= k < stop and return the number of
+        keys deleted.  Either bound may be None, for no bound.
+
+        Keys are compared as utf-8 bytestrings.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        with self._deadline(self._deadline_after(timeout)):
+            if start is None and stop is None:
+                cursor = self.conn.execute(_DEL_ALL_QUERY)
+            elif stop is None:
+                cursor = self.conn.execute(_DEL_FROM_QUERY, (start,))
+            elif start is None:
+                cursor = self.conn.execute(_DEL_BEFORE_QUERY, (stop,))
+            else:
+                cursor = self.conn.execute(_DEL_RANGE_QUERY, (start, stop))
+            self.conn.commit()
+        return cursor.rowcount
+
+    def delete_prefix(self, prefix, timeout=__TIMEOUT_SENTINEL__):
+        """Delete every key starting with `prefix` and return the number of
+        keys deleted.
+        """
+        return self.delete_range(
+            prefix or None, _prefix_end(prefix), timeout=timeout
+        )
 
     def __contains__(self, k):
         """D.__contains__(k) -> True if D has a key k, else False"""
@@ -285,7 +1460,11 @@ class SqliteMap(object):
         if self.readonly:
             raise error('DB is readonly')
 
-        self.conn.executescript(_CLEAR_QUERY)
+        if getattr(self.conn, 'depth', 0):
+            # Inside a Database transaction, where VACUUM is not allowed
+            self.conn.execute(_DEL_ALL_QUERY)
+        else:
+            self.conn.executescript(_CLEAR_QUERY)
         self.conn.commit()
 
     def get(self, k, d=None):
@@ -323,7 +1502,8 @@ class SqliteMap(object):
         if self.readonly:
             raise error('DB is readonly')
 
-        rows = [row for row in self.conn.execute(_GET_ONE_QUERY)]
+        query = _GET_ONE_TTL_QUERY if self.has_expiry else _GET_ONE_QUERY
+        rows = [row for row in self.conn.execute(query)]
         if len(rows) != 1:
             raise KeyError(
                 'Found %d rows when there should have been 1' % (len(rows),)
@@ -344,6 +1524,39 @@ class SqliteMap(object):
             self[k] = d
             return d
 
+    def _lookup_chunks(self, keys, deadline=None):
+        """Look up the iterable `keys` SQLITE_MAX_QUERY_VARS at a time.
+
+        Yields each chunk of keys along with a dict mapping the keys that
+        were found (as utf-8 bytestrings, which is what sqlite3 gives us back
+        from the cursor) to their values.  Each lookup must finish by
+        `deadline`, if given.
+        """
+        self._maybe_reload()
+        template = (
+            _GET_MANY_TTL_QUERY_TEMPLATE if self.has_expiry
+            else _GET_MANY_QUERY_TEMPLATE
+        )
+
+        def lookup(chunk):
+            # Need a dict because the select does not have a return order
+            with self._deadline(deadline):
+                key_to_val = dict(self.conn.execute(
+                    get_many_query(len(chunk), template), chunk
+                ))
+            if self.tracks_access:
+                self._record_access(key_to_val)
+            return chunk, key_to_val
+
+        chunk = []
+        for k in keys:
+            chunk.append(k)
+            if len(chunk) == SQLITE_MAX_QUERY_VARS:
+                yield lookup(chunk)
+                chunk = []
+        if chunk:
+            yield lookup(chunk)
+
     def get_many(self, *args, **kwargs):
         """Basically :meth:`~sqlite3dbm.dbm.SqliteMap.get`
         and :meth:`~sqlite3dbm.dbm.SqliteMap.select` combined.
@@ -353,47 +1566,50 @@ class SqliteMap(object):
         specifies what value should be used for keys that are not present in
         the dict.
         """
+        return list(self.get_many_iter(*args, **kwargs))
+
+    def get_many_iter(self, *args, **kwargs):
+        """Iterator version of :meth:`get_many`.
+
+        Keys are read from `args` and looked up SQLITE_MAX_QUERY_VARS at a
+        time as the values are consumed, so even huge iterables of keys are
+        handled in constant memory.
+        """
         default = kwargs.pop('default', None)
+        timeout = kwargs.pop('timeout', __TIMEOUT_SENTINEL__)
         if kwargs:
             raise TypeError(
                 'Got an unexpected keyword argument: %r' % (kwargs,)
             )
 
-        def k_gen():
-            """Generator to make iterating over args easy."""
-            for arg in args:
-                if hasattr(arg, '__iter__'):
-                    for k in arg:
-                        yield k
-                else:
-                    yield arg
-
-        def lookup(keys):
-            """Reuse the slightly weird logic to lookup values"""
-            # Do all the selects in a single transaction
-            key_to_val = dict(self.conn.execute(get_many_query(len(keys)), keys))
-
-            # Need to do this whole map lookup thing because the
-            # select does not have a return order.
-            #
-            # We force the keys to be utf8 because that is what sqlite3
-            # gives us back from the cursor.
-            return (key_to_val.get(_utf8(key), default) for key in keys)
-
-        keys = []
-        result = []
-        for k in k_gen():
-            if len(keys) < SQLITE_MAX_QUERY_VARS:
-                keys.append(k)
-            else:
-                result.extend(lookup(keys))
-                keys = [k]
-        if len(keys) > 0:
-            result.extend(lookup(keys))
+        deadline = self._deadline_after(timeout)
+        for chunk, key_to_val in self._lookup_chunks(_key_gen(args), deadline):
+            # We force the keys to be utf8 to match the cursor's keys
+            for k in chunk:
+                yield key_to_val.get(_utf8(k), default)
+
+    def get_dict(self, *args, **kwargs):
+        """D.get_dict(*keys) -> dict mapping the keys in `keys` that are in
+        D to their values.
 
+        Takes keys like :meth:`select`.  Missing keys are left out, and the
+        keys of the result are utf-8 bytestrings.  Nothing is done to
+        restore the order of the keys, so this is cheaper than
+        :meth:`get_many` when a mapping is wanted anyway.
+        """
+        timeout = kwargs.pop('timeout', __TIMEOUT_SENTINEL__)
+        if kwargs:
+            raise TypeError(
+                'Got an unexpected keyword argument: %r' % (kwargs,)
+            )
+
+        result = {}
+        deadline = self._deadline_after(timeout)
+        for _, key_to_val in self._lookup_chunks(_key_gen(args), deadline):
+            result.update(key_to_val)
         return result
 
-    def select(self, *args):
+    def select(self, *args, **kwargs):
         """List based version of :meth:`__getitem__`.  Complement of :meth:`~sqlite3dbm.dbm.SqliteMap.update`.
 
         `args` are the keys to retrieve from the dict.  All of the following work:
@@ -413,7 +1629,7 @@ class SqliteMap(object):
         Raises:
             KeyError if any of the keys are missing
         """
-        vals = self.get_many(default=__MISSING_SENTINEL__, *args)
+        vals = self.get_many(default=__MISSING_SENTINEL__, *args, **kwargs)
         if __MISSING_SENTINEL__ in vals:
             raise KeyError('One of the requested keys is missing!')
         return vals
@@ -425,59 +1641,1232 @@ class SqliteMap(object):
         if self.readonly:
             raise error('DB is readonly')
 
-        def kv_gen():
-            """Generator that combines all the args for easy iteration."""
-            for arg in args:
-                if isinstance(arg, dict):
-                    for k, v in arg.iteritems():
-                        yield k, v
-                else:
-                    for k, v in arg:
-                        yield k, v
-
-            for k, v in kwargs.iteritems():
-                yield k, v
-        rows = list(kv_gen())
+        rows = list(_kv_gen(args, kwargs))
 
         # Do all the inserts in a single transaction for the sake of efficiency
         # TODO: Compare preformance of INSERT MANY to many INSERTS.  Will
         # have to do it in blocks to not exceed query-size limits
-        self.conn.executemany(_SET_QUERY, rows)
+        with self._deadline(self._deadline_after(self.timeout)):
+            if self.default_ttl is None:
+                self.conn.executemany(_SET_QUERY, rows)
+            else:
+                self._enable_expiry()
+                expires = self._expires(self.default_ttl)
+                self.conn.executemany(
+                    _SET_TTL_QUERY, [(k, v, expires) for k, v in rows]
+                )
+            self.conn.commit()
+
+        if self.tracks_access:
+            self._record_access(k for k, _ in rows)
+            self.enforce_capacity()
+
+    def evict_expired(self, batch_size=_EVICT_BATCH_SIZE, sleep=0):
+        """Delete expired keys and return how many were deleted.
+
+        Keys are deleted `batch_size` at a time using the index on the expiry
+        time, committing (and pausing for `sleep` seconds) after each batch,
+        so the write lock is never held for long.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        if not self.has_expiry:
+            if not _has_column(self.conn, 'expires'):
+                return 0
+            self.has_expiry = True
+
+        now = time.time()
+        evicted = 0
+        while True:
+            count = self.conn.execute(
+                _EVICT_QUERY, (now, batch_size)
+            ).rowcount
+            self.conn.commit()
+            evicted += count
+            if count < batch_size:
+                return evicted
+            if sleep:
+                time.sleep(sleep)
+
+    def start_evictor(self, interval=60, batch_size=_EVICT_BATCH_SIZE):
+        """Start a background thread that calls :meth:`evict_expired` right
+        away and then every `interval` seconds, and return it.  Call its
+        `stop` method to stop it.
+
+        The thread uses its own connection to the map's table, so this map
+        can still be used from the current thread.  That includes maps from
+        a :class:`Database`, whose shared connection cannot be used from
+        another thread.
+        """
+        if self.path == ':memory:':
+            raise error('Cannot evict from another thread on a :memory: DB')
+
+        evictor = Evictor(
+            self.path, interval=interval, batch_size=batch_size,
+            table=self.table,
+        )
+        evictor.start()
+        return evictor
+
+    def enable_change_log(self, compact=False):
+        """Start recording every write to the DB in a change log table.
+
+        The log is kept by triggers inside the DB, so writes from all
+        connections are recorded, and it stays enabled across reopens.  Each
+        entry is a (seq, key, op) tuple, where `seq` increases with every
+        change and `op` is 'set' or 'del'.  If `compact` is True, only the
+        latest entry for each key is kept.
+
+        See :meth:`changes_since` and :meth:`apply_changes`.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        self.conn.execute(_CREATE_CHANGES_TABLE)
+        self.conn.execute(_CREATE_CHANGES_KEY_INDEX)
+        for trigger in _CHANGE_TRIGGERS:
+            params = dict(trigger)
+            params['compact'] = (
+                _COMPACT_CHANGE_STATEMENT % trigger if compact else ''
+            )
+            self.conn.execute(_CHANGE_TRIGGER_TEMPLATE % params)
+        self.conn.commit()
+
+    def disable_change_log(self):
+        """Stop recording changes and drop the change log."""
+        if self.readonly:
+            raise error('DB is readonly')
+
+        for trigger in _CHANGE_TRIGGERS:
+            self.conn.execute(_DROP_CHANGE_TRIGGER_QUERY % trigger)
+        self.conn.execute(_DROP_CHANGES_TABLE)
+        self.conn.commit()
+
+    def change_seq(self):
+        """Return the sequence number of the latest change in the log, or 0
+        if the log is empty.
+
+        Take this together with a copy of the DB to start a replica.
+        """
+        seq, = self._change_log_query(_CHANGE_SEQ_QUERY).fetchone()
+        return seq or 0
+
+    def _change_log_query(self, query, params=()):
+        """Run a query on the change log, raising error if it is not
+        enabled.
+        """
+        try:
+            return self.conn.execute(query, params)
+        except sqlite3.OperationalError, e:
+            if 'no such table' not in str(e):
+                raise
+            raise error('The change log is not enabled')
+
+    def changes_since(self, seq=0, batch_size=_CHANGES_BATCH_SIZE):
+        """Iterate over the changes made after `seq`, in order, as
+        (seq, key, op, val, expires) tuples.
+
+        `val` and `expires` are the current value and expiry time of the
+        key, so a replica that applies these changes catches up with the
+        current state of the DB, rather than replaying every intermediate
+        value.  Both are None for deletes, and `val` is also None for a set
+        of a key that has since been deleted.
+
+        Changes are fetched `batch_size` at a time, so no lock is held while
+        the caller processes them.  Raises error if the change log is not
+        enabled.
+        """
+        if self.has_expiry:
+            query = _CHANGES_SINCE_QUERY_TEMPLATE % ('kv_table.expires',)
+        else:
+            query = _CHANGES_SINCE_QUERY_TEMPLATE % ('NULL',)
+        while True:
+            rows = self._change_log_query(
+                query, (seq, batch_size)
+            ).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                return
+            seq = rows[-1][0]
+
+    def apply_changes(self, changes):
+        """Apply (seq, key, op, val, expires) tuples from another DB's
+        :meth:`changes_since`, in one transaction.
+
+        Sets of keys that have since been deleted are skipped, since the
+        delete comes later in the log.
+
+        Returns the seq of the last change applied (or None if there were
+        none), to pass to :meth:`changes_since` next time.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        self._enable_expiry()
+        last_seq = None
+        try:
+            for seq, k, op, val, expires in changes:
+                if op == 'set':
+                    if val is not None:
+                        self.conn.execute(_SET_TTL_QUERY, (k, val, expires))
+                elif op == 'del':
+                    self.conn.execute(_DEL_QUERY, (k,))
+                else:
+                    raise error('Unknown change op "%s"' % (op,))
+                last_seq = seq
+        except:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        return last_seq
+
+    def truncate_changes(self, seq):
+        """Drop the log entries up to and including `seq`, once every
+        replica has applied them.  Returns the number of entries dropped.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        count = self.conn.execute(_TRUNCATE_CHANGES_QUERY, (seq,)).rowcount
+        self.conn.commit()
+        return count
+
+    def compact_changes(self):
+        """Drop all but the latest log entry for each key.  Returns the number
+        of entries dropped.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        count = self.conn.execute(_COMPACT_CHANGES_QUERY).rowcount
         self.conn.commit()
+        return count
+
+    def _empty_copy(self, path):
+        """Create an empty map like this one at `path`."""
+        return SqliteMap(path, flag='n', table=self.table)
+
+    def backup(self, dest_path, rows_per_step=-1, sleep=0.25, progress=None):
+        """Write a copy of the database to `dest_path` and return the number
+        of rows of this map copied.
+
+        The copy is made by SQLite and only moved into place at `dest_path`
+        once it is complete.  By default it is a consistent snapshot of the
+        whole file (with ``VACUUM INTO``), including the other maps of a
+        :class:`Database` and the change logs.  It is taken in one read
+        transaction, which in the default rollback journal mode blocks
+        writers until the copy is done.  Put the database in WAL mode
+        (``PRAGMA journal_mode = WAL``) so that readers, backups included,
+        never block writers.
+
+        Passing a positive `rows_per_step` makes a stepped copy instead,
+        which is *not* a snapshot: only this map's table is copied, that
+        many rows (in key order) per step with a pause of `sleep` seconds in
+        between, so that even in rollback journal mode writers are only ever
+        blocked briefly.  Writes made while it runs may or may not end up in
+        the copy, so it may not match any state the database was ever in.
+
+        If given, `progress` is called as progress(copied, total) after each
+        step (just once for a snapshot), where `total` is the number of rows
+        when the backup started.
+        """
+        dest_path = os.path.abspath(dest_path)
+        tmp_path = dest_path + '.backup'
+        if rows_per_step < 0:
+            copied = self._snapshot(tmp_path)
+            if progress is not None:
+                progress(copied, copied)
+            os.rename(tmp_path, dest_path)
+            return copied
+
+        tmp_map = self._empty_copy(tmp_path)
+        if self.has_expiry:
+            tmp_map._enable_expiry()
+        tmp_map.conn.close()
+
+        self.conn.execute(_ATTACH_BACKUP_QUERY, (tmp_path,))
+        try:
+            copied = _copy_rows(
+                self.conn, 'main', 'backup_dest',
+                rows_per_step=rows_per_step, sleep=sleep, progress=progress,
+                expiry=self.has_expiry,
+            )
+        except:
+            self.conn.rollback()
+            self.conn.execute(_DETACH_BACKUP_QUERY)
+            os.remove(tmp_path)
+            raise
+        self.conn.execute(_DETACH_BACKUP_QUERY)
+
+        os.rename(tmp_path, dest_path)
+        return copied
+
+    def _snapshot(self, path):
+        """Copy the whole database to `path` and return the number of rows
+        of this map in the copy.
+        """
+        # Left over from a backup that was interrupted
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            self.conn.execute(_BACKUP_SNAPSHOT_QUERY, (path,))
+        except:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        conn = sqlite3.connect(path)
+        try:
+            count, = self._table_conn(conn).execute(_COUNT_QUERY).fetchone()
+        finally:
+            conn.close()
+        return count
 
     def __len__(self):
         """x.__len__() <==> len(x)"""
-        return self.conn.execute(_COUNT_QUERY).fetchone()[0]
-
-    ## Iteration
-    def iteritems(self):
+        self._maybe_reload()
+        query = _COUNT_TTL_QUERY if self.has_expiry else _COUNT_QUERY
+        with self._deadline(self._deadline_after(self.timeout)):
+            return self.conn.execute(query).fetchone()[0]
+
+    ## Iteration.  The optional `timeout` bounds the time spent fetching
+    ## rows, which does not include the time the caller spends between them.
+    def iteritems(self, timeout=__TIMEOUT_SENTINEL__):
         """D.iteritems() -> an iterator over the (key, value) items of D"""
-        for key, val in self.conn.execute(_GET_ALL_QUERY):
-            yield key, val
-
-    def items(self):
+        self._maybe_reload()
+        query = _GET_ALL_TTL_QUERY if self.has_expiry else _GET_ALL_QUERY
+        deadline = self._deadline_after(timeout)
+        if deadline is None:
+            for key, val in self.conn.execute(query):
+                yield key, val
+            return
+
+        with self._deadline(deadline):
+            cursor = self.conn.execute(query)
+        while True:
+            with self._deadline(deadline):
+                rows = cursor.fetchmany(_DEADLINE_FETCH_SIZE)
+            if not rows:
+                return
+            for key, val in rows:
+                yield key, val
+
+    def items(self, timeout=__TIMEOUT_SENTINEL__):
         """D.items() -> list of D's (key, value) pairs, as 2-tuples"""
-        return [(k, v) for k, v in self.iteritems()]
-    def iterkeys(self):
+        return [(k, v) for k, v in self.iteritems(timeout=timeout)]
+    def iterkeys(self, timeout=__TIMEOUT_SENTINEL__):
         """D.iterkeys() -> an iterator over the keys of D"""
-        return (k for k, _ in self.iteritems())
-    def keys(self):
+        return (k for k, _ in self.iteritems(timeout=timeout))
+    def keys(self, timeout=__TIMEOUT_SENTINEL__):
         """D.iterkeys() -> an iterator over the keys of D"""
-        return [k for k in self.iterkeys()]
-    def itervalues(self):
+        return [k for k in self.iterkeys(timeout=timeout)]
+    def itervalues(self, timeout=__TIMEOUT_SENTINEL__):
         """D.itervalues() -> an iterator over the values of D"""
-        return (v for _, v in self.iteritems())
-    def values(self):
+        return (v for _, v in self.iteritems(timeout=timeout))
+    def values(self, timeout=__TIMEOUT_SENTINEL__):
         """D.values() -> list of D's values"""
-        return [v for v in self.itervalues()]
+        return [v for v in self.itervalues(timeout=timeout)]
     def __iter__(self):
         """Iterate over the keys of D.  Consistent with dict."""
         return self.iterkeys()
 
-def open(filename, flag='r', mode=0666):
+class SqliteBlob(object):
+    """File-like object over one value of a :class:`SqliteMap`, returned by
+    :meth:`SqliteMap.open_blob`.
+
+    Readers support read, seek and tell; writers support write and tell.
+    """
+
+    def __init__(self, smap, key, mode='r'):
+        if mode not in ('r', 'w'):
+            raise error('Invalid mode "%s"' % (mode,))
+
+        self.smap = smap
+        self.key = key
+        self.mode = mode
+        self.pos = 0
+        self.closed = False
+
+        if mode == 'r':
+            # Bytes fetched ahead of `pos`, starting at `buffer_pos`
+            self.buffer = ''
+            self.buffer_pos = 0
+            smap._maybe_reload()
+            query = _BLOB_LENGTH_QUERY
+            if smap.has_expiry:
+                query += ' AND ' + _NOT_EXPIRED
+            row = smap.conn.execute(query, (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            self.size = row[0] or 0
+        else:
+            if smap.readonly:
+                raise error('DB is readonly')
+            smap.conn.execute(_CREATE_STREAM_TABLE)
+            self.stream = _stream_ids.next()
+            self.seq = 0
+            self.size = 0
+
+    def _check(self, mode):
+        if self.closed:
+            raise ValueError('I/O operation on closed blob')
+        if self.mode != mode:
+            raise IOError('Blob not open for %s' % (
+                'reading' if mode == 'r' else 'writing',
+            ))
+
+    def read(self, size=-1):
+        """Read at most `size` bytes, or everything left if `size` is
+        negative.  Returns '' at the end of the value.
+        """
+        self._check('r')
+        if size < 0 or self.pos + size > self.size:
+            size = self.size - self.pos
+        if size <= 0:
+            return ''
+
+        start = self.pos - self.buffer_pos
+        if start < 0 or start + size > len(self.buffer):
+            self._fill(max(size, _BLOB_READAHEAD))
+            start = 0
+        data = self.buffer[start:start + size]
+        self.pos += len(data)
+        return data
+
+    def _fill(self, size):
+        """Fetch `size` bytes from `pos` into the buffer."""
+        # Dropped first, so that only one range is held at a time
+        self.buffer = ''
+        query = _BLOB_READ_QUERY
+        if self.smap.has_expiry:
+            query += ' AND ' + _NOT_EXPIRED
+        row = self.smap.conn.execute(
+            query, (self.pos + 1, size, self.key)
+        ).fetchone()
+        if row is None:
+            raise KeyError(self.key)
+        self.buffer = str(row[0])
+        self.buffer_pos = self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """Move to `offset`, relative to the start, current position or
+        end of the value as for file.seek.
+        """
+        self._check('r')
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = max(offset, 0)
+
+    def tell(self):
+        """Current position in the value."""
+        if self.mode == 'w':
+            return self.size
+        return self.pos
+
+    def write(self, data):
+        """Append `data` to the value being written."""
+        self._check('w')
+        if not data:
+            return
+        # Committed right away so that a rollback elsewhere on the
+        # connection cannot drop chunks.  Only the temp database is written.
+        self.smap.conn.execute(
+            _STREAM_CHUNK_QUERY, (self.stream, self.seq, data)
+        )
+        self.smap.conn.commit()
+        self.seq += 1
+        self.size += len(data)
+
+    def abort(self):
+        """Discard a writer's chunks without setting the value."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.mode == 'w':
+            self.smap.conn.execute(_STREAM_DISCARD_QUERY, (self.stream,))
+            self.smap.conn.commit()
+
+    def close(self):
+        """Finish with the blob.  For a writer, this sets the value."""
+        if self.closed:
+            return
+        if self.mode == 'w':
+            try:
+                self.smap._set_from_stream(self.key, self.stream)
+            except:
+                self.smap.conn.rollback()
+                self.abort()
+                raise
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class _TableConnection(object):
+    """Connection proxy for a map stored in a table other than kv_table.
+
+    The statements it runs are rewritten to use the map's tables, and cached.
+    Everything else is passed through to the connection.
+    """
+
+    def __init__(self, conn, table):
+        self._conn = conn
+        self._table = table
+        self._queries = {}
+
+    def _replace(self, match):
+        if match.group(1) == 'table':
+            return self._table
+        return '%s_%s' % (self._table, match.group(1))
+
+    def _sql(self, sql):
+        try:
+            return self._queries[sql]
+        except KeyError:
+            if len(self._queries) >= _MAX_TABLE_QUERIES:
+                self._queries.clear()
+            query = self._queries[sql] = _TABLE_REF_RE.sub(self._replace, sql)
+            return query
+
+    def execute(self, sql, *args):
+        return self._conn.execute(self._sql(sql), *args)
+
+    def executemany(self, sql, *args):
+        return self._conn.executemany(self._sql(sql), *args)
+
+    def executescript(self, sql):
+        return self._conn.executescript(self._sql(sql))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+def _rollback_quietly(conn, query):
+    """Run the rollback `query` on `conn` and return True, or return False
+    if SQLite has already rolled the transaction back by itself.
+    """
+    try:
+        conn.execute(query)
+    except sqlite3.OperationalError, e:
+        if ('no transaction is active' not in str(e) and
+                'no such savepoint' not in str(e)):
+            raise
+        return False
+    return True
+
+class _SharedConnection(sqlite3.Connection):
+    """Connection shared by the maps of a :class:`Database`.
+
+    The commits and rollbacks of the maps are ignored while a transaction is
+    open, so that the transaction decides.  `depth` is the number of nested
+    transactions open.
+    """
+    depth = 0
+
+    def commit(self):
+        if not self.depth:
+            sqlite3.Connection.commit(self)
+
+    def rollback(self):
+        if not self.depth:
+            sqlite3.Connection.rollback(self)
+
+class Database(object):
+    """Several maps stored as tables of one SQLite file, sharing one
+    connection.
+
+    Writes to the maps inside :meth:`transaction` are committed together, in
+    one transaction.  Outside of one, every write commits as usual.
+    """
+
+    def __init__(self, path, flag='c', mode=0666):
+        """Open the database at `path`.  `flag` and `mode` are as for
+        :func:`open`, except that 'n' clears each map when it is first
+        opened.
+        """
+        self.path, _ = _prepare_path(path, flag, mode)
+        self.flag = flag
+        self.conn = sqlite3.connect(self.path, factory=_SharedConnection)
+        self.conn.text_factory = str
+        self.maps = {}
+
+    def map(self, table=DEFAULT_TABLE, **kwargs):
+        """Return the :class:`SqliteMap` stored in `table`, creating the
+        table if needed.
+
+        Keyword arguments are passed on to the map, as for :func:`open`.
+        Asking for the same table again returns the same map.
+        """
+        if table not in self.maps:
+            flag = self.flag
+            if flag == 'c':
+                flag = 'w'
+            codec = kwargs.pop('codec', None)
+            if codec is None:
+                self.maps[table] = SqliteMap(
+                    self.path, flag=flag, table=table, database=self,
+                    **kwargs
+                )
+            else:
+                self.maps[table] = TypedSqliteMap(
+                    self.path, codec, flag=flag, table=table,
+                    database=self, **kwargs
+                )
+        return self.maps[table]
+
+    def shelf(self, table=DEFAULT_TABLE, protocol=None, writeback=False):
+        """Return a :class:`sqlite3dbm.sshelve.SqliteMapShelf` over the
+        map stored in `table`.
+        """
+        import sqlite3dbm.sshelve
+        return sqlite3dbm.sshelve.SqliteMapShelf(
+            self.map(table), protocol=protocol, writeback=writeback
+        )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Context manager running the writes made to the maps in its
+        block as one transaction, committed (with one fsync) at the end of
+        the block or rolled back if it raises.
+
+        Transactions can be nested; an inner one that raises only rolls
+        back its own writes.  The maps' timeouts are not applied inside a
+        transaction.
+        """
+        conn = self.conn
+        depth = conn.depth
+        if not depth:
+            # Take over from the sqlite3 module, which would otherwise
+            # commit before statements such as ALTER TABLE
+            sqlite3.Connection.commit(conn)
+            isolation_level = conn.isolation_level
+            conn.isolation_level = None
+            conn.execute(_BEGIN_QUERY)
+        else:
+            conn.execute(_SAVEPOINT_QUERY % (depth,))
+        conn.depth = depth + 1
+
+        try:
+            yield self
+        except:
+            conn.depth = depth
+            try:
+                if not depth:
+                    _rollback_quietly(conn, _ROLLBACK_QUERY)
+                elif _rollback_quietly(conn, _ROLLBACK_TO_QUERY % (depth,)):
+                    conn.execute(_RELEASE_QUERY % (depth,))
+            finally:
+                if not depth:
+                    conn.isolation_level = isolation_level
+                self._resync_maps()
+            raise
+
+        conn.depth = depth
+        if not depth:
+            try:
+                conn.execute(_COMMIT_QUERY)
+            except:
+                try:
+                    _rollback_quietly(conn, _ROLLBACK_QUERY)
+                finally:
+                    conn.isolation_level = isolation_level
+                    self._resync_maps()
+                raise
+            conn.isolation_level = isolation_level
+        else:
+            conn.execute(_RELEASE_QUERY % (depth,))
+
+    def _resync_maps(self):
+        """Bring the maps back in line with the schema after a rollback,
+        which may have undone the creation of their tables or columns.
+        """
+        for smap in self.maps.itervalues():
+            if 'conn' in smap.__dict__:
+                smap._prepare_table()
+                smap.conn.commit()
+
+    def tables(self):
+        """Return the names of the maps in the database."""
+        return [
+            name for name, in self.conn.execute(_LIST_TABLES_QUERY)
+            if _has_column(_TableConnection(self.conn, name), 'val')
+        ]
+
+    def close(self):
+        """Close the connection shared by the maps."""
+        self.conn.close()
+
+def _nbytes(s):
+    """Size of a key or value as stored, for metrics."""
+    if isinstance(s, basestring):
+        return len(_utf8(s))
+    return 0
+
+class Metrics(object):
+    """Counters and latency histograms for the operations on one or more
+    :class:`InstrumentedSqliteMap` objects.
+
+    Latencies are bucketed by powers of two microseconds.  Callables added
+    with :meth:`add_hook` are called as hook(op, seconds, rows, nbytes) after
+    every operation, to forward measurements elsewhere.
+    """
+
+    def __init__(self):
+        self.hooks = []
+        self.reset()
+
+    def reset(self):
+        """Zero all the counters."""
+        self.ops = {}
+        self.rows_read = 0
+        self.bytes_read = 0
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.commits = 0
+        self.get_many_chunks = 0
+
+    def add_hook(self, hook):
+        """Call hook(op, seconds, rows, nbytes) after every operation."""
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        """Stop calling `hook`."""
+        self.hooks.remove(hook)
+
+    def record(self, op, seconds, rows_read=0, bytes_read=0, rows_written=0,
+               bytes_written=0):
+        """Count one call of `op` that took `seconds`."""
+        stats = self.ops.get(op)
+        if stats is None:
+            stats = self.ops[op] = {
+                'count': 0,
+                'total_time': 0.0,
+                'max_time': 0.0,
+                'histogram': {},
+            }
+        stats['count'] += 1
+        stats['total_time'] += seconds
+        stats['max_time'] = max(stats['max_time'], seconds)
+        # Upper bound of the bucket, in microseconds
+        bucket = 1 << int(seconds * 1e6).bit_length()
+        stats['histogram'][bucket] = stats['histogram'].get(bucket, 0) + 1
+
+        self.rows_read += rows_read
+        self.bytes_read += bytes_read
+        self.rows_written += rows_written
+        self.bytes_written += bytes_written
+
+        if self.hooks:
+            rows = rows_read + rows_written
+            nbytes = bytes_read + bytes_written
+            for hook in self.hooks:
+                hook(op, seconds, rows, nbytes)
+
+    def snapshot(self):
+        """Return a copy of all the counters as a dict."""
+        return {
+            'ops': dict(
+                (op, dict(stats, histogram=dict(stats['histogram'])))
+                for op, stats in self.ops.iteritems()
+            ),
+            'rows_read': self.rows_read,
+            'bytes_read': self.bytes_read,
+            'rows_written': self.rows_written,
+            'bytes_written': self.bytes_written,
+            'commits': self.commits,
+            'get_many_chunks': self.get_many_chunks,
+        }
+
+
+class _CountingConnection(sqlite3.Connection):
+    """Connection that counts its commits in `metrics`."""
+
+    metrics = None
+
+    def commit(self):
+        if self.metrics is not None:
+            self.metrics.commits += 1
+        return sqlite3.Connection.commit(self)
+
+
+class Diagnostics(object):
+    """Per-statement timings for one or more SqliteMaps opened with
+    `diagnostics`.
+
+    Every statement the maps run is timed, and a progress handler counts the
+    SQLite virtual machine instructions it takes, in units of
+    `progress_steps`.  A statement that takes many steps for few rows points
+    at a bad query plan, while one that is slow in few steps was most likely
+    waiting on a lock or on disk.  Statements are timed up to their first
+    row, so the rest of a scan that is iterated over is not included.
+
+    Statements that take at least `slow_query_time` seconds are logged as
+    warnings to `logger` (the 'sqlite3dbm' logger by default).
+    """
+
+    def __init__(self, slow_query_time=None, progress_steps=1000,
+                 logger=None):
+        self.slow_query_time = slow_query_time
+        self.progress_steps = progress_steps
+        if logger is None:
+            # Imported here to keep it out of the import time of the package
+            import logging
+            logger = logging.getLogger('sqlite3dbm')
+        self.logger = logger
+        self._steps = 0
+        # The same bound method every time, see _deadline_checker
+        self._progress_handler = self._progress
+        self.reset()
+
+    def reset(self):
+        """Forget all the statements recorded so far."""
+        self.statements = {}
+        self.slow_queries = 0
+
+    def install(self, conn):
+        """Trace the statements run by `conn`, a _TracingConnection."""
+        conn.diagnostics = self
+        if self.progress_steps:
+            conn.set_progress_handler(
+                self._progress_handler, self.progress_steps
+            )
+
+    def _progress(self):
+        self._steps += 1
+        # Returning non-zero would abort the statement
+        return 0
+
+    def record(self, sql, seconds, steps, failed=False):
+        """Count one run of the statement `sql`."""
+        sql = _PLACEHOLDER_LIST_RE.sub('?,...', sql)
+        stats = self.statements.get(sql)
+        if stats is None:
+            stats = self.statements[sql] = {
+                'count': 0,
+                'total_time': 0.0,
+                'max_time': 0.0,
+                'vm_steps': 0,
+                'errors': 0,
+            }
+        stats['count'] += 1
+        stats['total_time'] += seconds
+        stats['max_time'] = max(stats['max_time'], seconds)
+        stats['vm_steps'] += steps * self.progress_steps
+        if failed:
+            stats['errors'] += 1
+
+        if (self.slow_query_time is not None and
+            seconds >= self.slow_query_time):
+            self.slow_queries += 1
+            self.logger.warning(
+                'Slow query (%.3fs, ~%d VM steps): %s',
+                seconds, steps * self.progress_steps, sql
+            )
+
+    def statement_stats(self):
+        """Return a dict mapping each statement's SQL to its `count`,
+        `total_time` and `max_time` in seconds, approximate `vm_steps` and
+        number of `errors`.
+        """
+        return dict(
+            (sql, dict(stats)) for sql, stats in self.statements.iteritems()
+        )
+
+
+class _TracingConnection(_CountingConnection):
+    """Connection that times its statements in `diagnostics`."""
+
+    diagnostics = None
+
+    def _trace(self, method, sql, *args):
+        diagnostics = self.diagnostics
+        diagnostics._steps = 0
+        start = time.time()
+        failed = True
+        try:
+            result = method(self, sql, *args)
+            failed = False
+            return result
+        finally:
+            diagnostics.record(
+                sql, time.time() - start, diagnostics._steps, failed
+            )
+
+    def execute(self, sql, *args):
+        return self._trace(sqlite3.Connection.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._trace(sqlite3.Connection.executemany, sql, *args)
+
+    def executescript(self, sql):
+        return self._trace(sqlite3.Connection.executescript, sql)
+
+
+class InstrumentedSqliteMap(SqliteMap):
+    """SqliteMap that records :class:`Metrics` for its operations.
+
+    Returned by :func:`open` when metrics are asked for, so that plain maps
+    pay nothing for the instrumentation.  The timed operations are
+    `getitem`, `setitem`, `delitem`, `get_many`, `update` and `iteritems`
+    (which all the other lookups and iterators go through).
+    """
+
+    def __init__(self, path, metrics=None, **kwargs):
+        self.metrics = metrics if metrics is not None else Metrics()
+        SqliteMap.__init__(self, path, **kwargs)
+
+    def _connect(self, path):
+        if self.diagnostics is None:
+            conn = sqlite3.connect(path, factory=_CountingConnection)
+        else:
+            conn = sqlite3.connect(path, factory=_TracingConnection)
+            self.diagnostics.install(conn)
+        conn.text_factory = str
+        conn.metrics = self.metrics
+        return conn
+
+    def stats(self):
+        """Return the metrics collected so far as a dict.
+
+        `ops` maps each operation to its `count`, `total_time` and
+        `max_time` in seconds, and a `histogram` mapping latency bucket
+        upper bounds (in microseconds) to counts.  The other entries count
+        rows and bytes read and written, commits, and the chunks of at most
+        SQLITE_MAX_QUERY_VARS keys that get_many looked up.
+        """
+        return self.metrics.snapshot()
+
+    def __getitem__(self, k):
+        if hasattr(k, '__iter__'):
+            return self.select(k)
+
+        start = time.time()
+        v = SqliteMap.__getitem__(self, k)
+        self.metrics.record(
+            'getitem', time.time() - start,
+            rows_read=1, bytes_read=_nbytes(k) + _nbytes(v)
+        )
+        return v
+
+    def set(self, k, v, ttl=__TTL_SENTINEL__):
+        start = time.time()
+        SqliteMap.set(self, k, v, ttl=ttl)
+        self.metrics.record(
+            'setitem', time.time() - start,
+            rows_written=1, bytes_written=_nbytes(k) + _nbytes(v)
+        )
+
+    def __delitem__(self, k):
+        start = time.time()
+        SqliteMap.__delitem__(self, k)
+        self.metrics.record('delitem', time.time() - start, rows_written=1)
+
+    def get_many(self, *args, **kwargs):
+        start = time.time()
+        default = kwargs.get('default')
+        vals = SqliteMap.get_many(self, *args, **kwargs)
+        found = [v for v in vals if v is not default]
+        self.metrics.get_many_chunks += (
+            (len(vals) + SQLITE_MAX_QUERY_VARS - 1) / SQLITE_MAX_QUERY_VARS
+        )
+        self.metrics.record(
+            'get_many', time.time() - start,
+            rows_read=len(found), bytes_read=sum(map(_nbytes, found))
+        )
+        return vals
+
+    def update(self, *args, **kwargs):
+        start = time.time()
+        rows = list(_kv_gen(args, kwargs))
+        SqliteMap.update(self, rows)
+        self.metrics.record(
+            'update', time.time() - start,
+            rows_written=len(rows),
+            bytes_written=sum(_nbytes(k) + _nbytes(v) for k, v in rows)
+        )
+
+    def iteritems(self, timeout=__TIMEOUT_SENTINEL__):
+        # Only time spent fetching rows counts, not time spent by the caller
+        # between rows
+        items = SqliteMap.iteritems(self, timeout=timeout)
+        elapsed = 0.0
+        rows = 0
+        nbytes = 0
+        try:
+            while True:
+                start = time.time()
+                try:
+                    k, v = items.next()
+                except StopIteration:
+                    elapsed += time.time() - start
+                    break
+                elapsed += time.time() - start
+                rows += 1
+                nbytes += _nbytes(k) + _nbytes(v)
+                yield k, v
+        finally:
+            self.metrics.record(
+                'iteritems', elapsed, rows_read=rows, bytes_read=nbytes
+            )
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise error('NumPy is not installed')
+    return numpy
+
+def _array_typecode(typecodes, itemsize=8):
+    """Return the first of `typecodes` whose :mod:`array` items are
+    `itemsize` bytes wide on this platform, or None.
+
+    'q' and 'Q' only exist on Python 3, and 'l' and 'L' are only 8 bytes
+    wide where a C long is, which is not the case on Windows or 32-bit
+    builds.
+    """
+    for typecode in typecodes:
+        try:
+            if array(typecode).itemsize == itemsize:
+                return typecode
+        except ValueError:
+            pass
+    return None
+
+class IntCodec(object):
+    """Value codec storing ints as SQLite INTEGERs (64 bits)."""
+
+    # array typecode for batches of values.  None if the platform has no
+    # 64-bit array type, in which case batches cannot be packed.
+    typecode = _array_typecode('ql')
+
+    def encode(self, v):
+        return int(v)
+
+    def decode(self, v):
+        return int(v)
+
+    def extend(self, out, v):
+        """Append the stored value `v` to the array `out` and return the
+        number of items added.
+        """
+        out.append(int(v))
+        return 1
+
+class FloatCodec(object):
+    """Value codec storing floats as SQLite REALs."""
+
+    typecode = 'd'
+
+    def encode(self, v):
+        return float(v)
+
+    def decode(self, v):
+        return float(v)
+
+    def extend(self, out, v):
+        out.append(float(v))
+        return 1
+
+class ArrayCodec(object):
+    """Value codec storing sequences of numbers as packed BLOBs of the
+    :mod:`array` type `typecode`, in native byte order.
+
+    Values are decoded to arrays, or to read-only NumPy arrays if `numpy` is
+    True.  Lists, arrays and NumPy arrays can all be stored.
+    """
+
+    def __init__(self, typecode='d', numpy=False):
+        self.typecode = typecode
+        self.numpy = numpy
+        # Fail early on a bad typecode
+        array(typecode)
+
+    def encode(self, v):
+        if isinstance(v, array) and v.typecode == self.typecode:
+            data = v.tostring()
+        elif hasattr(v, 'dtype'):
+            data = v.astype(self.typecode).tostring()
+        else:
+            data = array(self.typecode, v).tostring()
+        # Bound as a BLOB, where a str would become TEXT
+        return buffer(data)
+
+    def decode(self, v):
+        if self.numpy:
+            return _import_numpy().frombuffer(v, dtype=self.typecode)
+        a = array(self.typecode)
+        a.fromstring(v)
+        return a
+
+    def extend(self, out, v):
+        before = len(out)
+        out.fromstring(v)
+        return len(out) - before
+
+# Codecs that can be given to `open` by name
+CODECS = {
+    'int': IntCodec,
+    'float': FloatCodec,
+    'array': ArrayCodec,
+}
+
+class TypedSqliteMap(SqliteMap):
+    """SqliteMap whose values are converted to and from their stored form
+    by a codec, such as :class:`IntCodec` or :class:`ArrayCodec`.
+
+    Returned by :func:`open` when a codec is asked for.  New tables are
+    created with an untyped value column, so that numbers are stored
+    natively and arrays as BLOBs.  Existing tables keep their TEXT column:
+    numbers are then stored as text, and still decoded correctly.
+
+    The raw stored values are what :meth:`changes_since`, :meth:`open_blob`
+    and :func:`diff` see.
+    """
+
+    _create_table_query = _CREATE_TYPED_TABLE
+
+    def __init__(self, path, codec, **kwargs):
+        if isinstance(codec, basestring):
+            if codec not in CODECS:
+                raise error('Unknown codec "%s"' % (codec,))
+            codec = CODECS[codec]()
+        self.codec = codec
+        SqliteMap.__init__(self, path, **kwargs)
+
+    def _empty_copy(self, path):
+        return TypedSqliteMap(path, self.codec, flag='n', table=self.table)
+
+    def __getitem__(self, k):
+        if hasattr(k, '__iter__'):
+            return self.select(k)
+        return self.codec.decode(SqliteMap.__getitem__(self, k))
+
+    def set(self, k, v, ttl=__TTL_SENTINEL__):
+        SqliteMap.set(self, k, self.codec.encode(v), ttl=ttl)
+
+    def update(self, *args, **kwargs):
+        encode = self.codec.encode
+        SqliteMap.update(
+            self, [(k, encode(v)) for k, v in _kv_gen(args, kwargs)]
+        )
+
+    def popitem(self):
+        k, v = SqliteMap.popitem(self)
+        return k, self.codec.decode(v)
+
+    def iteritems(self, timeout=__TIMEOUT_SENTINEL__):
+        decode = self.codec.decode
+        for k, v in SqliteMap.iteritems(self, timeout=timeout):
+            yield k, decode(v)
+
+    def get_many_iter(self, *args, **kwargs):
+        default = kwargs.pop('default', None)
+        decode = self.codec.decode
+        for v in SqliteMap.get_many_iter(
+                self, default=__MISSING_SENTINEL__, *args, **kwargs):
+            yield default if v is __MISSING_SENTINEL__ else decode(v)
+
+    def get_dict(self, *args, **kwargs):
+        decode = self.codec.decode
+        return dict(
+            (k, decode(v))
+            for k, v in SqliteMap.get_dict(self, *args, **kwargs).iteritems()
+        )
+
+    def select(self, *args, **kwargs):
+        # Checked before decoding, since comparing the sentinel against
+        # NumPy arrays does not give a bool
+        vals = list(SqliteMap.get_many_iter(
+            self, default=__MISSING_SENTINEL__, *args, **kwargs
+        ))
+        if any(v is __MISSING_SENTINEL__ for v in vals):
+            raise KeyError('One of the requested keys is missing!')
+        return map(self.codec.decode, vals)
+
+    def get_many_array(self, *args, **kwargs):
+        """Look up keys like :meth:`select`, and return their values
+        packed into one contiguous :mod:`array` of the codec's type.
+
+        The optional `default` keyword argument is used for missing keys;
+        without it KeyError is raised if any are missing.  Array values are
+        concatenated.  If the `numpy` keyword argument is True a NumPy array
+        is returned instead, with one row per key if every array value had
+        the same length.
+        """
+        default = kwargs.pop('default', __MISSING_SENTINEL__)
+        use_numpy = kwargs.pop('numpy', False)
+        if default is not __MISSING_SENTINEL__:
+            default = self.codec.encode(default)
+
+        if self.codec.typecode is None:
+            raise error('No array type can hold these values on this platform')
+        out = array(self.codec.typecode)
+        sizes = set()
+        count = 0
+        for v in SqliteMap.get_many_iter(
+                self, default=__MISSING_SENTINEL__, *args, **kwargs):
+            if v is __MISSING_SENTINEL__:
+                if default is __MISSING_SENTINEL__:
+                    raise KeyError('One of the requested keys is missing!')
+                v = default
+            sizes.add(self.codec.extend(out, v))
+            count += 1
+
+        if not use_numpy:
+            return out
+        result = _import_numpy().frombuffer(out, dtype=out.typecode)
+        if len(sizes) == 1 and sizes != set([1]):
+            result = result.reshape(count, -1)
+        return result
+
+
+class Evictor(threading.Thread):
+    """Background thread that periodically evicts expired keys from the map
+    in `table` of the DB at `path`.  See :meth:`SqliteMap.start_evictor`.
+    """
+
+    def __init__(self, path, interval=60, batch_size=_EVICT_BATCH_SIZE,
+                 table=DEFAULT_TABLE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.table = table
+        self.stopped = threading.Event()
+
+    def run(self):
+        smap = SqliteMap(self.path, flag='w', table=self.table)
+        while True:
+            smap.evict_expired(batch_size=self.batch_size)
+            self.stopped.wait(self.interval)
+            if self.stopped.is_set():
+                break
+        smap.conn.close()
+
+    def stop(self):
+        """Stop evicting and wait for the thread to finish."""
+        self.stopped.set()
+        self.join()
+
+def open(filename, flag='r', mode=0666, in_memory=False, progress=None,
+         reload_interval=None, default_ttl=None, max_entries=None,
+         max_bytes=None, eviction='lru', metrics=None, diagnostics=None,
+         table=DEFAULT_TABLE, codec=None, timeout=None):
     """Open a database and return a SqliteMap object.
 
-    The `filename` argument is the path to the database file.
+    The `filename` argument is the path to the database file.  An existing
+    database is not connected to until the map is first used.
 
     The optional `flag` argument can be:
         r: Open existing db for reading only [default]
@@ -488,5 +2877,276 @@ def open(filename, flag='r', mode=0666):
     The optional `mode` argument is the Unix mode of the file, used only when
     the database has to be created.  It defaults to octal 0666 and respects the
     prevailing umask.
+
+    If the optional `in_memory` argument is True, the whole database is
+    copied into an in-memory SQLite database when it is opened, and every
+    lookup is served from memory.  This requires the 'r' flag.  `progress`
+    is called as progress(copied, total) as rows are loaded.  If
+    `reload_interval` is given, the file is checked for changes at most
+    every `reload_interval` seconds (on access) and reloaded if it changed.
+
+    The optional `default_ttl` argument is the number of seconds after which
+    keys written to the map expire, unless a TTL is passed to
+    :meth:`SqliteMap.set`.  It defaults to None, meaning keys never expire.
+
+    The optional `max_entries` and `max_bytes` arguments bound the size of
+    the map, which is then used as a cache: once it grows past either limit,
+    the coldest keys are evicted according to `eviction`:
+        lru: Evict the least recently used keys [default]
+        lfu: Evict the least frequently used keys
+    Only reads and writes made through a map with limits count as uses.
+
+    If the optional `metrics` argument is True, an
+    :class:`InstrumentedSqliteMap` is returned, which records per-operation
+    metrics; see :meth:`InstrumentedSqliteMap.stats`.  A :class:`Metrics`
+    object may be passed instead, to share one set of metrics between maps.
+
+    If the optional `diagnostics` argument is True, every SQL statement the
+    map runs is timed; see :class:`Diagnostics`.  A Diagnostics object may be
+    passed instead, to set a slow query threshold or to share it between
+    maps.
+
+    The optional `table` argument names the table holding the map, so that
+    several maps can be kept in one file.  It defaults to 'kv_table'.  Use
+    a :class:`Database` to update several maps in one transaction.
+
+    If the optional `codec` argument is given, a :class:`TypedSqliteMap` is
+    returned, which converts values with the codec: 'int' or 'float' to
+    store numbers natively, 'array' (or an :class:`ArrayCodec` with another
+    typecode) to store packed arrays of doubles, or any other object with
+    the same methods.  It cannot be combined with `metrics`.
+
+    The optional `timeout` argument bounds, in seconds, how long each
+    lookup, write and delete of a single key, get_many and the other
+    multi-key lookups, iteration, len, update and the batch deletes may run,
+    including time spent waiting on locks.  An operation that runs out of
+    time is interrupted and raises :class:`SqliteMapTimeout`.  The batch
+    operations also take a `timeout` argument of their own, which overrides
+    this one.  Other operations, opening the connection on first use, and
+    anything run inside a :meth:`Database.transaction` are not bounded.
+    """
+    kwargs = dict(
+        flag=flag, mode=mode, in_memory=in_memory,
+        progress=progress, reload_interval=reload_interval,
+        default_ttl=default_ttl, max_entries=max_entries,
+        max_bytes=max_bytes, eviction=eviction, diagnostics=diagnostics,
+        table=table, timeout=timeout,
+    )
+    if codec is not None:
+        if metrics:
+            raise error('codec and metrics cannot be combined')
+        return TypedSqliteMap(filename, codec, **kwargs)
+    if metrics:
+        if metrics is True:
+            metrics = Metrics()
+        return InstrumentedSqliteMap(filename, metrics=metrics, **kwargs)
+    return SqliteMap(filename, **kwargs)
+
+def build(filename, rows, verify_sorted=True, mode=0666):
+    """Build a new database at `filename` from `rows` and return the number
+    of rows written.
+
+    This is much faster than calling :meth:`SqliteMap.update` for large,
+    offline-built databases.  `rows` is an iterable of (key, value) pairs
+    sorted by key (as utf-8 bytestrings), such as the output of a MapReduce
+    job.  Journaling and syncing are turned off during the load, and the
+    finished file is analyzed and vacuumed so that its pages are compact.
+
+    The database is built next to `filename` and moved into place once it is
+    complete, replacing any existing database.  The result can be opened
+    with :func:`open` like any other.
+
+    If `verify_sorted` is True (the default), error is raised if the keys
+    are not strictly increasing.  Otherwise duplicate keys are allowed, and
+    the last value wins.
     """
-    return SqliteMap(filename, flag=flag, mode=mode)
+    filename = os.path.abspath(filename)
+    build_path = filename + '.build'
+    if os.path.exists(build_path):
+        os.remove(build_path)
+    os.close(os.open(build_path, os.O_CREAT, mode))
+
+    def checked_rows():
+        """Pass through `rows`, checking the key order as we go."""
+        prev = None
+        for k, v in rows:
+            utf8_k = _utf8(k)
+            if prev is not None and utf8_k <= prev:
+                raise error(
+                    'Keys are not sorted: %r came after %r' % (k, prev)
+                )
+            prev = utf8_k
+            yield k, v
+
+    conn = sqlite3.connect(build_path)
+    try:
+        conn.text_factory = str
+        conn.executescript(_BUILD_PRAGMAS)
+        conn.execute(_CREATE_BUILD_TABLE)
+
+        if verify_sorted:
+            cursor = conn.executemany(_BUILD_INSERT_QUERY, checked_rows())
+        else:
+            cursor = conn.executemany(_SET_QUERY, rows)
+        num_rows = cursor.rowcount
+        conn.commit()
+
+        conn.executescript(_BUILD_FINISH_QUERY)
+    except:
+        conn.close()
+        os.remove(build_path)
+        raise
+    conn.close()
+
+    os.rename(build_path, filename)
+    return num_rows
+
+def merge(filename, sources, conflict='last', compact=False, mode=0666):
+    """Merge the databases at the paths in `sources` into the database at
+    `filename`, creating it if needed.
+
+    Rows are copied inside SQLite, one source at a time and one transaction
+    per source.  The optional `conflict` argument decides what happens when
+    a key already exists in the destination:
+        last: The value from the later source wins [default]
+        first: The value already present wins
+        callable: Called as conflict(key, old_val, new_val) and the
+            returned value is stored.  Conflicting rows are resolved in
+            Python, so this is slower than the other options.
+
+    If `compact` is True, the destination is vacuumed once all sources have
+    been merged.
+
+    Expiry times are copied along with the rows, and keys that have already
+    expired (in a source or in the destination) are treated as missing.  A
+    value resolved by a `conflict` callable keeps the expiry time of the
+    key already in the destination.
+
+    Returns a list with the number of rows each source added or changed.
+    """
+    if conflict not in ('last', 'first') and not callable(conflict):
+        raise error('Invalid conflict resolution "%s"' % (conflict,))
+
+    smap = SqliteMap(filename, flag='c', mode=mode)
+    conn = smap.conn
+    if conflict != 'last':
+        conn.execute(_MERGE_DEL_EXPIRED_QUERY)
+        conn.commit()
+
+    counts = []
+    for source in sources:
+        conn.execute(_ATTACH_QUERY, (os.path.abspath(source),))
+        try:
+            if _has_column(conn, 'expires', 'merge_src'):
+                last_query = _MERGE_LAST_TTL_QUERY
+                first_query = _MERGE_FIRST_TTL_QUERY
+                conflicts_query = _MERGE_CONFLICTS_TTL_QUERY
+            else:
+                last_query = _MERGE_LAST_QUERY
+                first_query = _MERGE_FIRST_QUERY
+                conflicts_query = _MERGE_CONFLICTS_QUERY
+
+            if conflict == 'last':
+                count = conn.execute(last_query).rowcount
+            elif conflict == 'first':
+                count = conn.execute(first_query).rowcount
+            else:
+                resolved = [
+                    (conflict(k, old_val, new_val), k)
+                    for k, old_val, new_val
+                    in conn.execute(conflicts_query)
+                ]
+                count = conn.execute(first_query).rowcount
+                count += conn.executemany(
+                    _MERGE_RESOLVE_QUERY, resolved
+                ).rowcount
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute(_DETACH_QUERY)
+        counts.append(count)
+
+    if compact:
+        conn.execute(_VACUUM_QUERY)
+    conn.close()
+
+    return counts
+
+def diff(old_path, new_path, values=True):
+    """Iterate over the differences between the databases at `old_path` and
+    `new_path`, as (change, key, old_val, new_val) tuples where `change` is
+    one of 'removed', 'changed' or 'added'.
+
+    Values are compared inside SQLite and results are streamed, so neither
+    database is loaded into memory.  Removed and changed keys come first, in
+    key order, followed by the added keys, in key order.  If `values` is
+    False, the values are not read out and old_val and new_val are None,
+    which is much cheaper when only the keys are wanted.  Expired keys are
+    treated as missing.
+    """
+    new_path = os.path.abspath(new_path)
+    if not os.path.exists(new_path):
+        raise error('DB does not exist at %s' % (new_path,))
+
+    if values:
+        columns = {'old_val': 'kv_table.val', 'new_val': 'new_kv.val'}
+    else:
+        columns = {'old_val': 'NULL', 'new_val': 'NULL'}
+
+    smap = SqliteMap(old_path, flag='r')
+    conn = smap.conn
+    conn.execute(_ATTACH_DIFF_QUERY, (new_path,))
+    # Files that predate TTLs have no expires column to filter on
+    columns['old_live'] = _NOT_EXPIRED if smap.has_expiry else '1'
+    if _has_column(conn, 'expires', 'diff_new'):
+        columns['new_live'] = _DIFF_NEW_NOT_EXPIRED
+    else:
+        columns['new_live'] = '1'
+    # Closing the connection also detaches the new DB, even if the caller
+    # stops iterating early and a query is still open
+    try:
+        old_query = _DIFF_OLD_QUERY_TEMPLATE % columns
+        for k, old_val, removed, new_val in conn.execute(old_query):
+            if removed:
+                yield ('removed', k, old_val, None)
+            else:
+                yield ('changed', k, old_val, new_val)
+
+        for k, new_val in conn.execute(_DIFF_ADDED_QUERY_TEMPLATE % columns):
+            yield ('added', k, None, new_val)
+    finally:
+        conn.close()
+
+def restore(filename, backup_path, mode=0666, table=DEFAULT_TABLE):
+    """Replace the contents of the database at `filename` with those of the
+    backup at `backup_path`, creating the database if needed.
+
+    The restore happens in a single transaction, so other connections to
+    `filename` see either the old contents or the restored ones.  Expiry
+    times are restored too.  Returns the number of rows restored.
+
+    The optional `table` argument names the map to restore, for backups of
+    maps opened with a `table`.  It is read from the table of the same name
+    in the backup.
+    """
+    smap = SqliteMap(filename, flag='c', mode=mode, table=table)
+    conn = smap.conn
+
+    conn.execute(_ATTACH_QUERY, (os.path.abspath(backup_path),))
+    try:
+        conn.execute(_RESTORE_CLEAR_QUERY)
+        if _has_column(conn, 'expires', 'merge_src'):
+            count = conn.execute(_RESTORE_TTL_QUERY).rowcount
+        else:
+            count = conn.execute(_MERGE_LAST_QUERY).rowcount
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute(_DETACH_QUERY)
+    conn.close()
+
+    return count
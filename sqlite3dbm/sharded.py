@@ -0,0 +1,498 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A dictionary hash-partitioned over several SqliteMap files.
+
+Each SQLite file has a single writer and a single B-tree.  Spreading the
+keys over N files gives N independent writers and keeps each file a
+manageable size.  The shards live in one directory and a key always hashes
+to the same shard, so the directory can be reopened later (by any process)
+with the same number of shards.
+
+Bulk operations (`update`, `get_many`/`select`, `items`, `clear`) group keys
+by shard and can be run on all shards at once in threads or processes by
+passing `parallel='thread'` or `parallel='process'`.  Each worker opens its
+own connection, since sqlite3 connections cannot be shared across threads.
+
+Usage Example:
+>>> import sqlite3dbm.sharded
+>>> db = sqlite3dbm.sharded.open('mydb_shards', num_shards=8, flag='c')
+>>> db.update({'foo': 'one', 'bar': 'two', 'baz': 'three'})
+>>> db.get_many('foo', 'bar', 'qux')
+['one', 'two', None]
+>>> shelf = sqlite3dbm.sharded.open_shelf('myshelf_shards', num_shards=8)
+>>> shelf['foo'] = [1, 2, 3]
+"""
+
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import os
+import re
+import zlib
+from UserDict import DictMixin
+
+import sqlite3dbm.dbm
+import sqlite3dbm.sshelve
+from sqlite3dbm.dbm import error, _key_gen, _utf8
+
+__all__ = [
+    'ShardedSqliteMap',
+    'ShardedSqliteMapShelf',
+    'open',
+    'open_shelf',
+]
+
+# Shard files are named by their index inside the shard directory
+_SHARD_FILE_TEMPLATE = 'shard-%05d.sqlite3'
+# Matches the shard files only, not their journals
+_SHARD_FILE_RE = re.compile(r'^shard-\d{5}\.sqlite3$')
+
+# Unique sentinel so we can tell missing values from None values
+__MISSING_SENTINEL__ = ('__missing__',)
+
+# Keys looked up per round by get_many_iter
+_ITER_CHUNK_SIZE = sqlite3dbm.dbm.SQLITE_MAX_QUERY_VARS
+
+def shard_for_key(k, num_shards):
+    """Index of the shard that `k` lives in.
+
+    Uses crc32 rather than hash() so that the mapping is the same in every
+    process and on every platform.
+    """
+    return (zlib.crc32(_utf8(k)) & 0xffffffff) % num_shards
+
+## Per-shard workers.  These are module-level functions so that they can be
+## pickled and sent to a process pool.  Each opens its own connection.
+
+def _shard_update(args):
+    path, rows = args
+    sqlite3dbm.dbm.SqliteMap(path, flag='w').update(rows)
+
+def _found_values(smap, keys):
+    """get_many() on `smap` as a list of (found, value) pairs.
+
+    The sentinel cannot be used to mark missing keys in results that come
+    back from another process, since it does not survive pickling.
+    """
+    return [
+        (v is not __MISSING_SENTINEL__, v)
+        for v in smap.get_many(keys, default=__MISSING_SENTINEL__)
+    ]
+
+def _shard_get_many(args):
+    path, keys = args
+    return _found_values(sqlite3dbm.dbm.SqliteMap(path), keys)
+
+def _shard_items(path):
+    return sqlite3dbm.dbm.SqliteMap(path).items()
+
+def _shard_clear(path):
+    sqlite3dbm.dbm.SqliteMap(path, flag='w').clear()
+
+
+class ShardedSqliteMap(DictMixin):
+    """Dictionary interface backed by `num_shards` SqliteMap files.
+
+    `path` is the directory that holds the shard files.  See `open` for an
+    explanation of the other parameters.
+
+    Like SqliteMap, this only accepts string key/values and is not
+    threadsafe.
+    """
+
+    def __init__(self, path, num_shards=None, flag='r', mode=0666,
+                 parallel=None, workers=None):
+        if flag not in ('c', 'n', 'w', 'r'):
+            raise error('Invalid flag "%s"' % (flag,))
+        if parallel not in (None, 'thread', 'process'):
+            raise error('Invalid parallel mode "%s"' % (parallel,))
+
+        self.path = os.path.abspath(path)
+        self.readonly = flag == 'r'
+        self.parallel = parallel
+        self.workers = workers
+
+        if not os.path.isdir(self.path):
+            if flag in ('r', 'w'):
+                raise error('Sharded DB does not exist at %s' % (self.path,))
+            os.makedirs(self.path)
+
+        existing = len([
+            name for name in os.listdir(self.path)
+            if _SHARD_FILE_RE.match(name)
+        ])
+        if num_shards is None:
+            if not existing:
+                raise error('num_shards is required to create a sharded DB')
+            num_shards = existing
+        elif existing and existing != num_shards:
+            raise error(
+                'Sharded DB at %s has %d shards, not %d' % (
+                    self.path, existing, num_shards
+                )
+            )
+        self.num_shards = num_shards
+
+        self.shard_paths = [
+            os.path.join(self.path, _SHARD_FILE_TEMPLATE % (i,))
+            for i in xrange(num_shards)
+        ]
+        self.shards = [
+            sqlite3dbm.dbm.SqliteMap(shard_path, flag=flag, mode=mode)
+            for shard_path in self.shard_paths
+        ]
+
+    def _shard(self, k):
+        return self.shards[shard_for_key(k, self.num_shards)]
+
+    def _map(self, func, args):
+        """Run `func` over `args`, one call per shard, maybe in parallel."""
+        if self.parallel is None:
+            return map(func, args)
+
+        if self.parallel == 'thread':
+            pool = multiprocessing.pool.ThreadPool(
+                self.workers or self.num_shards
+            )
+        else:
+            pool = multiprocessing.Pool(self.workers)
+        try:
+            return pool.map(func, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _group_by_shard(self, items, key=lambda item: item):
+        """Split `items` into one list per shard, preserving order."""
+        groups = [[] for _ in xrange(self.num_shards)]
+        for item in items:
+            groups[shard_for_key(key(item), self.num_shards)].append(item)
+        return groups
+
+    def __setitem__(self, k, v):
+        """x.__setitem__(k, v) <==> x[k] = v"""
+        if self.readonly:
+            raise error('DB is readonly')
+        self._shard(k)[k] = v
+
+    def __getitem__(self, k):
+        """x.__getitem__(k) <==> x[k]
+
+        Like SqliteMap, this also works on lists of keys.
+        """
+        if hasattr(k, '__iter__'):
+            return self.select(k)
+        return self._shard(k)[k]
+
+    def __delitem__(self, k):
+        """x.__delitem__(k) <==> del x[k]"""
+        if self.readonly:
+            raise error('DB is readonly')
+        del self._shard(k)[k]
+
+    def set(self, k, v, ttl=sqlite3dbm.dbm.__TTL_SENTINEL__):
+        """D.set(k, v[, ttl]) -> None.  Set D[k] = v, expiring in `ttl`
+        seconds.  See :meth:`sqlite3dbm.dbm.SqliteMap.set`.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+        self._shard(k).set(k, v, ttl)
+
+    def delete_many(self, keys, missing_ok=True):
+        """Delete all of `keys` and return the number of keys deleted.
+
+        Each shard deletes its keys in one transaction, but the shards are
+        not updated atomically together.  If `missing_ok` is False, every
+        key is looked up first and KeyError is raised (and nothing is
+        deleted) if any of them are missing.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        keys = list(keys)
+        if not missing_ok:
+            self.select(keys)
+
+        return sum(
+            shard.delete_many(group)
+            for shard, group in zip(self.shards, self._group_by_shard(keys))
+            if group
+        )
+
+    def delete_range(self, start=None, stop=None):
+        """Delete every key k with start <= k < stop and return the number of
+        keys deleted.  Either bound may be None, for no bound.
+
+        Every shard is searched, one transaction per shard.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+        return sum(shard.delete_range(start, stop) for shard in self.shards)
+
+    def delete_prefix(self, prefix):
+        """Delete every key starting with `prefix` and return the number of
+        keys deleted.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+        return sum(shard.delete_prefix(prefix) for shard in self.shards)
+
+    def __contains__(self, k):
+        """D.__contains__(k) -> True if D has a key k, else False"""
+        return k in self._shard(k)
+
+    def has_key(self, k):
+        """D.has_key(k) -> True if D has a key k, else False."""
+        return k in self
+
+    def __len__(self):
+        """x.__len__() <==> len(x)"""
+        return sum(len(shard) for shard in self.shards)
+
+    def clear(self):
+        """D.clear() -> None. Remove all items from D."""
+        if self.readonly:
+            raise error('DB is readonly')
+
+        if self.parallel is None:
+            for shard in self.shards:
+                shard.clear()
+        else:
+            self._map(_shard_clear, self.shard_paths)
+
+    def popitem(self):
+        """D.popitem() -> (k, v), remove and return some (key, value) pair as a
+        2-tuple; but raise KeyError if D is empty
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        for shard in self.shards:
+            if len(shard):
+                return shard.popitem()
+        raise KeyError('popitem(): sharded DB is empty')
+
+    def get_many(self, *args, **kwargs):
+        """Same as :meth:`sqlite3dbm.dbm.SqliteMap.get_many`, with each shard
+        queried once for all of its keys.
+        """
+        default = kwargs.pop('default', None)
+        if kwargs:
+            raise TypeError(
+                'Got an unexpected keyword argument: %r' % (kwargs,)
+            )
+
+        keys = []
+        for arg in args:
+            if hasattr(arg, '__iter__'):
+                keys.extend(arg)
+            else:
+                keys.append(arg)
+
+        groups = self._group_by_shard(keys)
+        if self.parallel is None:
+            shard_vals = [
+                _found_values(shard, group)
+                for shard, group in zip(self.shards, groups)
+            ]
+        else:
+            shard_vals = self._map(
+                _shard_get_many, zip(self.shard_paths, groups)
+            )
+
+        # Put the results back into the order the keys were requested in
+        shard_iters = [iter(vals) for vals in shard_vals]
+        result = []
+        for k in keys:
+            found, v = shard_iters[shard_for_key(k, self.num_shards)].next()
+            result.append(v if found else default)
+        return result
+
+    def get_many_iter(self, *args, **kwargs):
+        """Iterator version of :meth:`get_many`.
+
+        Keys are read from `args` a chunk at a time, and each chunk is
+        looked up with :meth:`get_many`, so huge iterables of keys are
+        handled in constant memory.
+        """
+        default = kwargs.pop('default', None)
+        if kwargs:
+            raise TypeError(
+                'Got an unexpected keyword argument: %r' % (kwargs,)
+            )
+
+        keys = _key_gen(args)
+        while True:
+            chunk = list(itertools.islice(keys, _ITER_CHUNK_SIZE))
+            if not chunk:
+                return
+            for v in self.get_many(chunk, default=default):
+                yield v
+
+    def get_dict(self, *args):
+        """D.get_dict(*keys) -> dict mapping the keys in `keys` that are in
+        D to their values.
+
+        See :meth:`sqlite3dbm.dbm.SqliteMap.get_dict`.  Each shard is
+        queried once for all of its keys.
+        """
+        result = {}
+        groups = self._group_by_shard(_key_gen(args))
+        for shard, group in zip(self.shards, groups):
+            if group:
+                result.update(shard.get_dict(group))
+        return result
+
+    def select(self, *args):
+        """List based version of :meth:`__getitem__`.
+
+        Raises KeyError if any of the keys are missing.
+        """
+        vals = self.get_many(default=__MISSING_SENTINEL__, *args)
+        if __MISSING_SENTINEL__ in vals:
+            raise KeyError('One of the requested keys is missing!')
+        return vals
+
+    def update(self, *args, **kwargs):
+        """D.update(E, **F) -> None.  Update D from E and F: for k in E: D[k] = E[k]
+        (if E has keys else: for (k, v) in E: D[k] = v) then: for k in F: D[k] = F[k]
+
+        Each shard gets all of its rows in a single transaction.
+        """
+        if self.readonly:
+            raise error('DB is readonly')
+
+        rows = []
+        for arg in args:
+            if isinstance(arg, dict):
+                rows.extend(arg.iteritems())
+            else:
+                rows.extend(arg)
+        rows.extend(kwargs.iteritems())
+
+        groups = self._group_by_shard(rows, key=lambda row: row[0])
+        if self.parallel is None:
+            for shard, group in zip(self.shards, groups):
+                if group:
+                    shard.update(group)
+        else:
+            self._map(_shard_update, [
+                (shard_path, group)
+                for shard_path, group in zip(self.shard_paths, groups)
+                if group
+            ])
+
+    ## Iteration
+    def iteritems(self):
+        """D.iteritems() -> an iterator over the (key, value) items of D
+
+        Streams the shards one after the other.  Use :meth:`items` to scan
+        the shards in parallel.
+        """
+        for shard in self.shards:
+            for k, v in shard.iteritems():
+                yield k, v
+
+    def items(self):
+        """D.items() -> list of D's (key, value) pairs, as 2-tuples"""
+        if self.parallel is None:
+            return list(self.iteritems())
+
+        result = []
+        for shard_items in self._map(_shard_items, self.shard_paths):
+            result.extend(shard_items)
+        return result
+
+    def iterkeys(self):
+        """D.iterkeys() -> an iterator over the keys of D"""
+        return (k for k, _ in self.iteritems())
+    def keys(self):
+        """D.keys() -> list of D's keys"""
+        return [k for k, _ in self.items()]
+    def itervalues(self):
+        """D.itervalues() -> an iterator over the values of D"""
+        return (v for _, v in self.iteritems())
+    def values(self):
+        """D.values() -> list of D's values"""
+        return [v for _, v in self.items()]
+    def __iter__(self):
+        """Iterate over the keys of D.  Consistent with dict."""
+        return self.iterkeys()
+
+
+class ShardedSqliteMapShelf(sqlite3dbm.sshelve.SqliteMapShelf):
+    """A :class:`sqlite3dbm.sshelve.SqliteMapShelf` over a
+    :class:`ShardedSqliteMap`.
+
+    The batched shelf methods (`select`, `get_many`, `get_many_iter`,
+    `get_dict`, `update`, `delete_many`, `delete_range`, `delete_prefix`,
+    `clear`) are passed through to the sharded map, so they are grouped per
+    shard too.  Secondary indexes are not supported.
+    """
+
+    def __init__(self, smap, protocol=None, writeback=False):
+        # The shards already return bytestrings, so there is no single
+        # connection to configure.  Skip straight to shelve.Shelf.
+        sqlite3dbm.sshelve.shelve.Shelf.__init__(
+            self, smap, protocol, writeback
+        )
+        self.indexes = {}
+
+    def _no_indexes(self, *args, **kwargs):
+        """Not supported: the index of a shard could only cover the rows
+        in that shard.
+        """
+        raise error(
+            'Secondary indexes are not supported on sharded shelves'
+        )
+
+    add_index = rebuild_index = drop_index = _no_indexes
+    find = find_range = _no_indexes
+
+
+def open(path, num_shards=None, flag='r', mode=0666, parallel=None,
+         workers=None):
+    """Open a sharded database and return a ShardedSqliteMap object.
+
+    The `path` argument is the directory holding the shard files.
+
+    `num_shards` is required when creating a new sharded DB.  When opening
+    an existing one it may be omitted, but if given it must match the number
+    of shards on disk.
+
+    The `flag` and `mode` arguments behave as for :func:`sqlite3dbm.open`,
+    with `mode` applying to every shard file.
+
+    The optional `parallel` argument can be None (the default), 'thread' or
+    'process', and controls how bulk operations are run across shards.
+    `workers` is the size of the thread or process pool.
+    """
+    return ShardedSqliteMap(
+        path, num_shards=num_shards, flag=flag, mode=mode,
+        parallel=parallel, workers=workers,
+    )
+
+def open_shelf(path, num_shards=None, flag='c', mode=0666, protocol=None,
+               writeback=False, parallel=None, workers=None):
+    """Open a persistent sharded dictionary of arbitrary objects.
+
+    The parameters are the same as for :func:`open` and
+    :func:`sqlite3dbm.sshelve.open`.
+    """
+    smap = open(
+        path, num_shards=num_shards, flag=flag, mode=mode,
+        parallel=parallel, workers=workers,
+    )
+    return ShardedSqliteMapShelf(smap, protocol=protocol, writeback=writeback)
@@ -41,6 +41,45 @@ __all__ = [
     'open',
 ]
 
+## Secondary indexes.  Extracted values live in a side table next to
+## kv_table, keyed by (index name, value, key) so that lookups and range
+## queries walk its primary key; the key index is for keeping it up to date.
+## kv_index_names records which indexes have been built.
+_CREATE_INDEX_TABLE = (
+    'CREATE TABLE IF NOT EXISTS kv_index ('
+    'name TEXT NOT NULL, '
+    'ival NOT NULL, '
+    'key TEXT NOT NULL, '
+    'PRIMARY KEY (name, ival, key)) WITHOUT ROWID'
+)
+_CREATE_INDEX_KEY_INDEX = (
+    'CREATE INDEX IF NOT EXISTS kv_index_key ON kv_index (key)'
+)
+_CREATE_INDEX_NAMES_TABLE = (
+    'CREATE TABLE IF NOT EXISTS kv_index_names (name TEXT PRIMARY KEY)'
+)
+_INDEX_BUILT_QUERY = (
+    'SELECT 1 FROM kv_index_names WHERE kv_index_names.name = ?'
+)
+_MARK_INDEX_BUILT_QUERY = (
+    'INSERT OR IGNORE INTO kv_index_names (name) VALUES (?)'
+)
+_UNMARK_INDEX_QUERY = (
+    'DELETE FROM kv_index_names WHERE kv_index_names.name = ?'
+)
+_INSERT_INDEX_QUERY = (
+    'INSERT OR IGNORE INTO kv_index (name, ival, key) VALUES (?, ?, ?)'
+)
+_DEL_INDEX_KEY_QUERY = 'DELETE FROM kv_index WHERE kv_index.key = ?'
+_DEL_INDEX_NAME_QUERY = 'DELETE FROM kv_index WHERE kv_index.name = ?'
+_DEL_INDEX_TEMPLATE = 'DELETE FROM kv_index%s'
+_FIND_QUERY_TEMPLATE = (
+    'SELECT kv_index.key, kv_table.val FROM kv_index '
+    'JOIN kv_table ON kv_table.key = kv_index.key '
+    'WHERE kv_index.name = ?%s '
+    'ORDER BY kv_index.ival, kv_index.key'
+)
+
 class SqliteMapShelf(shelve.Shelf):
     """A subclass of shelve.Shelf supporting sqlite3dbm.
 
@@ -54,13 +93,171 @@ class SqliteMapShelf(shelve.Shelf):
     """
 
     def __init__(self, smap, protocol=None, writeback=False):
-        # Force the Sqlite DB to return bytestrings.  By default it returns
-        # unicode by default, which causes Pickle to shit its pants.
-        smap.conn.text_factory = str
+        # SqliteMap connections already return bytestrings, which Pickle
+        # needs.  Not touching `smap.conn` here keeps the connection lazy.
 
         # SqliteMapShelf < Shelf < DictMixin which is an old style class :-P
         shelve.Shelf.__init__(self, smap, protocol, writeback)
 
+        # Index name => extractor function
+        self.indexes = {}
+
+    ## Secondary indexes
+
+    def add_index(self, name, extractor):
+        """Index the values of the shelf by `extractor(value)`, so that they
+        can be looked up with :meth:`find` and :meth:`find_range`.
+
+        `extractor` should return an int, float or string, or None to leave
+        the value out of the index.  The index is kept up to date by every
+        write through this shelf, in the same transaction as the write.  It
+        is stored in the database, but `extractor` is not, so every shelf
+        that writes to the database must add the same indexes.
+
+        The index is built from the existing values the first time it is
+        added to a database.  Use :meth:`rebuild_index` if the extractor
+        changes.
+        """
+        conn = self.dict.conn
+        conn.execute(_CREATE_INDEX_TABLE)
+        conn.execute(_CREATE_INDEX_KEY_INDEX)
+        conn.execute(_CREATE_INDEX_NAMES_TABLE)
+        conn.commit()
+
+        self.indexes[name] = extractor
+        if conn.execute(_INDEX_BUILT_QUERY, (name,)).fetchone() is None:
+            self.rebuild_index(name)
+
+    def rebuild_index(self, name=None):
+        """Rebuild the index `name` (or every index added to this shelf)
+        from the values in the database, in one transaction.
+        """
+        if name is None:
+            names = list(self.indexes)
+        elif name in self.indexes:
+            names = [name]
+        else:
+            raise sqlite3dbm.dbm.error('No index named "%s"' % (name,))
+
+        conn = self.dict.conn
+        try:
+            for name in names:
+                conn.execute(_DEL_INDEX_NAME_QUERY, (name,))
+                extractor = self.indexes[name]
+                conn.executemany(_INSERT_INDEX_QUERY, (
+                    (name, ival, k)
+                    for k, ival in (
+                        (k, extractor(loads(v)))
+                        for k, v in self.dict.iteritems()
+                    )
+                    if ival is not None
+                ))
+                conn.execute(_MARK_INDEX_BUILT_QUERY, (name,))
+        except:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def drop_index(self, name):
+        """Stop maintaining the index `name` and delete it."""
+        self.indexes.pop(name, None)
+        conn = self.dict.conn
+        conn.execute(_DEL_INDEX_NAME_QUERY, (name,))
+        conn.execute(_UNMARK_INDEX_QUERY, (name,))
+        conn.commit()
+
+    def find(self, name, value):
+        """Return the (key, value) pairs whose values were indexed as
+        `value` by the index `name`, in key order.
+        """
+        return self._find(name, ' AND kv_index.ival = ?', [value])
+
+    def find_range(self, name, start=None, stop=None):
+        """Return the (key, value) pairs whose values were indexed by the
+        index `name` as something in [start, stop), ordered by the indexed
+        value and then the key.  Either bound may be None, for no bound.
+        """
+        conditions = ''
+        params = []
+        if start is not None:
+            conditions += ' AND kv_index.ival >= ?'
+            params.append(start)
+        if stop is not None:
+            conditions += ' AND kv_index.ival < ?'
+            params.append(stop)
+        return self._find(name, conditions, params)
+
+    def _find(self, name, conditions, params):
+        """Look up rows through an index.  The matching rows are read with
+        a single join against kv_table.
+        """
+        if self.dict.has_expiry:
+            conditions += ' AND ' + sqlite3dbm.dbm._NOT_EXPIRED
+        cursor = self.dict.conn.execute(
+            _FIND_QUERY_TEMPLATE % (conditions,), [name] + params
+        )
+        return [(k, loads(v)) for k, v in cursor]
+
+    def _index_rows(self, items):
+        """(name, index value, key) rows for (key, value) `items`."""
+        for name, extractor in self.indexes.iteritems():
+            for k, v in items:
+                ival = extractor(v)
+                if ival is not None:
+                    yield name, ival, k
+
+    def _indexed_write(self, delete_index, insert_items, write):
+        """Call `write` to change the shelf's dict, after running
+        `delete_index` on the connection to drop stale index entries and
+        indexing the new (key, value) `insert_items`.
+
+        The dict's write commits the index changes along with it, and
+        everything is rolled back if anything fails.
+        """
+        if not self.indexes:
+            return write()
+
+        conn = self.dict.conn
+        try:
+            delete_index(conn)
+            if insert_items:
+                conn.executemany(
+                    _INSERT_INDEX_QUERY, self._index_rows(insert_items)
+                )
+            return write()
+        except:
+            conn.rollback()
+            raise
+
+    def _delete_index_range(self, conn, start, stop):
+        """Drop the index entries of the keys in [start, stop)."""
+        conditions = []
+        params = []
+        if start is not None:
+            conditions.append('kv_index.key >= ?')
+            params.append(start)
+        if stop is not None:
+            conditions.append('kv_index.key < ?')
+            params.append(stop)
+        where = ''
+        if conditions:
+            where = ' WHERE ' + ' AND '.join(conditions)
+        conn.execute(_DEL_INDEX_TEMPLATE % (where,), params)
+
+    def __setitem__(self, key, value):
+        self._indexed_write(
+            lambda conn: conn.execute(_DEL_INDEX_KEY_QUERY, (key,)),
+            [(key, value)],
+            lambda: shelve.Shelf.__setitem__(self, key, value),
+        )
+
+    def __delitem__(self, key):
+        self._indexed_write(
+            lambda conn: conn.execute(_DEL_INDEX_KEY_QUERY, (key,)),
+            None,
+            lambda: shelve.Shelf.__delitem__(self, key),
+        )
+
     def get_many(self, *args, **kwargs):
         # Pickle 'default' for consistency when we de-pickle
         default = dumps(kwargs.get('default'))
@@ -77,6 +274,33 @@ class SqliteMapShelf(shelve.Shelf):
             for v in self.dict.select(*args)
         ]
 
+    def get_many_iter(self, *args, **kwargs):
+        """See :meth:`sqlite3dbm.dbm.SqliteMap.get_many_iter`."""
+        kwargs['default'] = dumps(kwargs.get('default'))
+        for v in self.dict.get_many_iter(*args, **kwargs):
+            yield loads(v)
+
+    def get_dict(self, *args):
+        """See :meth:`sqlite3dbm.dbm.SqliteMap.get_dict`."""
+        return dict(
+            (k, loads(v)) for k, v in self.dict.get_dict(*args).iteritems()
+        )
+
+    def set(self, key, value, ttl=sqlite3dbm.dbm.__TTL_SENTINEL__):
+        """Store `value` at `key`, expiring in `ttl` seconds.  See
+        :meth:`sqlite3dbm.dbm.SqliteMap.set`.
+        """
+        def write():
+            if self.writeback:
+                self.cache[key] = value
+            self.dict.set(key, dumps(value, protocol=self._protocol), ttl)
+
+        self._indexed_write(
+            lambda conn: conn.execute(_DEL_INDEX_KEY_QUERY, (key,)),
+            [(key, value)],
+            write,
+        )
+
     # Performance override: we want to batch writes into one transaction
     def update(self, *args, **kwargs):
         # Copied from sqlite3dbm.dbm
@@ -94,26 +318,84 @@ class SqliteMapShelf(shelve.Shelf):
                 yield k, v
         inserts = list(kv_gen())
 
+        def write():
+            if self.writeback:
+                self.cache.update(inserts)
+
+            self.dict.update([
+                (k, dumps(v, protocol=self._protocol))
+                for k, v in inserts
+            ])
+
+        self._indexed_write(
+            lambda conn: conn.executemany(
+                _DEL_INDEX_KEY_QUERY, [(k,) for k, _ in inserts]
+            ),
+            inserts,
+            write,
+        )
+
+    def delete_many(self, keys, missing_ok=True):
+        """See :meth:`sqlite3dbm.dbm.SqliteMap.delete_many`."""
+        keys = list(keys)
+        deleted = self._indexed_write(
+            lambda conn: conn.executemany(
+                _DEL_INDEX_KEY_QUERY, [(k,) for k in keys]
+            ),
+            None,
+            lambda: self.dict.delete_many(keys, missing_ok=missing_ok),
+        )
         if self.writeback:
-            self.cache.update(inserts)
+            for k in keys:
+                self.cache.pop(k, None)
+        return deleted
 
-        self.dict.update([
-            (k, dumps(v, protocol=self._protocol))
-            for k, v in inserts
-        ])
+    def delete_range(self, start=None, stop=None):
+        """See :meth:`sqlite3dbm.dbm.SqliteMap.delete_range`."""
+        if self.writeback:
+            for k in self.cache.keys():
+                if ((start is None or k >= start) and
+                    (stop is None or k < stop)):
+                    del self.cache[k]
+
+        return self._indexed_write(
+            lambda conn: self._delete_index_range(conn, start, stop),
+            None,
+            lambda: self.dict.delete_range(start, stop),
+        )
+
+    def delete_prefix(self, prefix):
+        """See :meth:`sqlite3dbm.dbm.SqliteMap.delete_prefix`."""
+        if self.writeback:
+            for k in self.cache.keys():
+                if k.startswith(prefix):
+                    del self.cache[k]
+        return self._indexed_write(
+            lambda conn: self._delete_index_range(
+                conn, prefix or None, sqlite3dbm.dbm._prefix_end(prefix)
+            ),
+            None,
+            lambda: self.dict.delete_prefix(prefix),
+        )
 
     # Performance override: clear in one sqlite command
     def clear(self):
-        self.dict.clear()
+        self._indexed_write(
+            lambda conn: conn.execute(_DEL_INDEX_TEMPLATE % ('',)),
+            None,
+            self.dict.clear,
+        )
 
-def open(filename, flag='c', mode=0666, protocol=None, writeback=False):
+def open(filename, flag='c', mode=0666, protocol=None, writeback=False,
+         table=sqlite3dbm.dbm.DEFAULT_TABLE):
     """Open a persistent sqlite3-backed dictionary.  The *filename* specificed
     is the path to the underlying database.
 
-    The *flag* and *mode* parameters have the same semantics as sqlite3dbm.open
-    (and, in fact, are directly passed through to this function).
+    The *flag*, *mode* and *table* parameters have the same semantics as
+    sqlite3dbm.open (and, in fact, are directly passed through to this
+    function).
 
     The *protocl* and *writeback* parameters behave as outlined in shelve.open.
     """
-    smap = sqlite3dbm.dbm.open(filename, flag=flag, mode=mode)
+    smap = sqlite3dbm.dbm.open(filename, flag=flag, mode=mode, table=table)
     return SqliteMapShelf(smap, protocol=protocol, writeback=writeback)
@@ -0,0 +1,383 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A single-writer service for sharing one SqliteMap between processes.
+
+SQLite allows only one writer at a time, so many processes writing to the
+same file spend their time fighting over the database lock (and eventually
+see "database is locked" errors).  This module funnels all writes through a
+dedicated process that owns the only writing connection.  Clients push
+their writes onto a `multiprocessing` queue and the writer applies whatever
+has piled up in a single transaction (a group commit).  Reads do not go
+through the writer at all; clients read the file directly.
+
+Writes are asynchronous: a client only sees its own writes once the writer
+has committed them.  Call :meth:`WriterClient.flush` to wait for that.  Each
+queued write is applied under its own savepoint, so one that fails is
+dropped without taking the rest of its group commit down with it.  A group
+commit that finds the database locked by another connection is retried
+until it goes through.
+
+Usage Example:
+>>> import sqlite3dbm.writer
+>>> service = sqlite3dbm.writer.WriterService('mydb.sqlite3')
+>>> service.start()
+>>>
+>>> # Hand `service` to worker processes (eg. through multiprocessing.Process)
+>>> db = service.client()
+>>> db['foo'] = 'bar'
+>>> db.update({'baz': 'qux'})
+>>> db.flush()
+>>> db['foo']
+'bar'
+>>>
+>>> service.stop()
+"""
+
+import multiprocessing
+import Queue
+import sqlite3
+import threading
+import time
+
+import sqlite3dbm.dbm
+from sqlite3dbm.dbm import error
+
+__all__ = [
+    'WriterService',
+    'WriterClient',
+]
+
+# Maximum number of queued messages applied in one transaction
+DEFAULT_MAX_BATCH = 1000
+
+# Milliseconds the writer waits on a lock before giving up on a batch
+_BUSY_TIMEOUT = 5000
+
+# Seconds the writer waits before retrying a batch that hit a lock, doubling
+# up to the maximum on every attempt
+_RETRY_DELAY = 0.01
+_MAX_RETRY_DELAY = 1.0
+
+# Seconds between checks that the writer is still alive, while flushing
+_FLUSH_POLL_INTERVAL = 0.1
+
+# Message types understood by the writer process
+_SET = 'set'
+_UPDATE = 'update'
+_DEL = 'del'
+_CLEAR = 'clear'
+_STOP = 'stop'
+
+# Unique sentinel to tell when `pop` was called without a default
+__POP_SENTINEL__ = ('__pop__',)
+
+def _apply(conn, op, arg):
+    """Apply a single queued write to `conn` without committing."""
+    if op == _SET:
+        conn.execute(sqlite3dbm.dbm._SET_QUERY, arg)
+    elif op == _UPDATE:
+        conn.executemany(sqlite3dbm.dbm._SET_QUERY, arg)
+    elif op == _DEL:
+        conn.execute(sqlite3dbm.dbm._DEL_QUERY, (arg,))
+    elif op == _CLEAR:
+        conn.execute('DELETE FROM kv_table')
+    else:
+        raise error('Unknown writer message "%s"' % (op,))
+
+def _is_transient(e):
+    """True if `e` only means that another connection held a lock."""
+    return (isinstance(e, sqlite3.OperationalError) and
+            ('locked' in str(e) or 'busy' in str(e)))
+
+def _apply_batch(conn, batch):
+    """Apply the messages in `batch` in one transaction and commit it.
+
+    Every message is applied under a savepoint, so a bad one only drops
+    itself.  Errors from lock contention are raised instead, so that the
+    whole batch can be retried.  Returns (number of failed messages,
+    whether a stop message was seen).
+    """
+    failed = 0
+    running = True
+    conn.execute(sqlite3dbm.dbm._BEGIN_QUERY)
+    for message in batch:
+        conn.execute(sqlite3dbm.dbm._SAVEPOINT_QUERY % (1,))
+        try:
+            op, arg = message
+            if op == _STOP:
+                running = False
+            else:
+                _apply(conn, op, arg)
+        except Exception, e:
+            if _is_transient(e):
+                raise
+            # There is nobody to raise to, so count the failure for the
+            # clients to find when they flush.
+            conn.execute(sqlite3dbm.dbm._ROLLBACK_TO_QUERY % (1,))
+            failed += 1
+        conn.execute(sqlite3dbm.dbm._RELEASE_QUERY % (1,))
+    conn.execute(sqlite3dbm.dbm._COMMIT_QUERY)
+    return failed, running
+
+def _writer_loop(path, queue, max_batch, failures, alive_conn):
+    """Body of the writer process.
+
+    Blocks for one message, then drains whatever else is already waiting (up
+    to `max_batch` messages) and commits it all at once.  A batch that runs
+    into another connection's lock is rolled back and retried, backing off,
+    until it commits.
+
+    `alive_conn` is held open for as long as the process runs, so that
+    flushes can tell when the writer has died.
+    """
+    smap = sqlite3dbm.dbm.SqliteMap(path, flag='w')
+    conn = smap.conn
+    # Transactions are managed by hand, since pysqlite would otherwise
+    # commit before every SAVEPOINT
+    conn.isolation_level = None
+    conn.execute(sqlite3dbm.dbm._SET_BUSY_TIMEOUT_QUERY % (_BUSY_TIMEOUT,))
+
+    running = True
+    while running:
+        batch = [queue.get()]
+        while len(batch) < max_batch:
+            try:
+                batch.append(queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        failed = 0
+        delay = _RETRY_DELAY
+        try:
+            while True:
+                try:
+                    failed, running = _apply_batch(conn, batch)
+                    break
+                except sqlite3.Error, e:
+                    sqlite3dbm.dbm._rollback_quietly(
+                        conn, sqlite3dbm.dbm._ROLLBACK_QUERY
+                    )
+                    if not _is_transient(e):
+                        # The whole batch is lost
+                        failed = len(batch)
+                        running = (_STOP, None) not in batch
+                        break
+                time.sleep(delay)
+                delay = min(delay * 2, _MAX_RETRY_DELAY)
+        finally:
+            if failed:
+                with failures.get_lock():
+                    failures.value += failed
+            for _ in batch:
+                queue.task_done()
+
+    conn.close()
+    alive_conn.close()
+
+def _flush(service, owner):
+    """Block until every write queued on `service` so far has been applied.
+
+    Raises error if any writes failed since `owner` last flushed, or if the
+    writer process stops before the writes are applied.
+    """
+    joined = threading.Event()
+    def join():
+        service.queue.join()
+        joined.set()
+    joiner = threading.Thread(target=join)
+    joiner.daemon = True
+    joiner.start()
+
+    while not joined.wait(_FLUSH_POLL_INTERVAL):
+        if not service.is_alive():
+            raise error('Writer process is not running')
+
+    failed = service.failures.value
+    new_failures = failed - owner._failures_seen
+    owner._failures_seen = failed
+    if new_failures:
+        raise error(
+            'Writer failed to apply %d writes since the last flush' % (
+                new_failures,
+            )
+        )
+
+
+class WriterService(object):
+    """Owns the writer process for the SQLite DB at `path`.
+
+    The DB is created if it does not already exist.  The service must be
+    started before it is handed to other processes so that they inherit the
+    queue.
+
+    `max_batch` bounds how many queued writes go into one commit.
+    """
+
+    def __init__(self, path, mode=0666, max_batch=DEFAULT_MAX_BATCH):
+        # Make sure the file and table exist before any client opens it
+        smap = sqlite3dbm.dbm.SqliteMap(path, flag='c', mode=mode)
+        self.path = smap.path
+        smap.conn.close()
+
+        self.max_batch = max_batch
+        self.queue = multiprocessing.JoinableQueue()
+        self.failures = multiprocessing.Value('i', 0)
+        self._failures_seen = 0
+        self.process = None
+        self._alive_conn = None
+
+    def start(self):
+        """Spawn the writer process."""
+        if self.process is not None:
+            raise error('Writer is already running')
+
+        # Only the writer keeps the sending end open, so the receiving end
+        # sees EOF once the writer has gone, in whichever process checks
+        self._alive_conn, writer_conn = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=_writer_loop,
+            args=(
+                self.path, self.queue, self.max_batch, self.failures,
+                writer_conn,
+            ),
+        )
+        self.process.daemon = True
+        self.process.start()
+        writer_conn.close()
+
+    def is_alive(self):
+        """Return True if the writer process is running.
+
+        This works from any process the service was handed to.
+        """
+        # Nothing is ever sent, so the pipe only becomes readable at EOF
+        return self._alive_conn is not None and not self._alive_conn.poll()
+
+    def stop(self):
+        """Commit everything still queued and shut down the writer process."""
+        if self.process is None:
+            return
+
+        self.queue.put((_STOP, None))
+        self.process.join()
+        self.process = None
+        self._alive_conn.close()
+        self._alive_conn = None
+
+    def put(self, op, arg=None):
+        """Queue a write for the writer process."""
+        self.queue.put((op, arg))
+
+    def flush(self):
+        """Block until every write queued so far has been committed.
+
+        Raises error if any writes (queued by any client) failed since the
+        last call to flush, or if the writer process has died.  The writes
+        that did not fail are committed.
+        """
+        _flush(self, self)
+
+    def client(self):
+        """Return a :class:`WriterClient` that writes through this service."""
+        return WriterClient(self)
+
+
+class WriterClient(sqlite3dbm.dbm.SqliteMap):
+    """A SqliteMap whose writes are sent to a :class:`WriterService`.
+
+    Reads go straight to the file and only see committed data, so a client
+    does not see its own writes until they have been flushed.  Deleting a
+    key that has not been committed yet raises KeyError, just as for any
+    other missing key.
+
+    Only setting (without a TTL), updating, deleting, popping and clearing
+    go through the writer.  The client's own connection is read-only, so the
+    other writes (incr, append, the batch deletes, streams and so on) raise
+    error.
+    """
+
+    def __init__(self, service):
+        sqlite3dbm.dbm.SqliteMap.__init__(self, service.path, flag='r')
+        self.service = service
+        # Failures from before the client existed are not its business
+        self._failures_seen = service.failures.value
+
+    def __setitem__(self, k, v):
+        """x.__setitem__(k, v) <==> x[k] = v"""
+        self.service.put(_SET, (k, v))
+
+    def set(self, k, v, ttl=None):
+        """D.set(k, v) -> None.  Set D[k] = v.
+
+        The writer does not support TTLs, so `ttl` must be None.
+        """
+        if ttl is not None:
+            raise error('WriterClient does not support TTLs')
+        self.service.put(_SET, (k, v))
+
+    def __delitem__(self, k):
+        """x.__delitem__(k) <==> del x[k]"""
+        # Raise KeyError for missing keys like a dict would
+        self[k]
+
+        self.service.put(_DEL, k)
+
+    def pop(self, k, d=__POP_SENTINEL__):
+        """D.pop(k[,d]) -> v, remove specified key and return the corresponding value.
+        If key is not found, d is returned if given, otherwise KeyError is raised.
+        """
+        try:
+            val = self[k]
+        except KeyError:
+            if d is __POP_SENTINEL__:
+                raise
+            return d
+
+        self.service.put(_DEL, k)
+        return val
+
+    def setdefault(self, k, d=None):
+        """D.setdefault(k[,d]) -> D.get(k,d), also set D[k]=d if k not in D"""
+        try:
+            return self[k]
+        except KeyError:
+            self[k] = d
+            return d
+
+    def clear(self):
+        """D.clear() -> None. Remove all items from D."""
+        self.service.put(_CLEAR)
+
+    def update(self, *args, **kwargs):
+        """D.update(E, **F) -> None.  Update D from E and F: for k in E: D[k] = E[k]
+        (if E has keys else: for (k, v) in E: D[k] = v) then: for k in F: D[k] = F[k]
+        """
+        rows = []
+        for arg in args:
+            if isinstance(arg, dict):
+                rows.extend(arg.iteritems())
+            else:
+                rows.extend(arg)
+        rows.extend(kwargs.iteritems())
+
+        self.service.put(_UPDATE, rows)
+
+    def flush(self):
+        """Block until all queued writes have been committed.
+
+        Raises error if any writes failed since this client last flushed,
+        or if the writer process has died.
+        """
+        _flush(self.service, self)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test the constant database export and reader"""
+
+import os
+import shutil
+import tempfile
+
+import testify
+
+import sqlite3dbm.cdb
+import sqlite3dbm.dbm
+
+class TestCdbMap(testify.TestCase):
+    @testify.setup
+    def export_map(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sqlite_path = os.path.join(self.tmpdir, 'test_db.sqlite')
+        self.cdb_path = os.path.join(self.tmpdir, 'test_db.cdb')
+
+        self.d = dict(('key%d' % i, 'val%d' % i) for i in xrange(1000))
+        self.d[u'café'.encode('utf-8')] = 'unicode'
+        self.d['empty'] = ''
+        smap = sqlite3dbm.dbm.open(self.sqlite_path, flag='c')
+        smap.update(self.d)
+
+        testify.assert_equal(
+            sqlite3dbm.cdb.export(self.sqlite_path, self.cdb_path),
+            len(self.d)
+        )
+        self.cdb = sqlite3dbm.cdb.open(self.cdb_path)
+
+    @testify.teardown
+    def teardown_map(self):
+        self.cdb.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_getitem(self):
+        for k, v in self.d.iteritems():
+            testify.assert_equal(self.cdb[k], v)
+        testify.assert_equal(self.cdb[u'café'], 'unicode')
+        testify.assert_raises(KeyError, lambda: self.cdb['nope'])
+
+    def test_contains_and_get(self):
+        testify.assert_in('key1', self.cdb)
+        testify.assert_not_in('nope', self.cdb)
+        testify.assert_equal(self.cdb.get('nope', 'd'), 'd')
+        testify.assert_equal(self.cdb.get('empty'), '')
+
+    def test_get_many_and_select(self):
+        testify.assert_equal(
+            self.cdb.get_many('key1', ['key2', 'nope'], default=''),
+            ['val1', 'val2', '']
+        )
+        testify.assert_equal(self.cdb['key3', 'key4'], ['val3', 'val4'])
+        testify.assert_raises(
+            KeyError,
+            lambda: self.cdb.select('key1', 'nope')
+        )
+
+    def test_iteration(self):
+        testify.assert_equal(len(self.cdb), len(self.d))
+        testify.assert_equal(dict(self.cdb.iteritems()), self.d)
+        testify.assert_equal(set(self.cdb), set(self.d))
+        testify.assert_equal(sorted(self.cdb.values()), sorted(self.d.values()))
+
+    def test_zero_copy(self):
+        cdb = sqlite3dbm.cdb.open(self.cdb_path, zero_copy=True)
+        val = cdb['key1']
+        testify.assert_equal(type(val), buffer)
+        testify.assert_equal(str(val), 'val1')
+        testify.assert_equal(str(val[:3]), 'val')
+
+    def test_empty_db(self):
+        empty_path = os.path.join(self.tmpdir, 'empty.sqlite')
+        empty_cdb_path = os.path.join(self.tmpdir, 'empty.cdb')
+        sqlite3dbm.dbm.open(empty_path, flag='c')
+        sqlite3dbm.cdb.export(empty_path, empty_cdb_path)
+
+        cdb = sqlite3dbm.cdb.open(empty_cdb_path)
+        testify.assert_equal(len(cdb), 0)
+        testify.assert_not_in('foo', cdb)
+        testify.assert_equal(cdb.items(), [])
+
+    def test_typed_values(self):
+        typed_path = os.path.join(self.tmpdir, 'typed.sqlite')
+        typed_cdb_path = os.path.join(self.tmpdir, 'typed.cdb')
+        typed = sqlite3dbm.dbm.open(typed_path, flag='c', codec='int')
+        typed['a'] = 1
+
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.cdb.export(typed_path, typed_cdb_path)
+        )
+        testify.assert_equal(os.listdir(self.tmpdir).count('typed.cdb'), 0)
+        testify.assert_equal(
+            os.listdir(self.tmpdir).count('typed.cdb.export'), 0
+        )
+
+        arrays_path = os.path.join(self.tmpdir, 'arrays.sqlite')
+        arrays = sqlite3dbm.dbm.open(arrays_path, flag='c', codec='array')
+        arrays['a'] = [1.0, 2.0]
+        sqlite3dbm.cdb.export(arrays_path, typed_cdb_path)
+        cdb = sqlite3dbm.cdb.open(typed_cdb_path)
+        testify.assert_equal(
+            list(arrays.codec.decode(cdb['a'])), [1.0, 2.0]
+        )
+        cdb.close()
+
+    def test_without_64_bit_arrays(self):
+        # As on platforms where a C long is 32 bits
+        other_path = os.path.join(self.tmpdir, 'other.cdb')
+        typecode = sqlite3dbm.cdb._UINT64_TYPECODE
+        sqlite3dbm.cdb._UINT64_TYPECODE = None
+        try:
+            sqlite3dbm.cdb.export(self.sqlite_path, other_path)
+        finally:
+            sqlite3dbm.cdb._UINT64_TYPECODE = typecode
+
+        testify.assert_equal(
+            open(other_path, 'rb').read(), open(self.cdb_path, 'rb').read()
+        )
+
+    def test_not_a_cdb(self):
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.cdb.open(self.sqlite_path)
+        )
+
+
+if __name__ == '__main__':
+    testify.run()
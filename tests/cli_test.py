@@ -0,0 +1,179 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test the command-line tool"""
+
+import dumbdbm
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+import testify
+
+import sqlite3dbm.cli
+import sqlite3dbm.dbm
+
+class TestCli(testify.TestCase):
+    @testify.setup
+    def create_tmpdir(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cli_test.sqlite')
+        self.d = {
+            'b': 'two',
+            'a': 'one',
+            'tab\tkey': 'new\nline',
+            'binary': '\x00\xff',
+            'user:1': 'x',
+            'user:2': 'y',
+        }
+
+    @testify.teardown
+    def remove_tmpdir(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_cli(self, argv, stdin=''):
+        stdout = StringIO()
+        stderr = StringIO()
+        status = sqlite3dbm.cli.main(argv, StringIO(stdin), stdout, stderr)
+        return status, stdout.getvalue(), stderr.getvalue()
+
+    def test_tsv_round_trip(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='c')
+        smap.update(self.d)
+
+        status, out, err = self.run_cli(['export', self.path])
+        testify.assert_equal(status, 0)
+        testify.assert_equal(err, '\rExported 6 rows\n')
+        testify.assert_equal(len(out.splitlines()), 6)
+
+        copy_path = os.path.join(self.tmpdir, 'copy.sqlite')
+        status, _, err = self.run_cli(
+            ['import', '-b', '4', copy_path], stdin=out
+        )
+        testify.assert_equal(status, 0)
+        testify.assert_equal(err, '\rImported 6 rows\n')
+        testify.assert_equal(dict(sqlite3dbm.dbm.open(copy_path)), self.d)
+
+    def check_round_trip(self, fmt, d):
+        sqlite3dbm.dbm.open(self.path, flag='n').update(d)
+        dump_path = os.path.join(self.tmpdir, 'dump.' + fmt)
+        copy_path = os.path.join(self.tmpdir, 'copy.' + fmt)
+
+        status, _, _ = self.run_cli(
+            ['export', '-q', '-f', fmt, '-o', dump_path, self.path]
+        )
+        testify.assert_equal(status, 0)
+        status, _, _ = self.run_cli(
+            ['import', '-q', '-f', fmt, copy_path, dump_path]
+        )
+        testify.assert_equal(status, 0)
+        testify.assert_equal(dict(sqlite3dbm.dbm.open(copy_path)), d)
+
+    def test_pickle_round_trip(self):
+        self.check_round_trip('pickle', self.d)
+
+    def test_jsonl_round_trip(self):
+        # JSON can only hold utf-8 data
+        del self.d['binary']
+        self.d['unicode'] = u'caf\xe9'.encode('utf-8')
+        self.check_round_trip('jsonl', self.d)
+
+    def test_jsonl_export_of_binary_data(self):
+        sqlite3dbm.dbm.open(self.path, flag='c').update(self.d)
+        status, _, err = self.run_cli(
+            ['export', '-q', '-f', 'jsonl', '--sorted', self.path]
+        )
+        testify.assert_equal(status, 1)
+        testify.assert_in("key 'binary' as jsonl", err)
+
+    def test_export_of_numbers(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='c', codec='int')
+        smap['a'] = 1
+        for fmt in sorted(sqlite3dbm.cli.FORMATS):
+            status, out, err = self.run_cli(
+                ['export', '-q', '-f', fmt, self.path]
+            )
+            testify.assert_equal(status, 1)
+            testify.assert_equal(out, '')
+            testify.assert_in("int value of 'a'", err)
+
+    def test_sorted_and_prefix_export(self):
+        sqlite3dbm.dbm.open(self.path, flag='c').update(self.d)
+
+        _, out, _ = self.run_cli(['export', '-q', '--sorted', self.path])
+        keys = [line.split('\t')[0] for line in out.splitlines()]
+        testify.assert_equal(
+            keys,
+            [k.encode('string_escape') for k in sorted(self.d)]
+        )
+
+        _, out, _ = self.run_cli(
+            ['export', '-q', '--prefix', 'user:', self.path]
+        )
+        testify.assert_equal(out, 'user:1\tx\nuser:2\ty\n')
+
+    def test_stats(self):
+        sqlite3dbm.dbm.open(self.path, flag='c').update(self.d)
+        status, out, _ = self.run_cli(['stats', '--json', self.path])
+        testify.assert_equal(status, 0)
+
+        stats = json.loads(out)
+        testify.assert_equal(stats['rows'], 6)
+        testify.assert_equal(stats['key_size']['max'], len('tab\tkey'))
+        testify.assert_equal(stats['value_size']['min'], 1)
+        testify.assert_equal(
+            sum(stats['value_size']['histogram'].itervalues()), 6
+        )
+        testify.assert_equal(
+            stats['file_size'], stats['page_size'] * stats['page_count']
+        )
+
+        status, out, _ = self.run_cli(['stats', self.path])
+        testify.assert_equal(status, 0)
+        testify.assert_in('rows             6\n', out)
+
+    def test_compact(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='c')
+        smap.update(('k%d' % i, 'v' * 100) for i in xrange(1000))
+        smap.delete_prefix('k')
+        before = os.path.getsize(self.path)
+
+        status, _, _ = self.run_cli(['compact', self.path])
+        testify.assert_equal(status, 0)
+        testify.assert_lt(os.path.getsize(self.path), before)
+
+    def test_convert(self):
+        src_path = os.path.join(self.tmpdir, 'src')
+        src = dumbdbm.open(src_path, 'n')
+        for k, v in self.d.iteritems():
+            src[k] = v
+        src.close()
+
+        status, _, err = self.run_cli(['convert', src_path, self.path])
+        testify.assert_equal(status, 0)
+        testify.assert_equal(err, '\rConverted 6 rows\n')
+        testify.assert_equal(dict(sqlite3dbm.dbm.open(self.path)), self.d)
+
+    def test_missing_db(self):
+        status, _, err = self.run_cli(
+            ['export', os.path.join(self.tmpdir, 'missing')]
+        )
+        testify.assert_equal(status, 1)
+        testify.assert_in('DB does not exist', err)
+
+
+if __name__ == '__main__':
+    testify.run()
@@ -19,10 +19,14 @@ import os
 import shutil
 import stat
 import tempfile
+import time
+from array import array
+from StringIO import StringIO
 
 import testify
 
 import sqlite3dbm.dbm
+import sqlite3dbm.sshelve
 
 class SqliteMapTestCase(testify.TestCase):
     """Some common functionality for SqliteMap test cases"""
@@ -53,9 +57,10 @@ class TestSqliteMapInterface(SqliteMapTestCase):
         rows = list(cursor.fetchall())
 
         testify.assert_equal(len(rows), 1)
-        k, v = rows[0]
+        k, v, expires = rows[0]
         testify.assert_equal(k, 'darwin')
         testify.assert_equal(v, 'drools')
+        testify.assert_equal(expires, None)
 
     def test_getitem(self):
         self.smap['jugglers'] = 'awesomesauce'
@@ -265,6 +270,23 @@ class TestSqliteMapInterface(SqliteMapTestCase):
         names['foo'] = 'bar'
         testify.assert_equal(names, dict(self.smap.items()))
 
+    def test_update_from_own_items(self):
+        self.smap.update(('key%d' % i, 'v') for i in xrange(100))
+        self.smap.update((k, v + 'x') for k, v in self.smap.iteritems())
+        testify.assert_equal(
+            dict(self.smap.items()),
+            dict(('key%d' % i, 'vx') for i in xrange(100))
+        )
+
+    def test_update_iter_failure(self):
+        self.smap['foo'] = 'bar'
+
+        def rows():
+            yield 'jason', 'fennell'
+            raise ValueError
+        testify.assert_raises(ValueError, lambda: self.smap.update(rows()))
+        testify.assert_equal(dict(self.smap.items()), {'foo': 'bar'})
+
     def test_update_kwargs(self):
         self.smap['foo'] = 'bar'
 
@@ -332,6 +354,368 @@ class TestSqliteMapInterface(SqliteMapTestCase):
         )
 
 
+class TestAtomicOperations(SqliteMapTestCase):
+    """Test the UPSERT-based read-modify-write operations"""
+
+    def test_incr(self):
+        testify.assert_equal(self.smap.incr('count'), 1)
+        testify.assert_equal(self.smap.incr('count', 5), 6)
+        testify.assert_equal(self.smap.incr('count', -10), -4)
+        testify.assert_equal(self.smap['count'], '-4')
+
+        testify.assert_equal(self.smap.incr('other', default=10), 11)
+        testify.assert_equal(self.smap.incr('float', 0.5), 0.5)
+
+    def test_incr_across_connections(self):
+        other = sqlite3dbm.dbm.open(self.path, flag='w')
+        self.smap.incr('count')
+        other.incr('count')
+        self.smap.incr('count')
+        testify.assert_equal(other['count'], '3')
+
+    def test_incr_many(self):
+        self.smap['a'] = '10'
+        self.smap.incr_many({'a': 1, 'b': 2}, [('c', 3)], d=4)
+        self.smap.incr_many(('k%d' % (i % 10), 1) for i in xrange(1000))
+
+        testify.assert_equal(
+            self.smap.select('a', 'b', 'c', 'd', 'k0'),
+            ['11', '2', '3', '4', '100']
+        )
+
+    def test_append(self):
+        self.smap.append('log', 'a')
+        self.smap.append('log', 'b')
+        testify.assert_equal(self.smap['log'], 'ab')
+
+        self.smap.append_many([('log', 'c'), ('log', 'd'), ('new', 'x')])
+        testify.assert_equal(self.smap.select('log', 'new'), ['abcd', 'x'])
+
+    def test_expired_counters_restart(self):
+        self.smap.set('count', '100', ttl=-1)
+        testify.assert_equal(self.smap.incr('count'), 1)
+        self.smap.set('live', '100', ttl=60)
+        testify.assert_equal(self.smap.incr('live'), 101)
+
+        self.smap.set('log', 'old', ttl=-1)
+        self.smap.append('log', 'new')
+        testify.assert_equal(self.smap['log'], 'new')
+
+    def test_read_only(self):
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_raises(sqlite3dbm.dbm.error, lambda: smap.incr('a'))
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: smap.append('a', 'b')
+        )
+
+
+class TestBatchDeletes(SqliteMapTestCase):
+    """Test the set-based delete operations"""
+
+    def test_delete_many(self):
+        self.smap.update((str(x), str(x)) for x in xrange(2500))
+
+        keys = [str(x) for x in xrange(0, 2500, 2)] + ['nope']
+        testify.assert_equal(self.smap.delete_many(keys), 1250)
+        testify.assert_equal(len(self.smap), 1250)
+        testify.assert_not_in('0', self.smap)
+        testify.assert_in('1', self.smap)
+
+    def test_delete_many_missing(self):
+        self.smap.update({'a': '1', 'b': '2'})
+        testify.assert_raises(
+            KeyError,
+            lambda: self.smap.delete_many(['a', 'c'], missing_ok=False)
+        )
+        # Nothing was deleted
+        testify.assert_equal(len(self.smap), 2)
+        testify.assert_equal(
+            self.smap.delete_many(['a', 'a', 'b'], missing_ok=False),
+            2
+        )
+
+    def test_delete_many_expired(self):
+        self.smap['a'] = '1'
+        self.smap.set('b', '2', ttl=-1)
+        testify.assert_raises(
+            KeyError,
+            lambda: self.smap.delete_many(['a', 'b'], missing_ok=False)
+        )
+        testify.assert_in('a', self.smap)
+        testify.assert_equal(self.smap.delete_many(['a', 'b']), 1)
+        testify.assert_equal(self.smap.evict_expired(), 0)
+
+    def test_delete_prefix(self):
+        self.smap.update({
+            'user:1': 'a', 'user:2': 'b', 'users': 'c',
+            'usea': 'd', 'user\xff': 'e', 'usex': 'f',
+        })
+        testify.assert_equal(self.smap.delete_prefix('user:'), 2)
+        testify.assert_equal(self.smap.delete_prefix('user'), 2)
+        testify.assert_equal(sorted(self.smap.keys()), ['usea', 'usex'])
+        testify.assert_equal(self.smap.delete_prefix(''), 2)
+        testify.assert_equal(len(self.smap), 0)
+
+    def test_delete_range(self):
+        self.smap.update((c, c) for c in 'abcdef')
+        testify.assert_equal(self.smap.delete_range('b', 'd'), 2)
+        testify.assert_equal(self.smap.delete_range(stop='b'), 1)
+        testify.assert_equal(self.smap.delete_range('f'), 1)
+        testify.assert_equal(sorted(self.smap.keys()), ['d', 'e'])
+        testify.assert_equal(self.smap.delete_range(), 2)
+
+
+class TestChangeLog(SqliteMapTestCase):
+    """Test the change log and replicating from it"""
+
+    @testify.setup
+    def create_replica(self):
+        self.smap.enable_change_log()
+        self.replica_path = os.path.join(self.tmpdir, 'replica.sqlite')
+        self.replica = sqlite3dbm.dbm.open(self.replica_path, flag='c')
+
+    def test_changes_since(self):
+        self.smap['a'] = '1'
+        self.smap.update({'b': '2'})
+        self.smap['a'] = '3'
+        del self.smap['b']
+
+        testify.assert_equal(
+            [(op, k, v) for _, k, op, v, _ in self.smap.changes_since()],
+            [('set', 'a', '3'), ('set', 'b', None),
+             ('set', 'a', '3'), ('del', 'b', None)]
+        )
+        seq = self.smap.change_seq()
+        testify.assert_equal(list(self.smap.changes_since(seq)), [])
+
+        self.smap.incr('n')
+        testify.assert_equal(
+            [(k, op) for _, k, op, _, _ in self.smap.changes_since(seq)],
+            [('n', 'set')]
+        )
+
+    def test_changes_since_batches(self):
+        self.smap.update((str(x), str(x)) for x in xrange(25))
+        changes = list(self.smap.changes_since(batch_size=10))
+        testify.assert_equal(len(changes), 25)
+        testify.assert_equal(
+            [seq for seq, _, _, _, _ in changes],
+            sorted(seq for seq, _, _, _, _ in changes)
+        )
+
+    def test_apply_changes(self):
+        self.smap.update((str(x), str(x)) for x in xrange(100))
+        self.smap.delete_range('5', '7')
+        seq = self.replica.apply_changes(self.smap.changes_since())
+        testify.assert_equal(seq, self.smap.change_seq())
+        testify.assert_equal(dict(self.replica), dict(self.smap))
+
+        self.smap['new'] = 'val'
+        self.smap.clear()
+        self.smap['other'] = 'val'
+        testify.assert_equal(
+            self.replica.apply_changes(self.smap.changes_since(seq)),
+            self.smap.change_seq()
+        )
+        testify.assert_equal(dict(self.replica), {'other': 'val'})
+        testify.assert_equal(
+            self.replica.apply_changes(self.smap.changes_since(seq + 1000)),
+            None
+        )
+
+    def test_apply_changes_keeps_ttls(self):
+        self.smap.set('short', '1', ttl=-1)
+        self.smap.set('long', '2', ttl=3600)
+        self.smap['forever'] = '3'
+        self.replica.apply_changes(self.smap.changes_since())
+        testify.assert_equal(
+            dict(self.replica), {'long': '2', 'forever': '3'}
+        )
+        testify.assert_equal(self.replica.evict_expired(), 1)
+
+    def test_apply_changes_skips_deleted_sets(self):
+        self.smap['a'] = '1'
+        self.smap['b'] = '2'
+        del self.smap['a']
+        changes = list(self.smap.changes_since())
+        # Apply the set of 'a' in one batch and its delete in the next
+        seq = self.replica.apply_changes(changes[:2])
+        testify.assert_equal(seq, changes[1][0])
+        testify.assert_equal(dict(self.replica), {'b': '2'})
+        self.replica.apply_changes(changes[2:])
+        testify.assert_equal(dict(self.replica), {'b': '2'})
+
+    def test_change_log_not_enabled(self):
+        testify.assert_raises(
+            sqlite3dbm.dbm.error, lambda: list(self.replica.changes_since())
+        )
+        testify.assert_raises(sqlite3dbm.dbm.error, self.replica.change_seq)
+
+    def test_writes_from_other_connections_are_logged(self):
+        other = sqlite3dbm.dbm.open(self.path, flag='w')
+        other['foo'] = 'bar'
+        testify.assert_equal(
+            [k for _, k, _, _, _ in self.smap.changes_since()],
+            ['foo']
+        )
+
+    def test_truncate_and_compact(self):
+        for x in xrange(3):
+            self.smap.update({'a': str(x), 'b': str(x)})
+        seq = self.smap.change_seq()
+        testify.assert_equal(self.smap.compact_changes(), 4)
+        testify.assert_equal(
+            [k for _, k, _, _, _ in self.smap.changes_since()],
+            ['a', 'b']
+        )
+        testify.assert_equal(self.smap.truncate_changes(seq), 2)
+        testify.assert_equal(list(self.smap.changes_since()), [])
+        # Sequence numbers are never reused
+        self.smap['c'] = 'c'
+        testify.assert_gt(self.smap.change_seq(), seq)
+
+    def test_compact_mode(self):
+        self.smap.disable_change_log()
+        self.smap.enable_change_log(compact=True)
+        for x in xrange(3):
+            self.smap['a'] = str(x)
+        self.smap['b'] = 'b'
+        del self.smap['a']
+        testify.assert_equal(
+            [(k, op) for _, k, op, _, _ in self.smap.changes_since()],
+            [('b', 'set'), ('a', 'del')]
+        )
+
+    def test_access_tracking_is_not_logged(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='w', max_entries=10)
+        smap['a'] = '1'
+        smap['a']
+        smap.enforce_capacity()
+        testify.assert_equal(len(list(smap.changes_since())), 1)
+
+
+class TestStreamingLookups(SqliteMapTestCase):
+    """Test get_many_iter and get_dict"""
+
+    def test_get_many_iter(self):
+        self.smap.update((str(x), str(x)) for x in xrange(2500))
+        keys = (str(x) for x in xrange(3000))
+        vals = self.smap.get_many_iter(keys, default='')
+        testify.assert_equal(vals.next(), '0')
+        testify.assert_equal(
+            list(vals),
+            [str(x) for x in xrange(1, 2500)] + [''] * 500
+        )
+        testify.assert_equal(
+            list(self.smap.get_many_iter('1', ['2', 'nope'])),
+            ['1', '2', None]
+        )
+        testify.assert_raises(
+            TypeError,
+            lambda: list(self.smap.get_many_iter('1', nope=True))
+        )
+
+    def test_get_dict(self):
+        self.smap.update((str(x), str(x)) for x in xrange(2500))
+        d = self.smap.get_dict(str(x) for x in xrange(0, 3000, 2))
+        testify.assert_equal(
+            d,
+            dict((str(x), str(x)) for x in xrange(0, 2500, 2))
+        )
+        testify.assert_equal(self.smap.get_dict('1', ['nope']), {'1': '1'})
+        testify.assert_equal(self.smap.get_dict(), {})
+
+
+class TestBlobs(SqliteMapTestCase):
+    """Test open_blob and put_stream"""
+
+    def test_put_stream(self):
+        data = ''.join(chr(x % 256) for x in xrange(100000))
+        testify.assert_equal(
+            self.smap.put_stream('big', StringIO(data), chunk_size=4096),
+            len(data)
+        )
+        testify.assert_equal(self.smap['big'], data)
+
+        # Only `size` bytes are read
+        self.smap.put_stream('head', StringIO(data), size=10)
+        testify.assert_equal(self.smap['head'], data[:10])
+
+        # A short file leaves the old value alone
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: self.smap.put_stream('head', StringIO('abc'), size=10)
+        )
+        testify.assert_equal(self.smap['head'], data[:10])
+
+        self.smap.put_stream('empty', StringIO(''))
+        testify.assert_equal(self.smap['empty'], '')
+
+    def test_read(self):
+        self.smap['k'] = 'header:body\x00\xff'
+        blob = self.smap.open_blob('k')
+        testify.assert_equal(blob.size, 13)
+        testify.assert_equal(blob.read(7), 'header:')
+        testify.assert_equal(blob.tell(), 7)
+        testify.assert_equal(blob.read(), 'body\x00\xff')
+        testify.assert_equal(blob.read(), '')
+
+        blob.seek(-2, os.SEEK_END)
+        testify.assert_equal(blob.read(100), '\x00\xff')
+        blob.seek(0)
+        testify.assert_equal(blob.read(1), 'h')
+        blob.close()
+        testify.assert_raises(ValueError, lambda: blob.read())
+
+        testify.assert_raises(KeyError, lambda: self.smap.open_blob('nope'))
+
+    def test_read_past_readahead(self):
+        size = sqlite3dbm.dbm._BLOB_READAHEAD * 5 / 2
+        value = ''.join(chr(i % 251) for i in xrange(size))
+        self.smap['big'] = value
+
+        blob = self.smap.open_blob('big')
+        chunks = []
+        while True:
+            chunk = blob.read(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        testify.assert_equal(''.join(chunks), value)
+
+        blob.seek(100)
+        testify.assert_equal(blob.read(10), value[100:110])
+        blob.seek(-10, os.SEEK_END)
+        testify.assert_equal(blob.read(), value[-10:])
+        blob.close()
+
+    def test_write(self):
+        with self.smap.open_blob('k', 'w') as blob:
+            blob.write('ab')
+            # Not visible until closed
+            testify.assert_not_in('k', self.smap)
+            blob.write('cd')
+            testify.assert_equal(blob.tell(), 4)
+            testify.assert_raises(IOError, lambda: blob.read())
+        testify.assert_equal(self.smap['k'], 'abcd')
+
+        def fail():
+            with self.smap.open_blob('k', 'w') as blob:
+                blob.write('xyz')
+                raise ValueError
+        testify.assert_raises(ValueError, fail)
+        testify.assert_equal(self.smap['k'], 'abcd')
+
+        testify.assert_raises(
+            sqlite3dbm.dbm.error, lambda: self.smap.open_blob('k', 'a')
+        )
+        reader = sqlite3dbm.dbm.open(self.path, flag='r')
+        testify.assert_raises(
+            sqlite3dbm.dbm.error, lambda: reader.open_blob('k', 'w')
+        )
+
+
 class TestSqliteRegressions(SqliteMapTestCase):
     """A place for regression tests"""
 
@@ -401,6 +785,71 @@ class TestSqliteStorage(SqliteMapTestCase):
         testify.assert_equal(smap['foo'], 'a')
 
 
+class TestBackup(SqliteMapTestCase):
+    @testify.setup
+    def create_backup_path(self):
+        self.backup_path = os.path.join(self.tmpdir, 'backup.sqlite')
+
+    def test_backup_single_step(self):
+        d = dict((str(x), str(x)) for x in xrange(100))
+        self.smap.update(d)
+
+        steps = []
+        def progress(copied, total):
+            steps.append((copied, total))
+        testify.assert_equal(
+            self.smap.backup(self.backup_path, progress=progress),
+            100
+        )
+        testify.assert_equal(steps, [(100, 100)])
+
+        backup = sqlite3dbm.dbm.open(self.backup_path)
+        testify.assert_equal(dict(backup.items()), d)
+
+    def test_backup_copies_whole_file(self):
+        self.smap['a'] = '1'
+        users = sqlite3dbm.dbm.open(self.path, flag='w', table='users')
+        users['1'] = 'bob'
+        self.smap.enable_change_log()
+        self.smap['b'] = '2'
+
+        testify.assert_equal(self.smap.backup(self.backup_path), 2)
+        testify.assert_equal(
+            sqlite3dbm.dbm.open(self.backup_path, table='users').items(),
+            [('1', 'bob')]
+        )
+        testify.assert_equal(
+            sqlite3dbm.dbm.open(self.backup_path).change_seq(), 1
+        )
+
+    def test_backup_in_steps(self):
+        d = dict((str(x), str(x)) for x in xrange(100))
+        self.smap.update(d)
+
+        steps = []
+        def progress(copied, total):
+            steps.append(copied)
+        self.smap.backup(
+            self.backup_path, rows_per_step=30, sleep=0, progress=progress
+        )
+        testify.assert_equal(steps, [30, 60, 90, 100])
+
+        backup = sqlite3dbm.dbm.open(self.backup_path)
+        testify.assert_equal(dict(backup.items()), d)
+
+    def test_restore(self):
+        self.smap.update({'a': '1', 'b': '2'})
+        self.smap.backup(self.backup_path)
+
+        self.smap['a'] = 'changed'
+        self.smap['c'] = '3'
+        testify.assert_equal(
+            sqlite3dbm.dbm.restore(self.path, self.backup_path),
+            2
+        )
+        testify.assert_equal(dict(self.smap.items()), {'a': '1', 'b': '2'})
+
+
 class TestSqliteMemoryStorage(testify.TestCase):
     """Test that storage for in-memory databases works as expected."""
 
@@ -430,6 +879,174 @@ class TestSqliteMemoryStorage(testify.TestCase):
         testify.assert_equal(smap.items(), [])
 
 
+class TestExpiry(SqliteMapTestCase):
+    """Test keys with a TTL"""
+
+    def test_expired_keys_are_missing(self):
+        self.smap.set('live', 'a', ttl=60)
+        self.smap.set('dead', 'b', ttl=-1)
+        self.smap.set('forever', 'c')
+
+        testify.assert_equal(self.smap['live'], 'a')
+        testify.assert_raises(KeyError, lambda: self.smap['dead'])
+        testify.assert_not_in('dead', self.smap)
+        testify.assert_equal(
+            self.smap.get_many('live', 'dead', 'forever'),
+            ['a', None, 'c']
+        )
+        testify.assert_equal(len(self.smap), 2)
+        testify.assert_equal(
+            dict(self.smap.items()),
+            {'live': 'a', 'forever': 'c'}
+        )
+
+        # Other connections see the expiry too
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_not_in('dead', smap)
+
+    def test_maps_connected_before_first_ttl(self):
+        self.smap['x'] = 'a'
+        reader = sqlite3dbm.dbm.open(self.path)
+        testify.assert_equal(reader['x'], 'a')
+
+        writer = sqlite3dbm.dbm.open(self.path, flag='w')
+        writer.set('y', 'b', ttl=-1)
+        testify.assert_equal(reader.get('y'), None)
+        testify.assert_equal(len(reader), 1)
+        testify.assert_equal(self.smap.get('y'), None)
+
+    def test_old_files_without_expires_column(self):
+        path = os.path.join(self.tmpdir, 'old')
+        conn = sqlite3dbm.dbm.sqlite3.connect(path)
+        conn.execute('CREATE TABLE kv_table (key TEXT PRIMARY KEY, val TEXT)')
+        conn.execute("INSERT INTO kv_table VALUES ('x', 'a')")
+        conn.commit()
+
+        reader = sqlite3dbm.dbm.open(path)
+        testify.assert_equal(len(reader), 1)
+        testify.assert_equal(reader.has_expiry, False)
+
+        # A writer adds the column, and readers opened since see it
+        sqlite3dbm.dbm.open(path, flag='w').set('y', 'b', ttl=-1)
+        reader = sqlite3dbm.dbm.open(path)
+        testify.assert_equal(reader.has_expiry, True)
+        testify.assert_equal(reader.get('y'), None)
+        testify.assert_equal(len(reader), 1)
+
+    def test_overwrite_clears_ttl(self):
+        self.smap.set('foo', 'a', ttl=-1)
+        self.smap['foo'] = 'b'
+        testify.assert_equal(self.smap['foo'], 'b')
+
+    def test_default_ttl(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='w', default_ttl=-1)
+        smap['foo'] = 'a'
+        smap.update({'bar': 'b'})
+        smap.set('baz', 'c', ttl=None)
+
+        testify.assert_equal(smap.keys(), ['baz'])
+
+    def test_evict_expired(self):
+        self.smap.update(('live%d' % i, 'v') for i in xrange(10))
+        for i in xrange(25):
+            self.smap.set('dead%d' % i, 'v', ttl=-1)
+
+        testify.assert_equal(self.smap.evict_expired(batch_size=10), 25)
+        testify.assert_equal(
+            self.smap.conn.execute('SELECT COUNT(*) FROM kv_table').fetchone(),
+            (10,)
+        )
+        testify.assert_equal(self.smap.evict_expired(), 0)
+
+    def test_evict_without_ttls(self):
+        self.smap['foo'] = 'bar'
+        testify.assert_equal(self.smap.evict_expired(), 0)
+
+    def test_evictor_thread(self):
+        self.smap.set('dead', 'v', ttl=-1)
+        evictor = self.smap.start_evictor(interval=60)
+        evictor.stop()
+
+        testify.assert_equal(
+            self.smap.conn.execute('SELECT COUNT(*) FROM kv_table').fetchone(),
+            (0,)
+        )
+
+    def test_backup_keeps_ttl(self):
+        self.smap.set('live', 'a', ttl=60)
+        self.smap.set('dead', 'b', ttl=-1)
+
+        backup_path = os.path.join(self.tmpdir, 'backup.sqlite')
+        self.smap.backup(backup_path)
+        backup = sqlite3dbm.dbm.open(backup_path)
+        testify.assert_equal(backup.items(), [('live', 'a')])
+
+        mem_map = sqlite3dbm.dbm.open(self.path, in_memory=True)
+        testify.assert_equal(mem_map.items(), [('live', 'a')])
+
+        # Restoring keeps the expiry times
+        self.smap.clear()
+        testify.assert_equal(
+            sqlite3dbm.dbm.restore(self.path, backup_path), 2
+        )
+        testify.assert_equal(self.smap.items(), [('live', 'a')])
+        testify.assert_lt(
+            self.smap.conn.execute(
+                "SELECT expires FROM kv_table WHERE key = 'live'"
+            ).fetchone()[0],
+            time.time() + 61
+        )
+
+
+class TestInMemoryServing(SqliteMapTestCase):
+    """Test loading an on-disk database into memory at open time"""
+
+    def test_loads_into_memory(self):
+        d = dict((str(x), str(x)) for x in xrange(100))
+        self.smap.update(d)
+
+        steps = []
+        def progress(copied, total):
+            steps.append((copied, total))
+        mem_map = sqlite3dbm.dbm.open(
+            self.path, in_memory=True, progress=progress
+        )
+        testify.assert_equal(steps, [(100, 100)])
+        testify.assert_equal(dict(mem_map.items()), d)
+        testify.assert_equal(mem_map.get_many('1', 'nope'), ['1', None])
+
+        # Later writes to the file are not seen without a reload
+        self.smap['new'] = 'row'
+        testify.assert_not_in('new', mem_map)
+        mem_map.reload()
+        testify.assert_equal(mem_map['new'], 'row')
+
+    def test_read_only(self):
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.dbm.open(self.path, flag='w', in_memory=True)
+        )
+        mem_map = sqlite3dbm.dbm.open(self.path, in_memory=True)
+        def do_setitem():
+            mem_map['foo'] = 'bar'
+        testify.assert_raises(sqlite3dbm.dbm.error, do_setitem)
+
+    def test_reload_interval(self):
+        self.smap['foo'] = 'a'
+        mem_map = sqlite3dbm.dbm.open(
+            self.path, in_memory=True, reload_interval=0
+        )
+        testify.assert_equal(mem_map['foo'], 'a')
+
+        # Publish a new version of the file
+        new_path = os.path.join(self.tmpdir, 'new.sqlite')
+        sqlite3dbm.dbm.build(new_path, [('bar', 'b'), ('foo', 'c')])
+        os.rename(new_path, self.path)
+
+        testify.assert_equal(mem_map['foo'], 'c')
+        testify.assert_equal(len(mem_map), 2)
+
+
 class SqliteCreationTest(testify.TestCase):
     """Base class for tests checking creation of SqliteMap backend stores"""
     @testify.setup
@@ -579,12 +1196,827 @@ class TestModes(SqliteCreationTest):
         testify.assert_equal(self.get_perm_mask(self.path), expected_mode)
 
 
+class TestBuild(SqliteCreationTest):
+    def test_build_then_open(self):
+        rows = [('%05d' % i, str(i)) for i in xrange(2000)]
+        num_rows = sqlite3dbm.dbm.build(self.path, rows)
+        testify.assert_equal(num_rows, 2000)
+
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_equal(len(smap), 2000)
+        testify.assert_equal(smap['01234'], '1234')
+        testify.assert_equal(smap.get_many('00001', 'nope'), ['1', None])
+
+        # Built databases are ordinary, writeable databases too
+        smap = sqlite3dbm.dbm.open(self.path, flag='w')
+        smap['zzz'] = 'end'
+        testify.assert_equal(smap['zzz'], 'end')
+
+    def test_build_replaces_existing_db(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='c')
+        smap['old'] = 'data'
+
+        sqlite3dbm.dbm.build(self.path, iter([('a', '1'), ('b', '2')]))
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_equal(smap.items(), [('a', '1'), ('b', '2')])
+
+    def test_build_verifies_sort_order(self):
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.dbm.build(self.path, [('b', '1'), ('a', '2')])
+        )
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.dbm.build(self.path, [('a', '1'), ('a', '2')])
+        )
+        # Nothing is left behind by a failed build
+        testify.assert_equal(os.listdir(self.tmpdir), [])
+
+    def test_build_unverified(self):
+        sqlite3dbm.dbm.build(
+            self.path, [('b', '1'), ('a', '2'), ('b', '3')],
+            verify_sorted=False,
+        )
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_equal(dict(smap.items()), {'a': '2', 'b': '3'})
+
+
+class TestMerge(SqliteCreationTest):
+    @testify.setup
+    def create_sources(self):
+        self.sources = []
+        for i, d in enumerate([
+            {'a': '1', 'b': '1'},
+            {'b': '2', 'c': '2'},
+        ]):
+            source = os.path.join(self.tmpdir, 'source%d.sqlite' % (i,))
+            sqlite3dbm.dbm.open(source, flag='c').update(d)
+            self.sources.append(source)
+
+    def test_merge_last(self):
+        counts = sqlite3dbm.dbm.merge(self.path, self.sources)
+        testify.assert_equal(counts, [2, 2])
+
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_equal(
+            dict(smap.items()),
+            {'a': '1', 'b': '2', 'c': '2'}
+        )
+
+    def test_merge_first(self):
+        counts = sqlite3dbm.dbm.merge(self.path, self.sources, conflict='first')
+        testify.assert_equal(counts, [2, 1])
+
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_equal(
+            dict(smap.items()),
+            {'a': '1', 'b': '1', 'c': '2'}
+        )
+
+    def test_merge_callable(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='c')
+        smap['a'] = '10'
+
+        def add(k, old_val, new_val):
+            return str(int(old_val) + int(new_val))
+        counts = sqlite3dbm.dbm.merge(
+            self.path, self.sources, conflict=add, compact=True
+        )
+        testify.assert_equal(counts, [2, 2])
+        testify.assert_equal(
+            dict(smap.items()),
+            {'a': '11', 'b': '3', 'c': '2'}
+        )
+
+    def test_merge_keeps_ttls(self):
+        source = sqlite3dbm.dbm.open(self.sources[0], flag='w')
+        source.set('live', 'x', ttl=60)
+        source.set('dead', 'x', ttl=-1)
+        dest = sqlite3dbm.dbm.open(self.path, flag='c')
+        dest.set('b', 'expired', ttl=-1)
+
+        # The expired key in the destination does not block the source's
+        sqlite3dbm.dbm.merge(self.path, self.sources, conflict='first')
+        testify.assert_equal(dest['b'], '1')
+
+        for conflict in ('last', 'first', lambda k, old, new: old + new):
+            sqlite3dbm.dbm.merge(self.path, self.sources, conflict=conflict)
+            testify.assert_not_in('dead', dest)
+            testify.assert_equal(
+                dest.conn.execute(
+                    'SELECT COUNT(*) FROM kv_table WHERE key = ?', ('dead',)
+                ).fetchone(),
+                (0,)
+            )
+            expires, = dest.conn.execute(
+                'SELECT expires FROM kv_table WHERE key = ?', ('live',)
+            ).fetchone()
+            testify.assert_gt(expires, time.time())
+
+    def test_merge_invalid_conflict(self):
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.dbm.merge(self.path, self.sources, 'middle')
+        )
+
+
+class TestCapacityLimits(SqliteCreationTest):
+    """Test size-bounded maps with LRU/LFU eviction"""
+
+    def test_lru(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='c', max_entries=10)
+        smap.update(('old%d' % i, 'v') for i in xrange(10))
+        testify.assert_equal(len(smap), 10)
+
+        # Use half of the old keys again, later than the rest were written
+        time.sleep(0.01)
+        smap.get_many(['old%d' % i for i in xrange(5)])
+        smap.update(('new%d' % i, 'v') for i in xrange(5))
+
+        testify.assert_equal(len(smap), 10)
+        testify.assert_equal(
+            set(smap.keys()),
+            set(['old%d' % i for i in xrange(5)] +
+                ['new%d' % i for i in xrange(5)])
+        )
+        stats = smap.cache_stats()
+        testify.assert_equal(stats['evicted'], 5)
+        testify.assert_equal(stats['entries'], 10)
+
+    def test_lfu(self):
+        smap = sqlite3dbm.dbm.open(
+            self.path, flag='c', max_entries=3, eviction='lfu'
+        )
+        smap.update({'a': '1', 'b': '2', 'c': '3'})
+        for _ in xrange(3):
+            smap['a']
+            smap['c']
+        smap['d'] = '4'
+        testify.assert_equal(smap.enforce_capacity(), 1)
+
+        testify.assert_equal(sorted(smap.keys()), ['a', 'c', 'd'])
+
+    def test_single_writes_are_checked(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='c', max_entries=50)
+        for i in xrange(300):
+            smap[str(i)] = 'v'
+        testify.assert_lte(len(smap), 150)
+
+    def test_max_bytes(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='c', max_bytes=64 * 1024)
+        value = 'x' * 1000
+        for i in xrange(10):
+            smap.update(('%d-%d' % (i, j), value) for j in xrange(100))
+
+        testify.assert_gt(smap.cache_stats()['evicted'], 0)
+        testify.assert_lte(smap._used_bytes(), 128 * 1024)
+        testify.assert_gt(len(smap), 0)
+
+    def test_invalid_settings(self):
+        sqlite3dbm.dbm.open(self.path, flag='c')
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.dbm.open(self.path, max_entries=10)
+        )
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.dbm.open(
+                self.path, flag='w', max_entries=10, eviction='fifo'
+            )
+        )
+
+
+class TestDiff(SqliteCreationTest):
+    """Test diffing two DB files"""
+
+    @testify.setup
+    def create_dbs(self):
+        self.old_path = os.path.join(self.tmpdir, 'old.sqlite')
+        self.new_path = os.path.join(self.tmpdir, 'new.sqlite')
+        old = sqlite3dbm.dbm.open(self.old_path, flag='c')
+        old.update({'a': '1', 'b': '2', 'c': '3', 'd': '4'})
+        new = sqlite3dbm.dbm.open(self.new_path, flag='c')
+        new.update({'b': '2', 'c': 'changed', 'e': '5', '0': '6'})
+
+    def test_diff(self):
+        testify.assert_equal(
+            list(sqlite3dbm.diff(self.old_path, self.new_path)),
+            [
+                ('removed', 'a', '1', None),
+                ('changed', 'c', '3', 'changed'),
+                ('removed', 'd', '4', None),
+                ('added', '0', None, '6'),
+                ('added', 'e', None, '5'),
+            ]
+        )
+
+    def test_diff_keys_only(self):
+        testify.assert_equal(
+            [
+                (change, k, old_val, new_val)
+                for change, k, old_val, new_val
+                in sqlite3dbm.diff(self.old_path, self.new_path, values=False)
+            ],
+            [
+                ('removed', 'a', None, None),
+                ('changed', 'c', None, None),
+                ('removed', 'd', None, None),
+                ('added', '0', None, None),
+                ('added', 'e', None, None),
+            ]
+        )
+
+    def test_expired_keys_are_missing(self):
+        old = sqlite3dbm.dbm.open(self.old_path, flag='w')
+        new = sqlite3dbm.dbm.open(self.new_path, flag='w')
+        old.set('w', '7', ttl=-1)
+        old.set('x', '8', ttl=-1)
+        new['x'] = '8'
+        old['y'] = '9'
+        new.set('y', '9', ttl=-1)
+        old.set('z', '10', ttl=-1)
+        new.set('z', '10', ttl=-1)
+        testify.assert_equal(
+            [
+                (change, k)
+                for change, k, _, _
+                in sqlite3dbm.diff(self.old_path, self.new_path)
+            ],
+            [
+                ('removed', 'a'),
+                ('changed', 'c'),
+                ('removed', 'd'),
+                ('removed', 'y'),
+                ('added', '0'),
+                ('added', 'e'),
+                ('added', 'x'),
+            ]
+        )
+
+    def test_identical_dbs(self):
+        testify.assert_equal(
+            list(sqlite3dbm.diff(self.old_path, self.old_path)),
+            []
+        )
+
+    def test_stop_early(self):
+        changes = sqlite3dbm.diff(self.old_path, self.new_path)
+        testify.assert_equal(changes.next()[:2], ('removed', 'a'))
+        changes.close()
+
+    def test_missing_db(self):
+        changes = sqlite3dbm.diff(
+            self.old_path,
+            os.path.join(self.tmpdir, 'missing.sqlite')
+        )
+        testify.assert_raises(sqlite3dbm.dbm.error, changes.next)
+        testify.assert_not_in('missing.sqlite', os.listdir(self.tmpdir))
+
+
+class TestMetrics(SqliteCreationTest):
+    """Test the per-operation metrics"""
+
+    @testify.setup
+    def create_map(self):
+        self.smap = sqlite3dbm.dbm.open(self.path, flag='c', metrics=True)
+
+    def test_plain_maps_are_not_instrumented(self):
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_equal(type(smap), sqlite3dbm.dbm.SqliteMap)
+        testify.assert_equal(hasattr(smap, 'stats'), False)
+
+    def test_counters(self):
+        self.smap['foo'] = 'bar'
+        self.smap.update({'a': '1', 'b': '22'})
+        testify.assert_equal(self.smap['foo'], 'bar')
+        testify.assert_equal(
+            self.smap.get_many('a', 'b', 'nope'),
+            ['1', '22', None]
+        )
+        del self.smap['a']
+        testify.assert_equal(sorted(self.smap.keys()), ['b', 'foo'])
+
+        stats = self.smap.stats()
+        testify.assert_equal(
+            dict((op, s['count']) for op, s in stats['ops'].iteritems()),
+            # delitem checks the key exists first
+            {'setitem': 1, 'update': 1, 'getitem': 2, 'get_many': 1,
+             'delitem': 1, 'iteritems': 1}
+        )
+        testify.assert_equal(stats['rows_written'], 4)
+        testify.assert_equal(stats['bytes_written'], 6 + 2 + 3)
+        testify.assert_equal(stats['rows_read'], 1 + 1 + 2 + 2)
+        testify.assert_equal(stats['get_many_chunks'], 1)
+        testify.assert_equal(stats['commits'], 3)
+
+        for op_stats in stats['ops'].itervalues():
+            testify.assert_equal(
+                sum(op_stats['histogram'].itervalues()),
+                op_stats['count']
+            )
+            testify.assert_gte(op_stats['max_time'], 0)
+
+    def test_get_many_chunks(self):
+        self.smap.update((str(x), str(x)) for x in xrange(2500))
+        self.smap.select([str(x) for x in xrange(2500)])
+        testify.assert_equal(self.smap.stats()['get_many_chunks'], 3)
+
+    def test_hooks(self):
+        calls = []
+        self.smap.metrics.add_hook(
+            lambda op, seconds, rows, nbytes: calls.append((op, rows, nbytes))
+        )
+        self.smap['foo'] = 'bar'
+        self.smap.get('foo')
+        testify.assert_equal(calls, [('setitem', 1, 6), ('getitem', 1, 6)])
+
+    def test_shared_metrics(self):
+        metrics = sqlite3dbm.dbm.Metrics()
+        smap = sqlite3dbm.dbm.open(self.path, flag='w', metrics=metrics)
+        other = sqlite3dbm.dbm.open(self.path, metrics=metrics)
+        smap['foo'] = 'bar'
+        other['foo']
+        testify.assert_equal(
+            sorted(metrics.snapshot()['ops']),
+            ['getitem', 'setitem']
+        )
+
+        metrics.reset()
+        testify.assert_equal(metrics.snapshot()['ops'], {})
+
+
+class TestDiagnostics(SqliteCreationTest):
+    """Test statement tracing and query plans"""
+
+    def test_statement_stats(self):
+        diagnostics = sqlite3dbm.dbm.Diagnostics(progress_steps=10)
+        smap = sqlite3dbm.dbm.open(
+            self.path, flag='c', diagnostics=diagnostics
+        )
+        smap.update((str(x), str(x)) for x in xrange(50))
+        smap.get_many(['1', '2'])
+        smap.get_many(['1', '2', '3'])
+        smap['1']
+
+        stats = diagnostics.statement_stats()
+        get_many_sql = (
+            sqlite3dbm.dbm._GET_MANY_TTL_QUERY_TEMPLATE % ('?,...',)
+        )
+        testify.assert_equal(stats[get_many_sql]['count'], 2)
+        testify.assert_equal(stats[sqlite3dbm.dbm._GET_TTL_QUERY]['count'], 1)
+        testify.assert_equal(stats[sqlite3dbm.dbm._SET_QUERY]['count'], 1)
+        testify.assert_gt(stats[sqlite3dbm.dbm._SET_QUERY]['vm_steps'], 0)
+
+        testify.assert_raises(
+            sqlite3dbm.dbm.sqlite3.OperationalError,
+            lambda: smap.conn.execute('SELECT nope FROM kv_table')
+        )
+        bad_stats = diagnostics.statement_stats()['SELECT nope FROM kv_table']
+        testify.assert_equal(bad_stats['count'], 1)
+        testify.assert_equal(bad_stats['errors'], 1)
+
+    def test_slow_query_log(self):
+        messages = []
+        class Logger(object):
+            def warning(self, msg, *args):
+                messages.append(msg % args)
+
+        diagnostics = sqlite3dbm.dbm.Diagnostics(
+            slow_query_time=0, logger=Logger()
+        )
+        smap = sqlite3dbm.dbm.open(
+            self.path, flag='c', diagnostics=diagnostics
+        )
+        smap['foo'] = 'bar'
+        testify.assert_equal(diagnostics.slow_queries, len(messages))
+        testify.assert_in(
+            sqlite3dbm.dbm._SET_QUERY,
+            [m.split(': ', 1)[1] for m in messages]
+        )
+
+    def test_with_metrics(self):
+        smap = sqlite3dbm.dbm.open(
+            self.path, flag='c', metrics=True, diagnostics=True
+        )
+        smap['foo'] = 'bar'
+        testify.assert_equal(smap.stats()['commits'], 1)
+        testify.assert_in(
+            sqlite3dbm.dbm._SET_QUERY,
+            smap.diagnostics.statement_stats()
+        )
+
+    def test_explain(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='c')
+        # Point lookups use the primary key index rather than a scan
+        plan, = smap.explain('get')
+        testify.assert_in('USING INDEX', plan)
+        plans = smap.explain()
+        testify.assert_equal(
+            sorted(plans),
+            ['del', 'delete_range', 'evict_expired', 'get', 'get_many',
+             'iter', 'len', 'popitem', 'set']
+        )
+        testify.assert_raises(sqlite3dbm.dbm.error, lambda: smap.explain('x'))
+
+        smap.set('foo', 'bar', ttl=60)
+        testify.assert_in('evict_expired', smap.explain())
+
+
+class TestNamedTables(SqliteCreationTest):
+    def test_open_table(self):
+        users = sqlite3dbm.dbm.open(self.path, flag='c', table='users')
+        emails = sqlite3dbm.dbm.open(self.path, flag='w', table='emails')
+        users['1'] = 'bob'
+        emails['bob@example.com'] = '1'
+        users.set('2', 'amy', ttl=60)
+        users.enable_change_log()
+        emails.enable_change_log()
+        del emails['bob@example.com']
+
+        testify.assert_equal(
+            sorted(users.items()), [('1', 'bob'), ('2', 'amy')]
+        )
+        testify.assert_equal(emails.items(), [])
+        testify.assert_equal(
+            [op for _, _, op, _, _ in emails.changes_since()], ['del']
+        )
+        testify.assert_equal(users.change_seq(), 0)
+
+        # The default table is untouched
+        testify.assert_equal(sqlite3dbm.dbm.open(self.path).items(), [])
+
+        copy_path = os.path.join(self.tmpdir, 'copy')
+        users.backup(copy_path)
+        testify.assert_equal(
+            sorted(sqlite3dbm.dbm.open(copy_path, table='users').keys()),
+            ['1', '2']
+        )
+
+        users['3'] = 'new'
+        testify.assert_equal(
+            sqlite3dbm.dbm.restore(self.path, copy_path, table='users'), 2
+        )
+        testify.assert_equal(sorted(users.keys()), ['1', '2'])
+
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.dbm.open(self.path, table='bad name')
+        )
+
+    def test_evictor(self):
+        users = sqlite3dbm.dbm.open(self.path, flag='c', table='users')
+        users.set('dead', 'v', ttl=-1)
+        users['live'] = 'v'
+        users.start_evictor(interval=60).stop()
+
+        testify.assert_equal(
+            users.conn.execute('SELECT key FROM kv_table').fetchall(),
+            [('live',)]
+        )
+        # No stray default table either
+        testify.assert_equal(
+            sqlite3dbm.dbm.Database(self.path).tables(), ['users']
+        )
+
+        db = sqlite3dbm.dbm.Database(self.path)
+        emails = db.map('emails')
+        emails.set('dead', 'v', ttl=-1)
+        emails.start_evictor(interval=60).stop()
+        testify.assert_equal(emails.keys(), [])
+        testify.assert_equal(
+            emails.conn.execute('SELECT COUNT(*) FROM kv_table').fetchone(),
+            (0,)
+        )
+
+
+class TestDatabase(SqliteCreationTest):
+    @testify.setup
+    def create_db(self):
+        self.db = sqlite3dbm.dbm.Database(self.path)
+        self.users = self.db.map('users')
+        self.emails = self.db.map('emails')
+
+    def other_conn_rows(self, table):
+        return sorted(sqlite3dbm.dbm.open(self.path, table=table).items())
+
+    def test_transaction(self):
+        testify.assert_equal(self.db.map('users'), self.users)
+
+        with self.db.transaction():
+            self.users['1'] = 'bob'
+            self.emails.update({'bob@example.com': '1'})
+            # Nothing is committed yet
+            testify.assert_equal(
+                sqlite3dbm.dbm.Database(self.path).tables(), []
+            )
+        testify.assert_equal(self.other_conn_rows('users'), [('1', 'bob')])
+        testify.assert_equal(
+            self.other_conn_rows('emails'), [('bob@example.com', '1')]
+        )
+        testify.assert_equal(self.db.tables(), ['emails', 'users'])
+
+    def test_rollback(self):
+        self.users['1'] = 'bob'
+
+        def fail():
+            with self.db.transaction():
+                del self.users['1']
+                self.users.set('2', 'amy', ttl=60)
+                self.emails.clear()
+                self.emails['amy@example.com'] = '2'
+                raise ValueError
+        testify.assert_raises(ValueError, fail)
+        testify.assert_equal(self.users.items(), [('1', 'bob')])
+        testify.assert_equal(self.emails.items(), [])
+
+    def test_nested(self):
+        with self.db.transaction():
+            self.users['1'] = 'bob'
+            try:
+                with self.db.transaction():
+                    self.emails['bob@example.com'] = '1'
+                    raise ValueError
+            except ValueError:
+                pass
+            with self.db.transaction():
+                self.users['2'] = 'amy'
+        testify.assert_equal(
+            self.other_conn_rows('users'), [('1', 'bob'), ('2', 'amy')]
+        )
+        testify.assert_equal(self.other_conn_rows('emails'), [])
+
+    def test_no_timeouts_in_transaction(self):
+        timed = self.db.map('timed', timeout=0)
+        rows = [('k%05d' % i, 'v') for i in xrange(20000)]
+        testify.assert_raises(
+            sqlite3dbm.dbm.SqliteMapTimeout, lambda: timed.update(rows)
+        )
+
+        # An interrupt would roll back the writes before it too
+        with self.db.transaction():
+            self.users['1'] = 'bob'
+            timed.update(rows)
+            testify.assert_equal(len(timed.get_many(rows[0])), 2)
+        testify.assert_equal(self.other_conn_rows('users'), [('1', 'bob')])
+        testify.assert_equal(len(self.other_conn_rows('timed')), 20000)
+
+    def test_already_rolled_back(self):
+        def fail():
+            with self.db.transaction():
+                with self.db.transaction():
+                    self.users['1'] = 'bob'
+                    # As SQLite does on some errors
+                    self.db.conn.execute('ROLLBACK')
+                    raise ValueError
+        testify.assert_raises(ValueError, fail)
+        testify.assert_equal(self.db.conn.isolation_level, '')
+        testify.assert_equal(self.users.items(), [])
+        self.users['2'] = 'amy'
+        testify.assert_equal(self.other_conn_rows('users'), [('2', 'amy')])
+
+    def test_shelf(self):
+        shelf = self.db.shelf('objects')
+        with self.db.transaction():
+            shelf['a'] = {'n': 1}
+            self.users['1'] = 'bob'
+        testify.assert_equal(shelf['a'], {'n': 1})
+        testify.assert_equal(
+            dict(sqlite3dbm.sshelve.open(self.path, table='objects')),
+            {'a': {'n': 1}}
+        )
+
+
+class TestTypedValues(SqliteCreationTest):
+    def test_numbers(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='c', codec='int')
+        smap.update({'a': 1, 'b': 2})
+        smap['c'] = 3
+        testify.assert_equal(smap['a'], 1)
+        testify.assert_equal(smap.incr('a', 5), 6)
+        testify.assert_equal(
+            smap.get_many('a', 'nope', 'c', default=-1), [6, -1, 3]
+        )
+        testify.assert_equal(
+            sorted(smap.items()), [('a', 6), ('b', 2), ('c', 3)]
+        )
+        testify.assert_equal(smap.get_dict('b', 'nope'), {'b': 2})
+
+        # Stored natively
+        testify.assert_equal(
+            set(smap.conn.execute('SELECT typeof(val) FROM kv_table')),
+            set([('integer',)])
+        )
+
+        testify.assert_equal(
+            list(smap.get_many_array(['a', 'b'], 'nope', default=0)),
+            [6, 2, 0]
+        )
+        testify.assert_raises(
+            KeyError, lambda: smap.get_many_array('a', 'nope')
+        )
+        smap['big'] = 1 << 62
+        packed = smap.get_many_array('big')
+        testify.assert_equal(packed.itemsize, 8)
+        testify.assert_equal(list(packed), [1 << 62])
+        del smap['big']
+        testify.assert_raises(KeyError, lambda: smap.select('a', 'nope'))
+
+        floats = sqlite3dbm.dbm.open(
+            self.path, flag='w', codec='float', table='scores'
+        )
+        floats['x'] = 0.5
+        testify.assert_equal(floats.get_many_array('x'), array('d', [0.5]))
+        floats['y'] = 2.5
+        testify.assert_equal(floats.incr('y'), 3.5)
+        testify.assert_equal(floats.incr('y', 0.25), 3.75)
+        testify.assert_equal(floats['y'], 3.75)
+
+    def test_arrays(self):
+        smap = sqlite3dbm.dbm.open(
+            self.path, flag='c', codec=sqlite3dbm.dbm.ArrayCodec('f')
+        )
+        smap['x'] = [1, 2, 3]
+        smap.update({'y': array('f', [4, 5, 6])})
+        testify.assert_equal(smap['x'], array('f', [1, 2, 3]))
+        testify.assert_equal(
+            smap.select('x', 'y'),
+            [array('f', [1, 2, 3]), array('f', [4, 5, 6])]
+        )
+        testify.assert_equal(
+            smap.get_many_array('y', 'nope', 'x', default=[0]),
+            array('f', [4, 5, 6, 0, 1, 2, 3])
+        )
+
+        # The packed bytes can be read partially
+        blob = smap.open_blob('y')
+        blob.seek(4)
+        testify.assert_equal(array('f', blob.read(4)), array('f', [5]))
+
+        backup_path = os.path.join(self.tmpdir, 'backup')
+        smap.backup(backup_path)
+        backup = sqlite3dbm.dbm.open(backup_path, codec=smap.codec)
+        testify.assert_equal(backup['x'], array('f', [1, 2, 3]))
+
+        try:
+            import numpy
+        except ImportError:
+            testify.assert_raises(
+                sqlite3dbm.dbm.error,
+                lambda: smap.get_many_array('x', 'y', numpy=True)
+            )
+        else:
+            testify.assert_equal(
+                smap.get_many_array('x', 'y', numpy=True).tolist(),
+                [[1, 2, 3], [4, 5, 6]]
+            )
+
+    def test_bad_codec(self):
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.dbm.open(self.path, flag='c', codec='nope')
+        )
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: sqlite3dbm.dbm.open(
+                self.path, flag='c', codec='int', metrics=True
+            )
+        )
+
+
+class TestTimeouts(SqliteCreationTest):
+    @testify.setup
+    def fill_map(self):
+        self.smap = sqlite3dbm.dbm.open(self.path, flag='c')
+        self.smap.update(('k%05d' % i, 'v') for i in xrange(20000))
+        self.keys = ['k%05d' % i for i in xrange(20000)]
+
+    def test_per_call_timeout(self):
+        smap = self.smap
+        # A deadline in the past interrupts the first progress check
+        testify.assert_raises(
+            sqlite3dbm.dbm.SqliteMapTimeout,
+            lambda: smap.get_many(self.keys, timeout=0)
+        )
+        testify.assert_raises(
+            sqlite3dbm.dbm.SqliteMapTimeout, lambda: smap.items(timeout=0)
+        )
+        testify.assert_raises(
+            sqlite3dbm.dbm.error,
+            lambda: smap.delete_prefix('k', timeout=0)
+        )
+
+        # Nothing was deleted, and the connection still works
+        testify.assert_equal(len(smap), 20000)
+        testify.assert_equal(len(smap.get_many(self.keys, timeout=10)), 20000)
+        testify.assert_equal(smap.get_dict('k00001', timeout=10),
+                             {'k00001': 'v'})
+        smap['new'] = 'x'
+        testify.assert_equal(smap['new'], 'x')
+
+    def test_map_timeout(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='w', timeout=0)
+        testify.assert_raises(
+            sqlite3dbm.dbm.SqliteMapTimeout, lambda: smap.get_many(self.keys)
+        )
+        testify.assert_raises(
+            sqlite3dbm.dbm.SqliteMapTimeout, lambda: smap.keys()
+        )
+        # Overridden per call
+        testify.assert_equal(len(smap.keys(timeout=None)), 20000)
+
+    def test_lock_wait(self):
+        other = sqlite3dbm.dbm.sqlite3.connect(self.path)
+        other.execute('BEGIN EXCLUSIVE')
+        try:
+            start = time.time()
+            testify.assert_raises(
+                sqlite3dbm.dbm.SqliteMapTimeout,
+                lambda: self.smap.delete_many(['k00001'], timeout=0.05)
+            )
+            # Not the default five second busy timeout
+            testify.assert_lt(time.time() - start, 2)
+        finally:
+            other.rollback()
+        testify.assert_equal(
+            self.smap.conn.execute('PRAGMA busy_timeout').fetchone()[0], 5000
+        )
+        testify.assert_equal(self.smap.delete_many(['k00001']), 1)
+
+    def test_open_iterator(self):
+        # The deadline only applies while rows are being fetched, so other
+        # operations run between them are left alone
+        vals = self.smap.get_many_iter(self.keys, timeout=0.05)
+        vals.next()
+        items = self.smap.iteritems(timeout=0.05)
+        items.next()
+        time.sleep(0.1)
+        testify.assert_equal(len(self.smap.items()), 20000)
+        testify.assert_raises(
+            sqlite3dbm.dbm.SqliteMapTimeout, lambda: list(vals)
+        )
+        testify.assert_raises(
+            sqlite3dbm.dbm.SqliteMapTimeout, lambda: list(items)
+        )
+
+    def test_single_key_lock_wait(self):
+        smap = sqlite3dbm.dbm.open(self.path, flag='w', timeout=0.05)
+        # Connecting is not covered by the timeout
+        smap.conn
+        other = sqlite3dbm.dbm.sqlite3.connect(self.path)
+        other.execute('BEGIN EXCLUSIVE')
+        try:
+            start = time.time()
+            testify.assert_raises(
+                sqlite3dbm.dbm.SqliteMapTimeout, lambda: smap['k00001']
+            )
+            testify.assert_raises(
+                sqlite3dbm.dbm.SqliteMapTimeout,
+                lambda: smap.__setitem__('k00001', 'x')
+            )
+            testify.assert_lt(time.time() - start, 2)
+        finally:
+            other.rollback()
+        smap['k00001'] = 'x'
+        testify.assert_equal(smap['k00001'], 'x')
+
+    def test_diagnostics(self):
+        diagnostics = sqlite3dbm.dbm.Diagnostics(progress_steps=100)
+        smap = sqlite3dbm.dbm.open(
+            self.path, flag='w', diagnostics=diagnostics
+        )
+        testify.assert_raises(
+            sqlite3dbm.dbm.SqliteMapTimeout, lambda: smap.values(timeout=0)
+        )
+        # The statistics handler is put back
+        diagnostics.reset()
+        smap.get_many(self.keys)
+        get_many_sql = (
+            sqlite3dbm.dbm._GET_MANY_TTL_QUERY_TEMPLATE % ('?,...',)
+        )
+        testify.assert_gt(
+            diagnostics.statement_stats()[get_many_sql]['vm_steps'], 0
+        )
+
+
 class SanityCheckOpen(SqliteCreationTest):
     def test_open_creates(self):
         smap = sqlite3dbm.dbm.open(self.path, flag='c')
         smap['foo'] = 'bar'
         testify.assert_equal(smap['foo'], 'bar')
 
+    def test_connects_lazily(self):
+        sqlite3dbm.dbm.open(self.path, flag='c')
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_not_in('conn', vars(smap))
+        testify.assert_equal(len(smap), 0)
+        testify.assert_in('conn', vars(smap))
+        testify.assert_raises(AttributeError, lambda: smap.nope)
+
+    def test_new_files_are_valid_dbs(self):
+        sqlite3dbm.dbm.open(self.path, flag='c')
+        mem_map = sqlite3dbm.dbm.open(self.path, in_memory=True)
+        testify.assert_equal(len(mem_map), 0)
+
 
 if __name__ == '__main__':
     testify.run()
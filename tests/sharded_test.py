@@ -0,0 +1,243 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test the sharded SqliteMap"""
+
+import os
+import shutil
+import tempfile
+
+import testify
+
+import sqlite3dbm.sharded
+
+class ShardedMapTestCase(testify.TestCase):
+    """Common setup for sharded map tests"""
+
+    parallel = None
+
+    @testify.setup
+    def create_map(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'shards')
+        self.smap = sqlite3dbm.sharded.open(
+            self.path, num_shards=4, flag='c', parallel=self.parallel
+        )
+
+    @testify.teardown
+    def teardown_map(self):
+        shutil.rmtree(self.tmpdir)
+
+
+class TestShardedMapInterface(ShardedMapTestCase):
+    def test_dict_interface(self):
+        self.smap['foo'] = 'bar'
+        testify.assert_equal(self.smap['foo'], 'bar')
+        testify.assert_in('foo', self.smap)
+        testify.assert_equal(self.smap.get('qux', 'd'), 'd')
+
+        testify.assert_equal(self.smap.pop('foo'), 'bar')
+        testify.assert_not_in('foo', self.smap)
+        testify.assert_raises(KeyError, lambda: self.smap['foo'])
+
+        self.smap.setdefault('a', 'b')
+        testify.assert_equal(self.smap.popitem(), ('a', 'b'))
+        testify.assert_raises(KeyError, self.smap.popitem)
+
+    def test_keys_are_spread_over_shards(self):
+        d = dict(('key%d' % i, 'val%d' % i) for i in xrange(200))
+        self.smap.update(d)
+
+        testify.assert_equal(len(self.smap), 200)
+        testify.assert_equal(dict(self.smap.items()), d)
+        testify.assert_equal(dict(self.smap.iteritems()), d)
+        for shard in self.smap.shards:
+            testify.assert_gt(len(shard), 0)
+
+    def test_get_many_keeps_order(self):
+        d = dict(('key%d' % i, 'val%d' % i) for i in xrange(50))
+        self.smap.update(d)
+
+        keys = ['key%d' % i for i in reversed(xrange(50))]
+        testify.assert_equal(self.smap.select(keys), [d[k] for k in keys])
+        testify.assert_equal(self.smap[keys], [d[k] for k in keys])
+        testify.assert_equal(
+            self.smap.get_many('key1', 'nope', 'key2', default=''),
+            ['val1', '', 'val2']
+        )
+        testify.assert_raises(
+            KeyError,
+            lambda: self.smap.select('key1', 'nope')
+        )
+
+    def test_clear(self):
+        self.smap.update(('key%d' % i, 'v') for i in xrange(20))
+        self.smap.clear()
+        testify.assert_equal(len(self.smap), 0)
+
+    def test_set_with_ttl(self):
+        self.smap.set('forever', 'a', ttl=None)
+        self.smap.set('gone', 'b', ttl=-1)
+        testify.assert_equal(self.smap['forever'], 'a')
+        testify.assert_not_in('gone', self.smap)
+
+    def test_lookups(self):
+        self.smap.update(('key%d' % i, 'val%d' % i) for i in xrange(20))
+        keys = ['key%d' % i for i in xrange(25)]
+
+        testify.assert_equal(
+            list(self.smap.get_many_iter(iter(keys), default='d')),
+            self.smap.get_many(keys, default='d')
+        )
+        testify.assert_equal(
+            self.smap.get_dict(keys),
+            dict(('key%d' % i, 'val%d' % i) for i in xrange(20))
+        )
+
+    def test_deletes(self):
+        self.smap.update(('key%02d' % i, 'v') for i in xrange(30))
+
+        testify.assert_equal(self.smap.delete_many(['key00', 'nope']), 1)
+        testify.assert_raises(
+            KeyError,
+            lambda: self.smap.delete_many(['key01', 'nope'], missing_ok=False)
+        )
+        testify.assert_in('key01', self.smap)
+
+        testify.assert_equal(self.smap.delete_range('key01', 'key10'), 9)
+        testify.assert_equal(self.smap.delete_prefix('key1'), 10)
+        testify.assert_equal(
+            sorted(self.smap.keys()), ['key%02d' % i for i in xrange(20, 30)]
+        )
+
+    def test_reopen_infers_num_shards(self):
+        self.smap['foo'] = 'bar'
+        reopened = sqlite3dbm.sharded.open(self.path)
+        testify.assert_equal(reopened.num_shards, 4)
+        testify.assert_equal(reopened['foo'], 'bar')
+
+        testify.assert_raises(
+            sqlite3dbm.sharded.error,
+            lambda: sqlite3dbm.sharded.open(self.path, num_shards=3)
+        )
+
+    def test_journal_files_are_not_shards(self):
+        for suffix in ('-journal', '-wal', '-shm'):
+            open(os.path.join(self.path, 'shard-00000.sqlite3' + suffix), 'w')
+        testify.assert_equal(sqlite3dbm.sharded.open(self.path).num_shards, 4)
+        sqlite3dbm.sharded.open(self.path, num_shards=4)
+
+    def test_read_only(self):
+        smap = sqlite3dbm.sharded.open(self.path)
+        def do_setitem():
+            smap['foo'] = 'bar'
+        testify.assert_raises(sqlite3dbm.sharded.error, do_setitem)
+        testify.assert_raises(
+            sqlite3dbm.sharded.error,
+            lambda: smap.update({'foo': 'bar'})
+        )
+        testify.assert_raises(
+            sqlite3dbm.sharded.error,
+            lambda: sqlite3dbm.sharded.open(
+                os.path.join(self.tmpdir, 'missing')
+            )
+        )
+
+
+class TestThreadParallelShardedMap(ShardedMapTestCase):
+    parallel = 'thread'
+
+    def test_bulk_operations(self):
+        d = dict(('key%d' % i, 'val%d' % i) for i in xrange(200))
+        self.smap.update(d)
+
+        testify.assert_equal(dict(self.smap.items()), d)
+        keys = sorted(d)
+        testify.assert_equal(self.smap.select(keys), [d[k] for k in keys])
+
+        self.smap.clear()
+        testify.assert_equal(len(self.smap), 0)
+
+
+class TestProcessParallelShardedMap(ShardedMapTestCase):
+    parallel = 'process'
+
+    def test_bulk_operations(self):
+        d = dict(('key%d' % i, 'val%d' % i) for i in xrange(200))
+        self.smap.update(d)
+
+        testify.assert_equal(dict(self.smap.items()), d)
+        keys = sorted(d)
+        testify.assert_equal(
+            self.smap.get_many(keys + ['nope']),
+            [d[k] for k in keys] + [None]
+        )
+
+
+class TestShardedShelf(testify.TestCase):
+    @testify.setup
+    def create_shelf(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'shards')
+        self.shelf = sqlite3dbm.sharded.open_shelf(self.path, num_shards=3)
+
+    @testify.teardown
+    def teardown_shelf(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_serialization(self):
+        droid = ['R2-D2', 'C-3P0']
+        self.shelf.update({'jason': 'fennell', 'droid': droid, 'pi': 3.14})
+        self.shelf['dict'] = {'a': 1}
+
+        testify.assert_equal(self.shelf['droid'], droid)
+        testify.assert_equal(
+            self.shelf.get_many('pi', 'dict', 'nope', default=0),
+            [3.14, {'a': 1}, 0]
+        )
+        testify.assert_equal(len(self.shelf), 4)
+
+        self.shelf.clear()
+        testify.assert_equal(len(self.shelf), 0)
+
+    def test_batched_methods(self):
+        self.shelf.update(('key%d' % i, [i]) for i in xrange(10))
+        self.shelf.set('ttl', {}, ttl=None)
+
+        testify.assert_equal(
+            list(self.shelf.get_many_iter('key1', 'nope', default=0)),
+            [[1], 0]
+        )
+        testify.assert_equal(
+            self.shelf.get_dict('key2', 'ttl', 'nope'),
+            {'key2': [2], 'ttl': {}}
+        )
+        testify.assert_equal(self.shelf.delete_many(['key0', 'ttl']), 2)
+        testify.assert_equal(self.shelf.delete_range('key1', 'key3'), 2)
+        testify.assert_equal(self.shelf.delete_prefix('key'), 7)
+        testify.assert_equal(len(self.shelf), 0)
+
+    def test_indexes_are_refused(self):
+        for call in (
+            lambda: self.shelf.add_index('first', lambda v: v[0]),
+            lambda: self.shelf.rebuild_index(),
+            lambda: self.shelf.drop_index('first'),
+            lambda: self.shelf.find('first', 1),
+            lambda: self.shelf.find_range('first', 1, 2),
+        ):
+            testify.assert_raises(sqlite3dbm.sharded.error, call)
+
+
+if __name__ == '__main__':
+    testify.run()
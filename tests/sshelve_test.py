@@ -17,6 +17,8 @@
 
 import os
 import shutil
+import subprocess
+import sys
 import tempfile
 import time
 
@@ -24,6 +26,20 @@ import testify
 
 import sqlite3dbm
 
+class TestLazyImport(testify.TestCase):
+    def test_import_does_not_load_shelve(self):
+        code = (
+            'import sys, sqlite3dbm; '
+            'print "sqlite3dbm.sshelve" in sys.modules; '
+            'sqlite3dbm.sshelve.SqliteMapShelf; '
+            'print sqlite3dbm.sshelve.__name__'
+        )
+        output = subprocess.Popen(
+            [sys.executable, '-c', code], stdout=subprocess.PIPE
+        ).communicate()[0]
+        testify.assert_equal(output, 'False\nsqlite3dbm.sshelve\n')
+
+
 class TestSqliteShelf(testify.TestCase):
     @testify.setup
     def create_shelf(self):
@@ -115,6 +131,33 @@ class TestSqliteShelf(testify.TestCase):
         testify.assert_equal(len(self.smap_shelf), 0)
         testify.assert_not_in('jason', self.smap_shelf)
 
+    def test_set_ttl(self):
+        self.smap_shelf.set('live', [1, 2], ttl=60)
+        self.smap_shelf.set('dead', [3, 4], ttl=-1)
+
+        testify.assert_equal(self.smap_shelf['live'], [1, 2])
+        testify.assert_not_in('dead', self.smap_shelf)
+
+    def test_batch_deletes(self):
+        self.smap_shelf.update({
+            'user:1': [1], 'user:2': [2], 'post:1': [3], 'zzz': [4],
+        })
+        testify.assert_equal(self.smap_shelf.delete_prefix('user:'), 2)
+        testify.assert_equal(self.smap_shelf.delete_many(['zzz', 'nope']), 1)
+        testify.assert_equal(self.smap_shelf.delete_range('a', 'q'), 1)
+        testify.assert_equal(len(self.smap_shelf), 0)
+
+    def test_streaming_lookups(self):
+        self.smap_shelf.update({'a': [1], 'b': {'c': 2}})
+        testify.assert_equal(
+            list(self.smap_shelf.get_many_iter(['a', 'nope', 'b'], default=0)),
+            [[1], 0, {'c': 2}]
+        )
+        testify.assert_equal(
+            self.smap_shelf.get_dict('a', 'nope'),
+            {'a': [1]}
+        )
+
     def test_preserves_unicode(self):
         """Be paranoid about unicode."""
         k = u'café'.encode('utf-8')
@@ -125,6 +168,99 @@ class TestSqliteShelf(testify.TestCase):
         testify.assert_equal(self.smap_shelf.get_many([k]), [v])
 
 
+class TestSecondaryIndex(testify.TestCase):
+    @testify.setup
+    def create_indexed_shelf(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sqlite_map_test_db.sqlite')
+        self.smap_shelf = shelf = sqlite3dbm.sshelve.SqliteMapShelf(
+            sqlite3dbm.open(self.path, flag='c')
+        )
+
+        shelf['bob'] = {'city': 'SF', 'age': 30}
+        shelf.add_index('city', lambda v: v.get('city'))
+        shelf.add_index('age', lambda v: v.get('age'))
+
+        shelf.update({
+            'amy': {'city': 'NYC', 'age': 25},
+            'cal': {'city': 'SF', 'age': 41},
+            'dan': {'age': 19},
+        })
+        shelf.set('eve', {'city': 'SF', 'age': 35})
+
+    @testify.teardown
+    def teardown_shelf(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_find(self):
+        testify.assert_equal(
+            [k for k, _ in self.smap_shelf.find('city', 'SF')],
+            ['bob', 'cal', 'eve']
+        )
+        testify.assert_equal(
+            self.smap_shelf.find('city', 'NYC'),
+            [('amy', {'city': 'NYC', 'age': 25})]
+        )
+        testify.assert_equal(self.smap_shelf.find('city', 'LA'), [])
+
+    def test_find_range(self):
+        testify.assert_equal(
+            [k for k, _ in self.smap_shelf.find_range('age', 20, 36)],
+            ['amy', 'bob', 'eve']
+        )
+        testify.assert_equal(
+            [k for k, _ in self.smap_shelf.find_range('age', start=35)],
+            ['eve', 'cal']
+        )
+
+    def test_writes_update_index(self):
+        shelf = self.smap_shelf
+        shelf['bob'] = {'city': 'LA', 'age': 30}
+        del shelf['cal']
+        shelf.delete_many(['eve'])
+        testify.assert_equal(shelf.find('city', 'SF'), [])
+        testify.assert_equal(
+            [k for k, _ in shelf.find('city', 'LA')], ['bob']
+        )
+
+        shelf.delete_prefix('a')
+        testify.assert_equal(shelf.find('city', 'NYC'), [])
+
+        shelf.clear()
+        testify.assert_equal(shelf.find_range('age'), [])
+
+    def test_failed_write_leaves_index(self):
+        def bad_extractor(v):
+            if v.get('bad'):
+                raise ValueError(v)
+        self.smap_shelf.add_index('bad', bad_extractor)
+        testify.assert_raises(
+            ValueError, lambda: self.smap_shelf.update({'x': {'bad': 1}})
+        )
+        testify.assert_not_in('x', self.smap_shelf)
+
+        self.smap_shelf.drop_index('bad')
+        self.smap_shelf['x'] = {'bad': 1}
+        testify.assert_in('x', self.smap_shelf)
+
+    def test_index_persists(self):
+        reopened = sqlite3dbm.sshelve.SqliteMapShelf(
+            sqlite3dbm.open(self.path, flag='w')
+        )
+        reopened.add_index('city', lambda v: v.get('city'))
+        testify.assert_equal(
+            [k for k, _ in reopened.find('city', 'NYC')], ['amy']
+        )
+
+    def test_rebuild_index(self):
+        self.smap_shelf.add_index('city', lambda v: v.get('age'))
+        self.smap_shelf.rebuild_index()
+        testify.assert_equal(
+            [k for k, _ in self.smap_shelf.find('city', 30)], ['bob']
+        )
+        testify.assert_equal(self.smap_shelf.find('city', 'SF'), [])
+
+
 class TestShelfOpen(testify.TestCase):
     @testify.setup
     def create_shelf(self):
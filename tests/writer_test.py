@@ -0,0 +1,173 @@
+# Copyright 2011 Yelp
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Test the single-writer service"""
+
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import testify
+
+import sqlite3dbm.dbm
+import sqlite3dbm.writer
+
+def write_range(service, name, n):
+    """Worker process body: write `n` keys through the service."""
+    db = service.client()
+    for i in xrange(n):
+        db['%s%d' % (name, i)] = str(i)
+    db.flush()
+
+class TestWriterService(testify.TestCase):
+    @testify.setup
+    def start_service(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'sqlite_map_test_db.sqlite')
+        self.service = sqlite3dbm.writer.WriterService(self.path)
+        self.service.start()
+        self.db = self.service.client()
+
+    @testify.teardown
+    def stop_service(self):
+        self.service.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_setitem_visible_after_flush(self):
+        self.db['foo'] = 'bar'
+        self.db.flush()
+        testify.assert_equal(self.db['foo'], 'bar')
+
+        # Other, ordinary readers see the write too
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_equal(smap['foo'], 'bar')
+
+    def test_update_delitem_clear(self):
+        self.db.update({'a': '1', 'b': '2'}, c='3')
+        self.db.flush()
+        testify.assert_equal(len(self.db), 3)
+
+        del self.db['a']
+        self.db.flush()
+        testify.assert_not_in('a', self.db)
+        testify.assert_raises(KeyError, lambda: self.db.__delitem__('a'))
+
+        testify.assert_equal(self.db.pop('b'), '2')
+        self.db.flush()
+        testify.assert_not_in('b', self.db)
+
+        self.db.clear()
+        self.db.flush()
+        testify.assert_equal(len(self.db), 0)
+
+    def test_many_writer_processes(self):
+        num_procs = 4
+        per_proc = 200
+        procs = [
+            multiprocessing.Process(
+                target=write_range,
+                args=(self.service, 'proc%d-' % i, per_proc),
+            )
+            for i in xrange(num_procs)
+        ]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+            testify.assert_equal(proc.exitcode, 0)
+
+        self.db.flush()
+        testify.assert_equal(len(self.db), num_procs * per_proc)
+        testify.assert_equal(self.db['proc3-199'], '199')
+
+    def test_bad_write_only_drops_itself(self):
+        self.db['good'] = 'x'
+        self.service.put('set', ('bad',))
+        self.db['also_good'] = 'y'
+        testify.assert_raises(sqlite3dbm.dbm.error, self.db.flush)
+        testify.assert_equal(self.db['good'], 'x')
+        testify.assert_equal(self.db['also_good'], 'y')
+
+        # The failure is only reported once
+        self.db['later'] = 'z'
+        self.db.flush()
+        testify.assert_equal(self.db['later'], 'z')
+        # ...to each flusher
+        testify.assert_raises(sqlite3dbm.dbm.error, self.service.flush)
+        self.service.flush()
+
+    def test_other_writes_refused(self):
+        self.db['n'] = '1'
+        self.db.flush()
+        for write in [
+            lambda: self.db.incr('n', 5),
+            lambda: self.db.set('t', 'v', ttl=100),
+            lambda: self.db.append('n', 'x'),
+            lambda: self.db.delete_many(['n']),
+            lambda: self.db.delete_prefix('n'),
+            lambda: self.db.evict_expired(),
+        ]:
+            testify.assert_raises(sqlite3dbm.dbm.error, write)
+        testify.assert_equal(self.db['n'], '1')
+
+        self.db.set('t', 'v')
+        testify.assert_equal(self.db.setdefault('u', 'w'), 'w')
+        self.db.flush()
+        testify.assert_equal(self.db.get_many('t', 'u'), ['v', 'w'])
+
+    def test_retries_when_locked(self):
+        self.service.stop()
+        busy_timeout = sqlite3dbm.writer._BUSY_TIMEOUT
+        sqlite3dbm.writer._BUSY_TIMEOUT = 10
+        try:
+            self.service = sqlite3dbm.writer.WriterService(self.path)
+            self.service.start()
+        finally:
+            sqlite3dbm.writer._BUSY_TIMEOUT = busy_timeout
+        self.db = self.service.client()
+
+        # A reader in a transaction keeps the writer from committing for
+        # longer than it waits on the lock
+        reader = sqlite3.connect(self.path, isolation_level=None)
+        reader.execute('BEGIN')
+        reader.execute('SELECT COUNT(*) FROM kv_table').fetchall()
+        self.db['foo'] = 'bar'
+        time.sleep(0.3)
+        reader.execute('COMMIT')
+
+        self.db.flush()
+        testify.assert_equal(self.db['foo'], 'bar')
+
+    def test_flush_after_writer_died(self):
+        testify.assert_equal(self.service.is_alive(), True)
+        self.service.process.terminate()
+        self.service.process.join()
+        testify.assert_equal(self.service.is_alive(), False)
+
+        self.db['foo'] = 'bar'
+        testify.assert_raises(sqlite3dbm.dbm.error, self.db.flush)
+
+    def test_stop_commits_pending_writes(self):
+        self.db.update(('k%d' % i, 'v') for i in xrange(100))
+        self.service.stop()
+
+        smap = sqlite3dbm.dbm.open(self.path)
+        testify.assert_equal(len(smap), 100)
+
+
+if __name__ == '__main__':
+    testify.run()